@@ -0,0 +1,296 @@
+import gzip
+import json
+import logging
+import os
+import threading
+from datetime import date, datetime
+from glob import glob
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple, Union
+
+from config import ARCHIVE_COMPRESSION, SCRAP_DATA
+from storage import day_folder
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger('solaredge')
+
+SEGMENT_NAMES = {'gzip': 'dump.jsonl.gz', 'zstd': 'dump.jsonl.zst'}
+INDEX_NAME = 'dump.idx'
+
+
+def timestamp_key(timestamp: Union[datetime, float]) -> str:
+    if isinstance(timestamp, datetime):
+        timestamp = timestamp.timestamp()
+    return '%.6f' % timestamp
+
+
+def encode_record(timestamp: datetime, scrap_response: Dict) -> bytes:
+    """One JSONL line; raw bodies are embedded without being parsed"""
+    head = '{"ts":%s,"url":%s,"res":' % (
+        timestamp_key(timestamp), json.dumps(scrap_response.get('url')))
+    if 'raw' in scrap_response:
+        body = scrap_response['raw']
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        elif not isinstance(body, bytes):
+            body = bytes(body)
+        # json only allows a newline as whitespace between tokens, where a
+        # space means the same and keeps the record on one line
+        if b'\n' in body:
+            body = body.replace(b'\n', b' ')
+    else:
+        body = json.dumps(scrap_response.get('res')).encode('utf-8')
+    return head.encode('utf-8') + body + b'}\n'
+
+
+def _compress(data: bytes, compression: str) -> bytes:
+    if compression == 'zstd':
+        return zstandard.ZstdCompressor().compress(data)
+    return gzip.compress(data, compresslevel=6)
+
+
+def _decompress(data: bytes, compression: str) -> bytes:
+    if compression == 'zstd':
+        return zstandard.ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+
+def _read_index(path: str) -> Tuple[List[Tuple[str, int, int]], int]:
+    """The ``(timestamp, offset, length)`` entries of an index and the size
+    of its complete lines; a line cut short by a crash is left out"""
+    try:
+        with open(path, 'rb') as index_obj:
+            content = index_obj.read()
+    except FileNotFoundError:
+        return [], 0
+    size = content.rfind(b'\n') + 1
+    entries = []
+    for line in content[:size].splitlines():
+        parts = line.split()
+        if len(parts) == 3:
+            entries.append((parts[0].decode('ascii'), int(parts[1]), int(parts[2])))
+    return entries, size
+
+
+def _truncate(path: str, size: int):
+    if os.path.exists(path) and os.path.getsize(path) > size:
+        logger.warning("Truncating torn tail of %s at %d bytes" % (path, size))
+        with open(path, 'r+b') as file_obj:
+            file_obj.truncate(size)
+
+
+class _Segment:
+    """An open segment and its offset index.
+
+    A crash may leave a member, or an index line, half written. Appending
+    after it would make the segment undecodable past that point, so both
+    files are first cut back to the last indexed member.
+    """
+
+    def __init__(self, folder: str, compression: str):
+        data_path = os.path.join(folder, SEGMENT_NAMES[compression])
+        index_path = os.path.join(folder, INDEX_NAME)
+        entries, index_size = _read_index(index_path)
+        _truncate(index_path, index_size)
+        _truncate(data_path, max((offset + length for _, offset, length in entries),
+                                 default=0))
+        self.data: BinaryIO = open(data_path, 'ab')
+        self.index = open(index_path, 'a')
+
+    def close(self):
+        self.data.close()
+        self.index.close()
+
+
+class SegmentArchive:
+    """Appends raw responses to one compressed JSONL segment per site and
+    day, ``scrap_data/<date>/<site_id>/dump.jsonl.gz``.
+
+    Every record is compressed as its own gzip member (or zstd frame), so
+    the segment still decompresses as one stream for sequential reads,
+    while the sidecar ``dump.idx`` (``<timestamp> <offset> <length>`` per
+    line) lets the records of one message be read with a seek each. The
+    responses of one message share its timestamp, so it can appear on
+    several lines.
+    """
+
+    def __init__(self, compression: str = ARCHIVE_COMPRESSION):
+        if compression not in SEGMENT_NAMES:
+            raise ValueError("Unknown archive compression %s" % compression)
+        if compression == 'zstd' and zstandard is None:
+            raise RuntimeError("zstandard is required for zstd archives")
+        self.compression = compression
+        self._segments: Dict[Tuple[Optional[int], date], _Segment] = {}
+        self._day: Optional[date] = None
+        self._lock = threading.Lock()
+
+    def append(self, timestamp: datetime, site_id: Optional[int], scrap_response: Dict):
+        key = (site_id, timestamp.date())
+        member = _compress(encode_record(timestamp, scrap_response),
+                           self.compression)
+        with self._lock:
+            if self._day is None or key[1] > self._day:
+                self._roll_over(key[1])
+            segment = self._segments.get(key)
+            if segment is None:
+                segment = self._segments[key] = _Segment(
+                    day_folder(timestamp, site_id), self.compression)
+            offset = segment.data.tell()
+            segment.data.write(member)
+            segment.data.flush()
+            # the index line is written last so it never points past the data
+            segment.index.write('%s %d %d\n' % (
+                timestamp_key(timestamp), offset, len(member)))
+            segment.index.flush()
+        logger.info("Archived response of site %s at offset %s" %
+                    (site_id, offset))
+
+    def _roll_over(self, day: date):
+        self._day = day
+        for key in [key for key in self._segments if key[1] < day]:
+            self._segments.pop(key).close()
+
+    def close(self):
+        with self._lock:
+            while self._segments:
+                self._segments.popitem()[1].close()
+
+
+class ArchiveReader:
+    """Reads back the segments written by ``SegmentArchive``"""
+
+    def __init__(self, folder: str):
+        self.folder = folder
+        for compression, name in SEGMENT_NAMES.items():
+            if os.path.exists(os.path.join(folder, name)):
+                self.compression = compression
+                self.path = os.path.join(folder, name)
+                break
+        else:
+            raise FileNotFoundError("No archive segment in %s" % folder)
+        self._index: Optional[Dict[str, List[Tuple[int, int]]]] = None
+
+    @classmethod
+    def for_day(cls, day: Union[date, str], site_id: Optional[int] = None) -> 'ArchiveReader':
+        folder = os.path.join(SCRAP_DATA, str(day))
+        if site_id is not None:
+            folder = os.path.join(folder, str(site_id))
+        return cls(folder)
+
+    @property
+    def index(self) -> Dict[str, List[Tuple[int, int]]]:
+        if self._index is None:
+            self._index = {}
+            for key, offset, length in _read_index(os.path.join(self.folder, INDEX_NAME))[0]:
+                self._index.setdefault(key, []).append((offset, length))
+        return self._index
+
+    def timestamps(self) -> List[float]:
+        return sorted(float(key) for key in self.index)
+
+    def read_raw(self, timestamp: Union[datetime, float]) -> bytes:
+        """The JSONL lines archived at ``timestamp``, one per response of
+        the message, in the order they were archived"""
+        lines = []
+        with open(self.path, 'rb') as data_obj:
+            for offset, length in self.index[timestamp_key(timestamp)]:
+                data_obj.seek(offset)
+                lines.append(_decompress(data_obj.read(length), self.compression))
+        return b''.join(lines)
+
+    def read(self, timestamp: Union[datetime, float]) -> List[Dict]:
+        return [json.loads(line) for line in self.read_raw(timestamp).splitlines()]
+
+    def lines(self) -> Iterator[bytes]:
+        """Every JSONL line of the day, in the order they were archived.
+
+        Only indexed members are read, so a torn member left by a crash
+        is skipped rather than failing the rest of the segment; without
+        an index the segment is decompressed as one stream.
+        """
+        entries = _read_index(os.path.join(self.folder, INDEX_NAME))[0]
+        if not entries:
+            yield from self._stream()
+            return
+        with open(self.path, 'rb') as data_obj:
+            for _, offset, length in sorted(entries, key=lambda entry: entry[1]):
+                data_obj.seek(offset)
+                member = data_obj.read(length)
+                try:
+                    yield _decompress(member, self.compression).rstrip(b'\n')
+                except Exception as error:
+                    logger.error("Skipping unreadable record at offset %d of %s, error:%s" %
+                                 (offset, self.path, error))
+
+    def _stream(self) -> Iterator[bytes]:
+        if self.compression == 'zstd':
+            with open(self.path, 'rb') as data_obj:
+                reader = zstandard.ZstdDecompressor().stream_reader(
+                    data_obj, read_across_frames=True)
+                yield from _lines(reader)
+            return
+        with gzip.open(self.path, 'rb') as data_obj:
+            for line in data_obj:
+                yield line.rstrip(b'\n')
+
+    def __iter__(self) -> Iterator[Dict]:
+        """Every record of the day, in the order they were archived"""
+        for line in self.lines():
+            yield json.loads(line)
+
+
+def has_dumps(folder: str) -> bool:
+    """Whether ``folder`` holds legacy dump files or an archive segment"""
+    return (os.path.isdir(os.path.join(folder, 'dump'))
+            or any(os.path.exists(os.path.join(folder, name))
+                   for name in SEGMENT_NAMES.values()))
+
+
+def iter_dumps(folder: str, raw: bool = True) -> Iterator[Tuple[datetime, Dict]]:
+    """Every response archived in one day (or day/site) folder as
+    ``(timestamp, scrap_response)``: legacy ``dump/<timestamp>.json`` files
+    first, then the archive segment"""
+    for path in sorted(glob(os.path.join(folder, 'dump', '*.json'))):
+        stamp = os.path.splitext(os.path.basename(path))[0].replace('_', '.')
+        with open(path, 'rb') as dump_obj:
+            body = dump_obj.read()
+        response = {'raw': body} if raw else {'res': json.loads(body)}
+        response['url'] = None
+        yield datetime.fromtimestamp(float(stamp)), response
+    try:
+        reader = ArchiveReader(folder)
+    except FileNotFoundError:
+        return
+    for line in reader.lines():
+        yield decode_line(line, raw)
+
+
+def decode_line(line: bytes, raw: bool = False) -> Tuple[datetime, Dict]:
+    """``(timestamp, scrap_response)`` of an archived line; with ``raw`` the
+    body is sliced out unparsed, it starts at the first ``,"res":`` as the
+    quotes of the url are escaped"""
+    if not raw:
+        record = json.loads(line)
+        return (datetime.fromtimestamp(record['ts']),
+                {'res': record['res'], 'url': record.get('url')})
+    head, body = line.rstrip(b'\n').split(b',"res":', 1)
+    record = json.loads(head + b'}')
+    return datetime.fromtimestamp(record['ts']), {'raw': body[:-1], 'url': record.get('url')}
+
+
+def _lines(reader) -> Iterator[bytes]:
+    pending = b''
+    while True:
+        chunk = reader.read(1 << 16)
+        if not chunk:
+            break
+        pending += chunk
+        *lines, pending = pending.split(b'\n')
+        for line in lines:
+            if line:
+                yield line
+    if pending:
+        yield pending
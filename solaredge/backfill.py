@@ -0,0 +1,272 @@
+"""Rebuilds the processed outputs of past days from their archived dumps.
+
+Every day folder of SCRAP_DATA (or every site folder of it, with
+``--per site``) is reprocessed on its own process through
+``WorkerThread.process_message``:
+
+    python backfill.py --since 2020-01-01 --until 2020-12-31 --jobs 8
+
+Outputs are written next to the live ones and swapped in once a unit is
+complete, so a run can be interrupted and repeated safely; SQLite readings
+go to a staging database merged into the live one in a single transaction. Finished units
+are marked with a ``backfill.json`` file and skipped on the next run unless
+their schema tag changed or ``--force`` is given.
+"""
+import argparse
+import json
+import os
+import re
+import shutil
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date, datetime
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+MARKER_NAME = 'backfill.json'
+STAGING_SUFFIX = '.backfill'
+DAY_RE = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+
+
+class Unit(NamedTuple):
+    """One piece of work: a day and the site folders it covers"""
+    day: str
+    folders: Tuple[Tuple[str, Optional[int]], ...]
+
+
+def discover_units(scrap_data: str, per: str, since: Optional[str] = None,
+                   until: Optional[str] = None, include_today: bool = False) -> List[Unit]:
+    from archive import has_dumps
+
+    today = str(date.today())
+    units = []
+    if not os.path.isdir(scrap_data):
+        return units
+    for day in sorted(os.listdir(scrap_data)):
+        day_path = os.path.join(scrap_data, day)
+        if not DAY_RE.match(day) or not os.path.isdir(day_path):
+            continue
+        if (since and day < since) or (until and day > until):
+            continue
+        if day == today and not include_today:
+            continue
+        folders = []
+        if has_dumps(day_path):
+            folders.append((day_path, None))
+        for name in sorted(os.listdir(day_path)):
+            path = os.path.join(day_path, name)
+            if name.isdigit() and os.path.isdir(path) and has_dumps(path):
+                folders.append((path, int(name)))
+        if per == 'site':
+            units.extend(Unit(day, (folder,)) for folder in folders)
+        elif folders:
+            units.append(Unit(day, tuple(folders)))
+    return units
+
+
+def schema_tag(storages: List[str], deltas: bool) -> str:
+    from config import ROLLUPS
+    from records import PanelReading
+
+    return '%s|%s|deltas=%s|rollups=%s' % (','.join(PanelReading.fields),
+                                           ','.join(sorted(storages)), deltas, ROLLUPS)
+
+
+def is_done(folder: str, tag: str) -> bool:
+    try:
+        with open(os.path.join(folder, MARKER_NAME)) as marker_obj:
+            return json.load(marker_obj).get('tag') == tag
+    except (OSError, ValueError):
+        return False
+
+
+class _NoArchive:
+    """The dumps are the input, so nothing is archived again"""
+
+    def append(self, *args):
+        pass
+
+    def close(self):
+        pass
+
+
+def _swap_directory(staging: str, target: str):
+    if os.path.exists(target):
+        shutil.rmtree(target)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    os.replace(staging, target)
+
+
+def _merge_database(staging: str, target: str, day: str, site_id: Optional[int]):
+    """Replace the readings ``site_id`` has on ``day`` in ``target`` with
+    those of ``staging``, in one transaction"""
+    import sqlite3
+    from storage import EPOCH, MICROSECOND, SQLITE_SCHEMA
+
+    start = datetime.strptime(day, '%Y-%m-%d')
+    first = (start - EPOCH) // MICROSECOND
+    last = first + 86400 * 10 ** 6
+    connection = sqlite3.connect(target, timeout=30, isolation_level=None)
+    try:
+        connection.executescript(SQLITE_SCHEMA)
+        connection.execute('ATTACH DATABASE ? AS staging', (staging,))
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            # readings dated outside the day are matched by their timestamp
+            connection.execute(
+                'DELETE FROM main.readings WHERE site IS ? AND ((ts >= ? AND ts < ?) '
+                'OR ts IN (SELECT ts FROM staging.readings))', (site_id, first, last))
+            connection.execute('INSERT OR IGNORE INTO main.panels (site, name) '
+                               'SELECT site, name FROM staging.panels')
+            connection.execute(
+                'INSERT INTO main.readings SELECT r.site, m.id, r.ts, r.energy, r.units, '
+                'r.unscaledEnergy, r.moduleEnergy, r.relayState FROM staging.readings r '
+                'JOIN staging.panels s ON s.id = r.panel '
+                'JOIN main.panels m ON m.site IS s.site AND m.name = s.name')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+        connection.execute('DETACH DATABASE staging')
+    finally:
+        connection.close()
+
+
+def _remove_database(path: str):
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def backfill_folder(day: str, folder: str, site_id: Optional[int],
+                    storages: List[str], tag: str) -> Dict:
+    """Reprocess one day/site folder; runs inside a pool process"""
+    import scrapper
+    from archive import iter_dumps
+    from config import PARQUET_PATH, ROLLUPS, SQLITE_PATH
+    from rollups import RollupEngine, RollupWriter
+    from storage import CsvStorage, ParquetStorage, SqliteStorage
+
+    class StagingCsvStorage(CsvStorage):
+        def __init__(self):
+            CsvStorage.__init__(self)
+            self.paths = set()
+
+        def get_write_path(self, timestamp, site_id):
+            path = CsvStorage.get_write_path(self, timestamp, site_id) + STAGING_SUFFIX
+            if path not in self.paths:
+                # leftovers of an interrupted run
+                if os.path.exists(path):
+                    os.remove(path)
+                self.paths.add(path)
+            return path
+
+    staging_root = os.path.join(PARQUET_PATH, STAGING_SUFFIX + '-%d' % os.getpid())
+    staging_database = SQLITE_PATH + STAGING_SUFFIX + '-%d' % os.getpid()
+    backends = []
+    for name in storages:
+        if name == 'csv':
+            backends.append(StagingCsvStorage())
+        elif name == 'parquet':
+            shutil.rmtree(staging_root, ignore_errors=True)
+            backends.append(ParquetStorage(root=staging_root))
+        elif name == 'sqlite':
+            _remove_database(staging_database)
+            backends.append(SqliteStorage(path=staging_database, fsync=False))
+        else:
+            raise ValueError("Unknown storage %s" % name)
+
+    rollup_writer = RollupWriter(suffix=STAGING_SUFFIX)
+    worker = scrapper.WorkerThread(
+        'DATA_PROCESSOR', storages=backends, archive=_NoArchive(),
+        rollups=RollupEngine(writer=rollup_writer) if ROLLUPS else None)
+    start = time.perf_counter()
+    messages = 0
+    for timestamp, response in iter_dumps(folder):
+        # anything else would overwrite another day's outputs
+        if str(timestamp.date()) != day:
+            continue
+        worker.process_message(scrapper.ScrapMessage(
+            datetime=timestamp, data=[response], site_id=site_id))
+        messages += 1
+    worker.close()
+
+    for path in rollup_writer.paths:
+        os.replace(path, path[:-len(STAGING_SUFFIX)])
+    for backend in backends:
+        if isinstance(backend, StagingCsvStorage):
+            for path in backend.paths:
+                os.replace(path, path[:-len(STAGING_SUFFIX)])
+        elif isinstance(backend, SqliteStorage):
+            _merge_database(staging_database, SQLITE_PATH, day, site_id)
+            _remove_database(staging_database)
+        elif os.path.isdir(staging_root):
+            for site_dir in os.listdir(staging_root):
+                for day_dir in os.listdir(os.path.join(staging_root, site_dir)):
+                    _swap_directory(os.path.join(staging_root, site_dir, day_dir),
+                                    os.path.join(PARQUET_PATH, site_dir, day_dir))
+            shutil.rmtree(staging_root, ignore_errors=True)
+
+    result = {'tag': tag, 'messages': messages,
+              'seconds': time.perf_counter() - start,
+              'finished': datetime.now().isoformat()}
+    with open(os.path.join(folder, MARKER_NAME), 'w') as marker_obj:
+        json.dump(result, marker_obj)
+    return result
+
+
+def backfill_unit(unit: Unit, storages: List[str], tag: str) -> Tuple[Unit, List[Dict]]:
+    return unit, [backfill_folder(unit.day, folder, site_id, storages, tag)
+                  for folder, site_id in unit.folders]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--since', help='first day to rebuild, YYYY-MM-DD')
+    parser.add_argument('--until', help='last day to rebuild, YYYY-MM-DD')
+    parser.add_argument('--per', choices=('day', 'site'), default='day',
+                        help='what one pool task covers')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count())
+    parser.add_argument('--storage', default='csv',
+                        help='comma separated storages to rebuild')
+    parser.add_argument('--include-today', action='store_true',
+                        help='also rebuild today, which the scraper may be writing')
+    parser.add_argument('--force', action='store_true',
+                        help='rebuild units that are already marked done')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    storages = [name.strip() for name in args.storage.split(',') if name.strip()]
+    from config import DEDUP_DELTAS, SCRAP_DATA
+
+    tag = schema_tag(storages, DEDUP_DELTAS)
+    units = discover_units(SCRAP_DATA, args.per, args.since, args.until,
+                           args.include_today)
+    if not args.force:
+        units = [unit for unit in units
+                 if not all(is_done(folder, tag) for folder, _ in unit.folders)]
+    print("%d units to rebuild with %d jobs" % (len(units), args.jobs))
+
+    start = time.perf_counter()
+    failed = 0
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        futures = {executor.submit(backfill_unit, unit, storages, tag): unit
+                   for unit in units}
+        for future in as_completed(futures):
+            unit = futures[future]
+            try:
+                _, results = future.result()
+                print("%s: %d folders, %d messages in %.1fs" % (
+                    unit.day, len(results), sum(r['messages'] for r in results),
+                    sum(r['seconds'] for r in results)))
+            except Exception as error:
+                failed += 1
+                print("%s: failed, %s" % (unit.day, error))
+    print("done in %.1fs, %d failed" % (time.perf_counter() - start, failed))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,226 @@
+"""Replays recorded or synthetic scrape responses through the processing
+pipeline, ScrapMessage -> WorkerThread.process_message -> storages, and
+reports throughput, per stage latency percentiles and peak memory.
+
+No browser is started, so it can run in CI:
+
+    python benchmark.py --synthetic 500 --panels 1000
+    python benchmark.py --replay data/scrap_data/2020-06-01 --storage csv,parquet
+
+Output goes to a temporary data folder unless SOLAREDGE_DATA is set.
+"""
+import argparse
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Iterator, List
+
+
+def percentile(samples: List[float], fraction: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+class StageTimer:
+    """Collects wall clock samples of wrapped callables by stage name"""
+
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = defaultdict(list)
+
+    def wrap(self, name: str, function: Callable) -> Callable:
+        samples = self.samples[name]
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                samples.append(time.perf_counter() - start)
+        return timed
+
+    def report(self) -> Dict[str, Dict[str, float]]:
+        return {
+            name: {
+                'count': len(samples),
+                'p50_ms': percentile(samples, 0.5) * 1000,
+                'p90_ms': percentile(samples, 0.9) * 1000,
+                'p99_ms': percentile(samples, 0.99) * 1000,
+                'max_ms': max(samples) * 1000 if samples else 0.0,
+            }
+            for name, samples in self.samples.items()
+        }
+
+
+def synthetic_payload(panels: int, step: int, change_ratio: float = 1.0) -> Dict:
+    changing = int(panels * change_ratio)
+    return {
+        str(200000000 + panel): {
+            'energy': 1250.0 + panel + (step if panel < changing else 0) * 0.25,
+            'units': 'Wh',
+            'unscaledEnergy': 1250.123 + panel + (step if panel < changing else 0) * 0.25,
+            'moduleEnergy': 1.25 + panel * 0.001,
+            'relayState': 'CLOSED',
+        }
+        for panel in range(panels)
+    }
+
+
+def synthetic_messages(scrap_message, count: int, panels: int, sites: int,
+                       change_ratio: float, raw: bool) -> Iterator:
+    start = datetime(2020, 6, 1, 12)
+    for index in range(count):
+        payload = synthetic_payload(panels, index // sites, change_ratio)
+        body = json.dumps(payload).encode('utf-8')
+        response = {'raw': body} if raw else {'res': json.loads(body)}
+        response['url'] = '/solaredge-apigw/api/sites/%d/layout/energy' % (index % sites)
+        yield scrap_message(datetime=start + timedelta(seconds=30 * index),
+                            data=[response], site_id=index % sites)
+
+
+def replay_messages(scrap_message, roots: List[str], raw: bool) -> Iterator:
+    """Messages from legacy ``dump/<timestamp>.json`` files and from
+    ``dump.jsonl.*`` archive segments found under ``roots``"""
+    from archive import has_dumps, iter_dumps
+
+    for root in roots:
+        for folder, _, _ in sorted(os.walk(root)):
+            if not has_dumps(folder):
+                continue
+            name = os.path.basename(folder)
+            site_id = int(name) if name.isdigit() else None
+            for timestamp, response in iter_dumps(folder, raw):
+                yield scrap_message(datetime=timestamp, data=[response],
+                                    site_id=site_id)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--replay', nargs='+', metavar='DIR',
+                        help='scrap_data folders to replay')
+    source.add_argument('--synthetic', type=int, metavar='MESSAGES',
+                        help='number of synthetic messages to generate')
+    parser.add_argument('--panels', type=int, default=1000)
+    parser.add_argument('--sites', type=int, default=1)
+    parser.add_argument('--change-ratio', type=float, default=1.0,
+                        help='share of panels whose values move between messages')
+    parser.add_argument('--parsed', action='store_true',
+                        help='hand over parsed payloads instead of raw text')
+    parser.add_argument('--storage', default='csv')
+    parser.add_argument('--columnar', action='store_true')
+    parser.add_argument('--deltas', action='store_true')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='run through a WorkerPool of this size instead of inline')
+    parser.add_argument('--tracemalloc', action='store_true',
+                        help='measure the python heap peak (slows the run down)')
+    parser.add_argument('--json', action='store_true', help='print the report as json')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    # the output paths are read at import time, so set them up before importing
+    os.environ.setdefault('SOLAREDGE_DATA', tempfile.mkdtemp(prefix='solaredge-bench-'))
+    import scrapper
+    from dedup import Deduplicator
+    from storage import create_storages
+
+    if args.synthetic:
+        messages = list(synthetic_messages(
+            scrapper.ScrapMessage, args.synthetic, args.panels, args.sites,
+            args.change_ratio, not args.parsed))
+    else:
+        messages = list(replay_messages(
+            scrapper.ScrapMessage, args.replay, not args.parsed))
+    if not messages:
+        print("Nothing to replay")
+        return 1
+
+    timer = StageTimer()
+    if args.workers:
+        pool = scrapper.WorkerPool('DATA_PROCESSOR', args.workers,
+                                   storages=create_storages(args.storage.split(',')),
+                                   deduplicator=Deduplicator(deltas=args.deltas))
+        workers = pool.workers
+        storages, archive, deduplicator = pool.storages, pool.archive, pool.deduplicator
+    else:
+        pool = None
+        workers = [scrapper.WorkerThread(
+            'DATA_PROCESSOR', storages=create_storages(args.storage.split(',')),
+            deduplicator=Deduplicator(deltas=args.deltas))]
+        storages, archive = workers[0].storages, workers[0].archive
+        deduplicator = workers[0].deduplicator
+    for storage in storages:
+        # only the entry point the worker calls, the other may delegate to it
+        name = 'storage.%s' % type(storage).__name__
+        if args.columnar:
+            storage.write_columns = timer.wrap(name, storage.write_columns)
+        else:
+            storage.write = timer.wrap(name, storage.write)
+    archive.append = timer.wrap('archive', archive.append)
+    deduplicator.is_repeat = timer.wrap('dedup', deduplicator.is_repeat)
+    for worker in workers:
+        worker.columnar = args.columnar
+        worker.process_message = timer.wrap('process_message', worker.process_message)
+
+    if args.tracemalloc:
+        tracemalloc.start()
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    if pool:
+        pool.start()
+        for message in messages:
+            pool.put_message(message)
+        for worker in workers:
+            worker.queue.join()
+        scrapper.EXIT_SIG = 1
+    else:
+        for message in messages:
+            workers[0].process_message(message)
+    elapsed = time.perf_counter() - start
+    timer.wrap('close', workers[0].close)()
+    total = time.perf_counter() - start
+
+    report = {
+        'messages': len(messages),
+        'panels_per_message': args.panels if args.synthetic else None,
+        'seconds': elapsed,
+        'messages_per_second': len(messages) / elapsed,
+        'seconds_with_close': total,
+        'stages': timer.report(),
+        'peak_rss_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'rss_before_kib': rss_before,
+        'output': os.environ['SOLAREDGE_DATA'],
+    }
+    if args.tracemalloc:
+        report['python_heap_peak_kib'] = tracemalloc.get_traced_memory()[1] / 1024
+        tracemalloc.stop()
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return 0
+    print("%d messages in %.3fs, %.1f messages/s (%.3fs including close)" % (
+        report['messages'], elapsed, report['messages_per_second'], total))
+    print("%-28s %8s %10s %10s %10s %10s" % ('stage', 'count', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms'))
+    for name, stats in sorted(report['stages'].items()):
+        print("%-28s %8d %10.3f %10.3f %10.3f %10.3f" % (
+            name, stats['count'], stats['p50_ms'], stats['p90_ms'],
+            stats['p99_ms'], stats['max_ms']))
+    print("peak rss %d KiB (%d KiB before processing)" % (
+        report['peak_rss_kib'], report['rss_before_kib']))
+    if args.tracemalloc:
+        print("python heap peak %.0f KiB" % report['python_heap_peak_kib'])
+    print("output written to %s" % report['output'])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,27 +1,190 @@
+import json
 import os
 from pathlib import Path
+from typing import List, NamedTuple, Optional
 
 ROOT = os.path.dirname(os.path.realpath(__file__))
 
-DATAPATH = os.path.join(ROOT, 'data')
-if not os.path.exists(DATAPATH):
-    os.mkdir(DATAPATH)
-
+DATAPATH = os.environ.get('SOLAREDGE_DATA', os.path.join(ROOT, 'data'))
 SCRAP_DATA = os.path.join(DATAPATH, 'scrap_data')
-if not os.path.exists(SCRAP_DATA):
-    os.mkdir(SCRAP_DATA)
-
 BROWSER_DATA = os.path.join(DATAPATH, 'browser_data')
-if not os.path.exists(BROWSER_DATA):
-    os.mkdir(BROWSER_DATA)
-
-LOG_PATH = os.path.join(ROOT, 'logs')
-if not os.path.exists(LOG_PATH):
-    os.mkdir(LOG_PATH)
-
+LOG_PATH = os.environ.get('SOLAREDGE_LOGS', os.path.join(ROOT, 'logs'))
 ASSETS_PATH = os.path.join(ROOT, 'assets')
-if not os.path.exists(ASSETS_PATH):
-    os.mkdir(ASSETS_PATH , 777)
-
 EXTENSION_PATH = os.path.join(ROOT, 'extension')
 LOG_FILE = os.path.join(LOG_PATH, 'browser.log')
+# resolved webdriver executables, see utils.cached_driver
+DRIVER_CACHE = os.path.join(ASSETS_PATH, 'drivers.json')
+
+
+def ensure_dirs():
+    """Create the data, log and assets folders; called on startup rather
+    than at import so importing the modules has no side effects"""
+    for path in (DATAPATH, SCRAP_DATA, BROWSER_DATA, LOG_PATH, ASSETS_PATH):
+        os.makedirs(path, exist_ok=True)
+
+
+# collection engine: 'browser' drives Chrome through the extension,
+# 'cdp' drives Chrome and reads responses from devtools network events,
+# 'http' talks to the api gateway directly
+SCRAP_ENGINE = os.environ.get('SOLAREDGE_ENGINE', 'browser')
+
+API_HOST = os.environ.get(
+    'SOLAREDGE_API_HOST', 'https://monitoringpublic.solaredge.com')
+PUBLIC_SITE_URL = API_HOST + '/solaredge-web/p/site/public?name={name}#/layout'
+LAYOUT_ENERGY_PATH = '/solaredge-apigw/api/sites/{site_id}/layout/energy'
+LAYOUT_ENERGY_PATTERN = r'/solaredge-apigw/api/sites/(\d+)/layout/energy$'
+LAYOUT_ENERGY_METHOD = 'POST'
+LAYOUT_ENERGY_PARAMS = {'timeUnit': 'ALL'}
+HTTP_POOL_SIZE = 10
+HTTP_TIMEOUT = 30
+# hand responses to python as unparsed text, decoded by records.decode_payload
+RAW_PAYLOADS = os.environ.get('SOLAREDGE_RAW_PAYLOADS', '0') == '1'
+# decode whole responses into numpy column arrays (records.decode_columns)
+COLUMNAR_TRANSFORM = os.environ.get('SOLAREDGE_COLUMNAR', '0') == '1'
+# upper bound on waiting for the layout/energy response after a click
+SCRAP_TIMEOUT = 30
+# tabs are probed every HEALTH_CHECK_INTERVAL seconds and refreshed when the
+# extension is gone, no response arrived for RESPONSE_STALE_AFTER seconds
+# despite scrapes, or the js heap passed TAB_HEAP_LIMIT
+HEALTH_CHECK_INTERVAL = 60
+RESPONSE_STALE_AFTER = 15*60
+TAB_HEAP_LIMIT = int(os.environ.get('SOLAREDGE_TAB_HEAP_MB', 512))*1024*1024
+# a browser whose process tree passes BROWSER_RSS_LIMIT bytes or that runs
+# for longer than BROWSER_MAX_AGE seconds (0 for no limit) is recycled
+WATCHDOG_INTERVAL = 60
+BROWSER_RSS_LIMIT = int(os.environ.get('SOLAREDGE_BROWSER_RSS_MB', 2048))*1024*1024
+BROWSER_MAX_AGE = int(os.environ.get('SOLAREDGE_BROWSER_MAX_AGE', 24*60*60))
+
+# site registry: a json list of {"site_id": ..., "name": ..., "interval": ...,
+# "latitude": ..., "longitude": ...}, coordinates being optional
+SITES_FILE = os.environ.get('SOLAREDGE_SITES', os.path.join(ROOT, 'sites.json'))
+DEFAULT_POLL_INTERVAL = 60
+MAX_CONCURRENT_SCRAPS = int(os.environ.get('SOLAREDGE_CONCURRENCY', 8))
+
+
+class Site(NamedTuple):
+    site_id: int
+    name: str
+    interval: int = DEFAULT_POLL_INTERVAL
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
+
+    @property
+    def url(self) -> str:
+        return PUBLIC_SITE_URL.format(name=self.name)
+
+
+DEFAULT_SITES = [Site(site_id=1047995, name='myerssolargrumbles')]
+
+
+def load_sites(path: str = SITES_FILE) -> List[Site]:
+    """Read the site registry, falling back to the default site"""
+    if not os.path.exists(path):
+        return list(DEFAULT_SITES)
+    with open(path) as sites_obj:
+        entries = json.load(sites_obj)
+    return [
+        Site(site_id=int(entry['site_id']), name=entry['name'],
+             interval=int(entry.get('interval', DEFAULT_POLL_INTERVAL)),
+             latitude=entry.get('latitude'), longitude=entry.get('longitude'))
+        for entry in entries
+    ]
+
+# browser pool: BROWSER_POOL_SIZE browsers with TABS_PER_BROWSER tabs each
+BROWSER_KIND = os.environ.get('SOLAREDGE_BROWSER', 'chrome')
+BROWSER_POOL_SIZE = int(os.environ.get('SOLAREDGE_BROWSERS', 1))
+TABS_PER_BROWSER = int(os.environ.get('SOLAREDGE_TABS', 4))
+# lean loading: skip images, fonts, media, analytics and map tiles; the
+# patterns are handed to Network.setBlockedURLs in every Chrome tab
+LEAN_LOAD = os.environ.get('SOLAREDGE_LEAN', '0') == '1'
+LEAN_BLOCKED_URLS = [
+    '*.png', '*.jpg', '*.jpeg', '*.gif', '*.svg', '*.ico', '*.webp', '*.bmp',
+    '*.woff', '*.woff2', '*.ttf', '*.otf', '*.eot',
+    '*.mp4', '*.webm', '*.mp3', '*.ogg', '*.wav',
+    '*google-analytics.com*', '*googletagmanager.com*', '*doubleclick.net*',
+    '*hotjar.com*', '*nr-data.net*', '*newrelic.com*', '*facebook.net*',
+    '*maps.googleapis.com/maps/vt*', '*maps.gstatic.com*', '*khms*.google.com*',
+    '*tile.openstreetmap.org*', '*virtualearth.net*',
+]
+
+# storage backends fed by the DATA_PROCESSOR worker, comma separated
+STORAGE_BACKENDS = os.environ.get('SOLAREDGE_STORAGE', 'csv').split(',')
+CSV_FLUSH_ROWS = 10000
+CSV_FLUSH_BYTES = 1024*1024
+CSV_FLUSH_INTERVAL = 60
+CSV_FSYNC = os.environ.get('SOLAREDGE_FSYNC', '0') == '1'
+# how often idle workers check the flush intervals of the storages
+FLUSH_CHECK_INTERVAL = 1
+# raw responses are archived per site and day, 'gzip' or 'zstd'
+ARCHIVE_COMPRESSION = os.environ.get('SOLAREDGE_ARCHIVE_COMPRESSION', 'gzip')
+PARQUET_PATH = os.path.join(DATAPATH, 'parquet')
+PARQUET_ROW_GROUP_SIZE = 100000
+PARQUET_FLUSH_INTERVAL = 15*60
+PARQUET_COMPRESSION = 'zstd'
+# one WAL mode database of all readings, indexed on (site, panel, ts) for
+# point in time and per panel range queries
+SQLITE_PATH = os.environ.get('SOLAREDGE_SQLITE', os.path.join(DATAPATH, 'readings.db'))
+SQLITE_CHECKPOINT_PAGES = 10000
+
+# skip responses identical to the previous one of the same site
+DEDUP_REPEATS = os.environ.get('SOLAREDGE_DEDUP', '1') == '1'
+# only store panels whose energy, moduleEnergy or relayState changed ...
+DEDUP_DELTAS = os.environ.get('SOLAREDGE_DELTAS', '0') == '1'
+# ... plus a full snapshot every DEDUP_SNAPSHOT_INTERVAL minutes, 0 for never
+DEDUP_SNAPSHOT_INTERVAL = int(os.environ.get('SOLAREDGE_SNAPSHOT_INTERVAL', 60))
+
+# per panel and per site rollups of ROLLUP_FIELD, written next to
+# processed.csv as rollup-<resolution>.csv
+ROLLUPS = os.environ.get('SOLAREDGE_ROLLUPS', '1') == '1'
+ROLLUP_RESOLUTIONS = (('5min', 5*60), ('hour', 60*60), ('day', 24*60*60))
+ROLLUP_FIELD = 'unscaledEnergy'
+
+# worker threads per role and the bounded queue in front of each of them;
+# when a queue is full 'block' stalls the producer, 'drop_oldest' discards
+WORKER_POOL_SIZES = {
+    'DATA_PROCESSOR': int(os.environ.get('SOLAREDGE_WORKERS', 2)),
+}
+QUEUE_MAXSIZE = int(os.environ.get('SOLAREDGE_QUEUE_SIZE', 1000))
+QUEUE_POLICY = os.environ.get('SOLAREDGE_QUEUE_POLICY', 'block')
+
+# run scraper, processors and storages as coroutines (see pipeline.py)
+# instead of threads; decoding and file i/o use ASYNC_IO_WORKERS threads
+ASYNC_PIPELINE = os.environ.get('SOLAREDGE_ASYNC', '0') == '1'
+ASYNC_IO_WORKERS = int(os.environ.get('SOLAREDGE_IO_WORKERS', 4))
+# how long a shutdown waits for in flight scrapes and queued messages
+SHUTDOWN_TIMEOUT = 30
+
+# sharded deployment (see coordinator.py): SHARD_WORKERS processes per host
+# lease their share of the sites from the SQLite table LEASE_DB, renewing
+# every LEASE_HEARTBEAT seconds; the sites of a worker silent for LEASE_TTL
+# seconds go to the others. Each worker keeps its data, browser profile and
+# logs under PARTITIONS_PATH/<worker id> and serves metrics and state on the
+# base ports plus SHARD_PORT_STEP times its number
+SHARD_WORKER_ID = os.environ.get('SOLAREDGE_WORKER_ID')
+SHARD_WORKERS = int(os.environ.get('SOLAREDGE_SHARDS', 2))
+LEASE_DB = os.environ.get('SOLAREDGE_LEASES', os.path.join(DATAPATH, 'leases.db'))
+LEASE_TTL = int(os.environ.get('SOLAREDGE_LEASE_TTL', 45))
+LEASE_HEARTBEAT = max(1, LEASE_TTL // 4)
+PARTITIONS_PATH = os.path.join(DATAPATH, 'partitions')
+SHARD_PORT_STEP = 10
+SHARD_RESTART_DELAY = 5
+
+# adaptive polling: learn how often a site's values change, poll right
+# after the expected update and back off at night
+ADAPTIVE_SCHEDULING = os.environ.get('SOLAREDGE_ADAPTIVE', '1') == '1'
+ADAPTIVE_MIN_INTERVAL = 30
+ADAPTIVE_MAX_INTERVAL = 30*60
+ADAPTIVE_LAG = 15
+NIGHT_MARGIN = 30*60
+NIGHT_MAX_INTERVAL = 60*60
+
+# prometheus text metrics on http://METRICS_HOST:METRICS_PORT/metrics,
+# 0 disables the endpoint
+METRICS_HOST = os.environ.get('SOLAREDGE_METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('SOLAREDGE_METRICS_PORT', 9108))
+
+# latest readings and the last STATE_HISTORY messages of every site as json
+# on http://STATE_API_HOST:STATE_API_PORT/sites, 0 disables the endpoint
+STATE_API_HOST = os.environ.get('SOLAREDGE_STATE_HOST', '127.0.0.1')
+STATE_API_PORT = int(os.environ.get('SOLAREDGE_STATE_PORT', 9109))
+STATE_HISTORY = int(os.environ.get('SOLAREDGE_HISTORY', 12))
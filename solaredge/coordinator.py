@@ -0,0 +1,148 @@
+"""Run the scraper as SHARD_WORKERS processes sharing the sites.
+
+    python coordinator.py [--workers N]
+
+Every worker is a ``scrapper.py`` process with its own browsers and GIL
+that leases its share of the sites from the LeaseTable at LEASE_DB (see
+leases.py) and heartbeats it. A worker that exits is restarted and its
+sites are freed at once; one that hangs or whose host goes away loses them
+after LEASE_TTL seconds. To spread over several hosts, run a coordinator on
+each one with SOLAREDGE_LEASES pointing to the same file on a filesystem
+with working locks.
+
+Each worker writes below PARTITIONS_PATH/<host>-<number>, its own data
+folder, browser profile and logs, so no file is ever written by two
+processes. A site moving between workers continues in the partition of its
+new worker; backfill.py runs per partition with SOLAREDGE_DATA set to it.
+"""
+import argparse
+import logging
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional
+
+from config import (LEASE_DB, LEASE_TTL, METRICS_PORT, PARTITIONS_PATH, ROOT,
+                    SHARD_PORT_STEP, SHARD_RESTART_DELAY, SHARD_WORKERS,
+                    SHUTDOWN_TIMEOUT, STATE_API_PORT, ensure_dirs)
+from leases import LeaseTable
+from utils import create_logger
+
+logger = logging.getLogger('solaredge')
+
+SCRAPPER = os.path.join(ROOT, 'scrapper.py')
+
+
+class ShardWorker:
+    """One scraper process of the coordinator, restarted when it exits"""
+
+    def __init__(self, worker_id: str, number: int):
+        self.worker_id = worker_id
+        self.number = number
+        self.partition = os.path.join(PARTITIONS_PATH, worker_id)
+        self.process: Optional[subprocess.Popen] = None
+        self.exited_at: Optional[float] = None
+        self.restarts = 0
+
+    def environ(self) -> Dict[str, str]:
+        offset = SHARD_PORT_STEP * self.number
+        env = dict(os.environ)
+        env.update({
+            'SOLAREDGE_WORKER_ID': self.worker_id,
+            'SOLAREDGE_LEASES': os.path.abspath(LEASE_DB),
+            'SOLAREDGE_DATA': self.partition,
+            'SOLAREDGE_LOGS': os.path.join(self.partition, 'logs'),
+            'SOLAREDGE_METRICS_PORT': str(METRICS_PORT + offset if METRICS_PORT else 0),
+            'SOLAREDGE_STATE_PORT': str(STATE_API_PORT + offset if STATE_API_PORT else 0),
+        })
+        return env
+
+    def start(self):
+        # own session: a ctrl-c reaches the coordinator only, which then
+        # stops the workers once
+        self.process = subprocess.Popen([sys.executable, SCRAPPER], cwd=ROOT,
+                                        env=self.environ(), start_new_session=True)
+        self.exited_at = None
+        logger.info("Started worker %s, pid %s" % (self.worker_id, self.process.pid))
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+
+class Coordinator:
+    def __init__(self, workers: int = SHARD_WORKERS, table: LeaseTable = None,
+                 host: str = None):
+        host = host or socket.gethostname()
+        self.table = table or LeaseTable()
+        self.workers = [ShardWorker('%s-%d' % (host, number), number)
+                        for number in range(1, workers + 1)]
+        self.stopping = False
+
+    def stop(self, signalNumber=None, frame=None):
+        self.stopping = True
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for worker in self.workers:
+            self.table.register(worker.worker_id)
+        for worker in self.workers:
+            worker.start()
+        assignments = None
+        while not self.stopping:
+            time.sleep(1)
+            for worker in self.workers:
+                self.supervise(worker)
+            current = self.table.assignments()
+            if current != assignments:
+                logger.info("Sites per worker: %s" % current)
+                assignments = current
+        self.shutdown()
+
+    def supervise(self, worker: ShardWorker):
+        if worker.alive:
+            return
+        if worker.exited_at is None:
+            worker.exited_at = time.monotonic()
+            logger.error("Worker %s exited with code %s, freeing its sites" %
+                         (worker.worker_id, worker.process.returncode))
+            self.table.release(worker.worker_id)
+        delay = min(SHARD_RESTART_DELAY * 2 ** min(worker.restarts, 6), LEASE_TTL)
+        if time.monotonic() - worker.exited_at >= delay:
+            worker.restarts += 1
+            worker.start()
+
+    def shutdown(self):
+        logger.info("Stopping %d workers" % len(self.workers))
+        running: List[ShardWorker] = [worker for worker in self.workers if worker.alive]
+        for worker in running:
+            worker.process.terminate()
+        deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+        for worker in running:
+            try:
+                worker.process.wait(max(0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                logger.warning("Killing worker %s" % worker.worker_id)
+                worker.process.kill()
+                worker.process.wait()
+        for worker in self.workers:
+            self.table.release(worker.worker_id)
+        self.table.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=SHARD_WORKERS,
+                        help='scraper processes to run on this host')
+    args = parser.parse_args()
+    ensure_dirs()
+    create_logger('solaredge')
+    Coordinator(args.workers).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+import hashlib
+import json
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from config import DEDUP_DELTAS, DEDUP_REPEATS, DEDUP_SNAPSHOT_INTERVAL
+from records import PanelReading, orjson
+
+
+def response_digest(scrap_response: Dict) -> bytes:
+    """Hash of a captured response body, raw or parsed"""
+    if 'raw' in scrap_response:
+        body = scrap_response['raw']
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+    elif orjson is not None:
+        body = orjson.dumps(scrap_response.get('res'),
+                            option=orjson.OPT_SORT_KEYS)
+    else:
+        body = json.dumps(scrap_response.get('res'),
+                          sort_keys=True).encode('utf-8')
+    return hashlib.blake2b(body, digest_size=16).digest()
+
+
+class Deduplicator:
+    """Drops repeated responses and, optionally, unchanged panel values.
+
+    The scrape loop reads the capture buffer twice per cycle and the
+    energy values change slowly, so most of what reaches the worker is a
+    repeat of what was already stored.
+    """
+
+    def __init__(self, repeats: bool = DEDUP_REPEATS, deltas: bool = DEDUP_DELTAS,
+                 snapshot_interval: int = DEDUP_SNAPSHOT_INTERVAL):
+        self.repeats = repeats
+        self.deltas = deltas
+        self.snapshot_interval = timedelta(minutes=snapshot_interval)
+        self._digests: Dict[Optional[int], bytes] = {}
+        self._values: Dict[Tuple[Optional[int], str], Tuple] = {}
+        self._snapshots: Dict[Optional[int], datetime] = {}
+        self._lock = threading.Lock()
+
+    def is_repeat(self, site_id: Optional[int], scrap_response: Dict) -> bool:
+        """True when the response is identical to the previous one seen
+        for the site"""
+        if not self.repeats:
+            return False
+        digest = response_digest(scrap_response)
+        with self._lock:
+            if self._digests.get(site_id) == digest:
+                return True
+            self._digests[site_id] = digest
+            return False
+
+    def changed(self, readings: List[PanelReading], site_id: Optional[int],
+                timestamp: datetime) -> List[PanelReading]:
+        """Readings whose stored values moved since the last call, or all of
+        them when a snapshot is due"""
+        if not self.deltas:
+            return readings
+        with self._lock:
+            last_snapshot = self._snapshots.get(site_id)
+            snapshot = last_snapshot is None or (
+                self.snapshot_interval and timestamp - last_snapshot >= self.snapshot_interval)
+            if snapshot:
+                self._snapshots[site_id] = timestamp
+            values = self._values
+            changed = []
+            for reading in readings:
+                key = (site_id, reading.panel)
+                current = (reading.energy, reading.moduleEnergy,
+                           reading.relayState)
+                if snapshot or values.get(key) != current:
+                    changed.append(reading)
+                values[key] = current
+            return changed
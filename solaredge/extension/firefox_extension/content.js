@@ -66,10 +66,10 @@ function __parseQuery(queryString) {
 }
 function __intercept_url__call(url) {
     var HOSTS = ['monitoringpublic.solaredge.com'],
-        PATHS = ['/solaredge-apigw/api/sites/1047995/layout/energy'],
+        PATHS = [new RegExp('^/solaredge-apigw/api/sites/[0-9]+/layout/energy$')],
         _url = new URL(window.origin + url);
     if (HOSTS.includes(_url.host)) {
-        if (PATHS.includes(_url.pathname)) {
+        if (PATHS.some(path => path.test(_url.pathname))) {
             return true
         }
         return false
@@ -78,16 +78,23 @@ function __intercept_url__call(url) {
 }
 function __process_scrap_response(data) { 
     window.scrap_response.push(data) 
+    window.scrap_response_count += 1
 }
 function __scrap_data() {
     window.scrap_response = []
     element=document.getElementById('ext-comp-1034-button')
     if(element){element.click()}
+    return window.scrap_response_count
 }
 function __get_data() {
     return { data: window.scrap_response }
 }
+function __get_count() {
+    return window.scrap_response_count
+}
 if (typeof window.scrap_response === 'undefined') window.scrap_response = [];
+if (typeof window.scrap_response_count === 'undefined') window.scrap_response_count = 0;
+if (typeof window.scrap_raw === 'undefined') window.scrap_raw = false;
 if (typeof window.process_scrap_response === 'undefined') window.process_scrap_response = __process_scrap_response;
 
 (function (XHR) {
@@ -103,24 +110,22 @@ if (typeof window.process_scrap_response === 'undefined') window.process_scrap_r
             url = this._url;
         async function onReadyStateChange() {
             if (self.readyState == XHR.DONE) {
-                var data;
+                var text;
                 if ('object' == typeof self.response) {
-                    const text = await self.response.text();
-                    data = {
-                        res: JSON.parse(text),
-                        url: url,
-                    };
+                    text = await self.response.text();
                 } else if (self.responseText) {
-                    data = {
-                        res: JSON.parse(self.responseText),
-                        url: url,
-                    };
+                    text = self.responseText;
                 } else {
-                    data = {
-                        res: JSON.parse(self.response),
-                        url: url,
-                    };
+                    text = self.response;
                 }
+                // with scrap_raw set the text is handed to python unparsed
+                var data = window.scrap_raw ? {
+                    raw: text,
+                    url: url,
+                } : {
+                    res: JSON.parse(text),
+                    url: url,
+                };
                 __process_scrap_response(data);
                 if (oldOnReadyStateChange) {
                     oldOnReadyStateChange();
@@ -145,7 +150,7 @@ function injectJs() {
     script.innerHTML = customScript;
     script.type = 'text/javascript';
     script.id = '_ENGINE_';
-    script.setAttribute('data-version', '1.0.1')
+    script.setAttribute('data-version', '1.0.3')
     script.setAttribute('data-ts' , new Date())
     document.head.insertBefore(script, document.head.children[0]);
 }
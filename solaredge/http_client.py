@@ -0,0 +1,67 @@
+import logging
+from typing import Dict, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import (API_HOST, HTTP_POOL_SIZE, HTTP_TIMEOUT,
+                    LAYOUT_ENERGY_METHOD, LAYOUT_ENERGY_PARAMS,
+                    LAYOUT_ENERGY_PATH, RAW_PAYLOADS)
+
+logger = logging.getLogger('solaredge')
+
+
+class LayoutEnergyClient:
+    """Fetches the layout/energy endpoint over a pooled keep-alive session.
+
+    Responses come back in the same ``{'res': ..., 'url': ...}`` shape the
+    extension pushes into ``__get_data()``, so they can be wrapped in a
+    ``ScrapMessage`` unchanged. With ``raw`` the body is returned unparsed
+    as ``{'raw': ..., 'url': ...}``.
+    """
+
+    def __init__(self, base_url: str = API_HOST, pool_size: int = HTTP_POOL_SIZE,
+                 timeout: int = HTTP_TIMEOUT, method: str = LAYOUT_ENERGY_METHOD,
+                 params: Optional[Dict] = None, raw: bool = RAW_PAYLOADS):
+        self.raw = raw
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.method = method
+        self.params = LAYOUT_ENERGY_PARAMS if params is None else params
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({
+            'Accept': 'application/json, text/plain, */*',
+            'X-Requested-With': 'XMLHttpRequest',
+        })
+
+    def warm_up(self, page_url: str) -> bool:
+        """Load the public page once so the session picks up its cookies"""
+        try:
+            response = self.session.get(page_url, timeout=self.timeout)
+            response.raise_for_status()
+            self.session.headers['Referer'] = page_url
+            return True
+        except requests.RequestException as error:
+            logger.error("Unable to warm up session, error:%s" % error)
+            return False
+
+    def fetch(self, site_id) -> Optional[Dict]:
+        path = LAYOUT_ENERGY_PATH.format(site_id=site_id)
+        try:
+            response = self.session.request(
+                self.method, self.base_url + path,
+                params=self.params, timeout=self.timeout)
+            response.raise_for_status()
+            if self.raw:
+                return {'raw': response.content, 'url': path}
+            return {'res': response.json(), 'url': path}
+        except (requests.RequestException, ValueError) as error:
+            logger.error("Unable to fetch %s, error:%s" % (path, error))
+            return None
+
+    def close(self):
+        self.session.close()
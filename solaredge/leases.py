@@ -0,0 +1,122 @@
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, Set
+
+from config import LEASE_DB, LEASE_TTL
+
+logger = logging.getLogger('solaredge')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS workers (
+    worker_id TEXT PRIMARY KEY,
+    heartbeat REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS leases (
+    site_id INTEGER PRIMARY KEY,
+    worker_id TEXT NOT NULL,
+    acquired REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS leases_worker ON leases (worker_id);
+"""
+
+
+class LeaseTable:
+    """Site leases shared by the worker processes of a sharded deployment.
+
+    A worker owns the sites leased to it for as long as it heartbeats;
+    one silent for ``ttl`` seconds is dropped together with its leases.
+    Every renewal also balances the load: a worker takes free sites up to
+    its fair share, the site count over the live workers rounded up, and
+    hands back what it holds above it. Each renewal is one immediate
+    transaction, so concurrent workers never lease the same site. The
+    database may be shared by several hosts as long as its filesystem
+    supports locking, hence the rollback journal rather than WAL.
+    """
+
+    def __init__(self, path: str = LEASE_DB, ttl: float = LEASE_TTL):
+        self.path = path
+        self.ttl = ttl
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self._connection = sqlite3.connect(path, timeout=30, isolation_level=None,
+                                           check_same_thread=False)
+        self._lock = threading.Lock()
+        self._connection.executescript(SCHEMA)
+
+    def _transaction(self, work):
+        with self._lock:
+            cursor = self._connection.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                result = work(cursor)
+            except BaseException:
+                cursor.execute('ROLLBACK')
+                raise
+            cursor.execute('COMMIT')
+            return result
+
+    def register(self, worker_id: str):
+        """Count ``worker_id`` as live before its first renewal, so the
+        workers started together do not all take every site at first"""
+        self._transaction(lambda cursor: cursor.execute(
+            'INSERT OR REPLACE INTO workers VALUES (?, ?)', (worker_id, time.time())))
+
+    def renew(self, worker_id: str, site_ids: Iterable[int]) -> Set[int]:
+        """Heartbeat, rebalance and return the sites now leased to
+        ``worker_id``"""
+        site_ids = set(site_ids)
+
+        def work(cursor) -> Set[int]:
+            now = time.time()
+            cursor.execute('INSERT OR REPLACE INTO workers VALUES (?, ?)', (worker_id, now))
+            cursor.execute('DELETE FROM workers WHERE heartbeat < ?', (now - self.ttl,))
+            cursor.execute('DELETE FROM leases WHERE worker_id NOT IN '
+                           '(SELECT worker_id FROM workers)')
+            live = cursor.execute('SELECT COUNT(*) FROM workers').fetchone()[0]
+            share = math.ceil(len(site_ids) / live)
+            owned = {site_id for site_id, in cursor.execute(
+                'SELECT site_id FROM leases WHERE worker_id = ?', (worker_id,))}
+            # leases of sites removed from the registry
+            stale = owned - site_ids
+            owned -= stale
+            excess = sorted(owned)[share:]
+            if stale or excess:
+                cursor.executemany('DELETE FROM leases WHERE site_id = ?',
+                                   [(site_id,) for site_id in stale | set(excess)])
+                owned.difference_update(excess)
+            if len(owned) < share:
+                leased = {site_id for site_id, in cursor.execute('SELECT site_id FROM leases')}
+                free = sorted(site_ids - leased)[:share - len(owned)]
+                cursor.executemany('INSERT INTO leases VALUES (?, ?, ?)',
+                                   [(site_id, worker_id, now) for site_id in free])
+                owned.update(free)
+            return owned
+
+        return self._transaction(work)
+
+    def release(self, worker_id: str):
+        """Drop ``worker_id`` and free its sites right away"""
+        def work(cursor):
+            cursor.execute('DELETE FROM leases WHERE worker_id = ?', (worker_id,))
+            cursor.execute('DELETE FROM workers WHERE worker_id = ?', (worker_id,))
+
+        self._transaction(work)
+
+    def assignments(self) -> Dict[str, int]:
+        """Number of sites leased to every live worker"""
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT workers.worker_id, COUNT(leases.site_id) FROM workers '
+                'LEFT JOIN leases ON leases.worker_id = workers.worker_id '
+                'GROUP BY workers.worker_id').fetchall()
+        return dict(rows)
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
@@ -1,22 +1,30 @@
-from typing import Optional
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, List, Optional, Sequence
 
 from selenium import webdriver
-from selenium.common.exceptions import WebDriverException
+from selenium.common.exceptions import NoSuchWindowException, WebDriverException
 from selenium.webdriver import Remote
 from selenium.webdriver.common.keys import Keys
 from selenium.webdriver.firefox.options import Options as Firefox_Options
 
-from config import BROWSER_DATA, DATAPATH
+from config import (BROWSER_DATA, BROWSER_KIND, BROWSER_POOL_SIZE, DATAPATH,
+                    LEAN_BLOCKED_URLS, LEAN_LOAD, LOG_FILE, SCRAP_ENGINE,
+                    TABS_PER_BROWSER)
+from metrics import PAGE_LOAD_SECONDS
 from utils import (create_firefox_extension, get_chrome_driver,
                    get_geckodriver, sleep)
 
 
-def create_proxied_browser_instance(proxy=None, use_proxy=False, headless=False, use_data_dir=False) -> webdriver.Chrome:
+def create_proxied_browser_instance(proxy=None, use_proxy=False, headless=False, use_data_dir=False,
+                                    capture_network=False, lean=False) -> webdriver.Chrome:
     chrome_options = webdriver.ChromeOptions()
-    capabilities = webdriver.DesiredCapabilities.CHROME
+    capabilities = webdriver.DesiredCapabilities.CHROME.copy()
     prefs = {'disk-cache-size': 4096}
     if headless:
         chrome_options.headless = True
+    if headless or lean:
         prefs["profile.managed_default_content_settings.images"] = 2
     chrome_options.add_experimental_option('prefs', prefs)
     chrome_options.add_argument("--start-maximized")
@@ -25,11 +33,19 @@ def create_proxied_browser_instance(proxy=None, use_proxy=False, headless=False,
     if use_data_dir:
         chrome_options.add_argument('user-data-dir={D}'.format(D=BROWSER_DATA))
 
-    try:
-        extension = create_firefox_extension()
-    except Exception as a:
-        print(str(a))
+    if capture_network:
+        # responses are read from the devtools network events, see
+        # network_capture.NetworkCapture, so the extension is not needed
+        capabilities['goog:loggingPrefs'] = {'performance': 'ALL'}
+        chrome_options.add_experimental_option(
+            'perfLoggingPrefs', {'enableNetwork': True, 'enablePage': False})
         extension = None
+    else:
+        try:
+            extension = create_firefox_extension()
+        except Exception as a:
+            print(str(a))
+            extension = None
     if extension:
         chrome_options.add_extension(extension)
 
@@ -185,3 +201,303 @@ def retry(max_retry_count=3, start_page=None):
         return wrapper
 
     return real_decorator
+
+
+class BrowserSlot:
+    """One browser process shared by several tabs.
+
+    WebDriver only talks to the focused window, so every command sent
+    through a tab holds ``lock`` while it switches to its window.
+    """
+
+    def __init__(self, factory: Callable[[], Remote], blocked_urls: Sequence[str] = ()):
+        self.factory = factory
+        self.blocked_urls = list(blocked_urls)
+        self.lock = threading.RLock()
+        self.browser: Optional[Remote] = None
+        self.generation = 0
+        self.started_at: Optional[float] = None
+        self.tabs: List['BrowserTab'] = []
+        self._free_handles: List[str] = []
+
+    def start(self):
+        with self.lock:
+            self.browser = self.factory()
+            self.started_at = time.monotonic()
+            self.generation += 1
+            self._free_handles = list(self.browser.window_handles)
+
+    def restart(self):
+        with self.lock:
+            self.quit()
+            self.start()
+            # the new browser shows no site yet
+            for tab in self.tabs:
+                tab.site_id = None
+
+    def quit(self):
+        with self.lock:
+            if self.browser:
+                try:
+                    self.browser.quit()
+                except WebDriverException as e:
+                    print(e)
+            self.browser = None
+
+    @property
+    def age(self) -> float:
+        """Seconds since the browser was started"""
+        return time.monotonic() - self.started_at if self.started_at else 0
+
+    @property
+    def pid(self) -> Optional[int]:
+        """Pid of the driver process, the browser runs as its child"""
+        service = getattr(self.browser, 'service', None)
+        return getattr(getattr(service, 'process', None), 'pid', None)
+
+    def is_alive(self) -> bool:
+        try:
+            return bool(self.browser and self.browser.window_handles)
+        except WebDriverException:
+            return False
+
+    def prepare_window(self):
+        """Apply the per tab devtools settings to the focused window"""
+        if not self.blocked_urls or not hasattr(self.browser, 'execute_cdp_cmd'):
+            return
+        try:
+            self.browser.execute_cdp_cmd('Network.enable', {})
+            self.browser.execute_cdp_cmd(
+                'Network.setBlockedURLs', {'urls': self.blocked_urls})
+        except WebDriverException as e:
+            print(e)
+
+    def claim_handle(self) -> str:
+        """Hand out an unused window, opening a new tab when none is left"""
+        with self.lock:
+            if self._free_handles:
+                return self._free_handles.pop(0)
+            known = set(self.browser.window_handles)
+            self.browser.execute_script('window.open("about:blank", "_blank")')
+            return [h for h in self.browser.window_handles if h not in known][0]
+
+    def replace_handle(self, handle: Optional[str]) -> Optional[str]:
+        """Open a window to replace ``handle``, which stopped responding,
+        then close it. The new window is opened from another one, so None
+        is returned when ``handle`` is the browser's only window or the
+        opening fails; the browser then needs a restart."""
+        with self.lock:
+            try:
+                free = [h for h in self._free_handles if h != handle]
+                if free:
+                    replacement = free[0]
+                    self._free_handles.remove(replacement)
+                else:
+                    known = self.browser.window_handles
+                    others = [h for h in known if h != handle]
+                    if not others:
+                        return None
+                    self.browser.switch_to.window(others[0])
+                    self.browser.execute_script('window.open("about:blank", "_blank")')
+                    replacement = [h for h in self.browser.window_handles if h not in known][0]
+            except (WebDriverException, IndexError) as e:
+                print(e)
+                return None
+            if handle is not None:
+                try:
+                    self.browser.switch_to.window(handle)
+                    self.browser.close()
+                except NoSuchWindowException:
+                    pass
+                except WebDriverException as e:
+                    print(e)
+            return replacement
+
+
+class BrowserTab:
+    """A leased window; proxies the few driver calls the scraper needs"""
+
+    def __init__(self, slot: BrowserSlot):
+        self.slot = slot
+        self.handle: Optional[str] = None
+        self.generation = 0
+        self.site_id = None
+        slot.tabs.append(self)
+
+    @property
+    def browser(self) -> Remote:
+        return self.slot.browser
+
+    def _focus(self):
+        if self.generation != self.slot.generation:
+            self.adopt(self.slot.claim_handle())
+            return
+        self.slot.browser.switch_to.window(self.handle)
+
+    def adopt(self, handle: str):
+        """Make ``handle``, a blank window, this tab's window"""
+        with self.slot.lock:
+            self.handle = handle
+            self.generation = self.slot.generation
+            self.site_id = None
+            self.slot.browser.switch_to.window(handle)
+            # blocked urls are a setting of the tab, not of the browser
+            self.slot.prepare_window()
+
+    def execute_script(self, script, *args):
+        with self.slot.lock:
+            self._focus()
+            return self.slot.browser.execute_script(script, *args)
+
+    def execute_async_script(self, script, *args):
+        with self.slot.lock:
+            self._focus()
+            return self.slot.browser.execute_async_script(script, *args)
+
+    def get(self, url: str):
+        with self.slot.lock:
+            self._focus()
+            with PAGE_LOAD_SECONDS.time():
+                self.slot.browser.get(url)
+
+    def refresh(self):
+        with self.slot.lock:
+            self._focus()
+            self.slot.browser.refresh()
+
+    @property
+    def current_url(self) -> str:
+        with self.slot.lock:
+            self._focus()
+            return self.slot.browser.current_url
+
+    @property
+    def title(self) -> str:
+        with self.slot.lock:
+            self._focus()
+            return self.slot.browser.title
+
+    def is_healthy(self) -> bool:
+        try:
+            self.execute_script('return document.readyState')
+            return True
+        except WebDriverException:
+            return False
+
+
+def default_browser_factory() -> Remote:
+    if BROWSER_KIND == 'firefox':
+        return set_selenium_local_session(LOG_FILE, disable_image_load=LEAN_LOAD)
+    return create_proxied_browser_instance(capture_network=SCRAP_ENGINE == 'cdp',
+                                           lean=LEAN_LOAD)
+
+
+class BrowserPool:
+    """Holds ``size`` browsers with ``tabs_per_browser`` tabs each.
+
+    Callers lease a tab, use it and release it; a tab is never handed to
+    two callers at once. Tabs are health checked on lease and a dead
+    browser is restarted before its tab is handed out. ``blocked_urls``
+    are refused by every tab of a Chrome browser.
+    """
+
+    def __init__(self, size: int = BROWSER_POOL_SIZE,
+                 tabs_per_browser: int = TABS_PER_BROWSER,
+                 factory: Callable[[], Remote] = default_browser_factory,
+                 blocked_urls: Sequence[str] = LEAN_BLOCKED_URLS if LEAN_LOAD else ()):
+        self.slots = [BrowserSlot(factory, blocked_urls) for _ in range(size)]
+        self.tabs = [BrowserTab(slot)
+                     for slot in self.slots for _ in range(tabs_per_browser)]
+        self._idle: List[BrowserTab] = []
+        self._condition = threading.Condition()
+
+    @property
+    def capacity(self) -> int:
+        return len(self.tabs)
+
+    def start(self):
+        for slot in self.slots:
+            slot.start()
+        with self._condition:
+            self._idle = list(self.tabs)
+            self._condition.notify_all()
+
+    def close(self):
+        for slot in self.slots:
+            slot.quit()
+
+    def _acquire(self, pick: Callable[[List[BrowserTab]], Optional[BrowserTab]],
+                 timeout: Optional[float]) -> Optional[BrowserTab]:
+        with self._condition:
+            tab = pick(self._idle)
+            if tab is None and self._condition.wait_for(
+                    lambda: pick(self._idle) is not None, timeout):
+                tab = pick(self._idle)
+            if tab is None:
+                return None
+            self._idle.remove(tab)
+        try:
+            self._ensure_healthy(tab)
+        except Exception:
+            self.release(tab)
+            raise
+        return tab
+
+    def lease(self, site_id=None, timeout: Optional[float] = None) -> Optional[BrowserTab]:
+        """Lease the tab already showing ``site_id`` if it is idle,
+        otherwise the least recently used idle tab"""
+        def pick(idle):
+            for tab in idle:
+                if site_id is not None and tab.site_id == site_id:
+                    return tab
+            return idle[0] if idle else None
+        return self._acquire(pick, timeout)
+
+    def lease_tab(self, tab: BrowserTab, timeout: Optional[float] = None) -> Optional[BrowserTab]:
+        """Wait for a specific tab to become idle and lease it"""
+        return self._acquire(lambda idle: tab if tab in idle else None, timeout)
+
+    def lease_slot(self, slot: BrowserSlot,
+                   timeout: Optional[float] = None) -> Optional[List[BrowserTab]]:
+        """Lease every tab of ``slot``, e.g. to restart its browser, or
+        none of them if one stays busy past ``timeout``"""
+        leased = []
+        for tab in self.tabs:
+            if tab.slot is not slot:
+                continue
+            tab = self.lease_tab(tab, timeout=timeout)
+            if tab is None:
+                for other in leased:
+                    self.release(other)
+                return None
+            leased.append(tab)
+        return leased
+
+    def release(self, tab: BrowserTab):
+        with self._condition:
+            self._idle.append(tab)
+            self._condition.notify_all()
+
+    @contextmanager
+    def leased(self, site_id=None, timeout: Optional[float] = None):
+        tab = self.lease(site_id=site_id, timeout=timeout)
+        try:
+            yield tab
+        finally:
+            if tab is not None:
+                self.release(tab)
+
+    def _ensure_healthy(self, tab: BrowserTab):
+        if tab.is_healthy():
+            return
+        with tab.slot.lock:
+            if not tab.slot.is_alive():
+                print("Browser is not responding, restarting it")
+                tab.slot.restart()
+                return
+            handle = tab.slot.replace_handle(tab.handle)
+            if handle is None:
+                print("Unable to replace the unresponsive tab, restarting the browser")
+                tab.slot.restart()
+            else:
+                tab.adopt(handle)
@@ -0,0 +1,300 @@
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from config import METRICS_HOST, METRICS_PORT
+
+logger = logging.getLogger('solaredge')
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence) -> str:
+    if not names:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape(value))
+                             for name, value in zip(names, values))
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return '%d' % value
+    return repr(float(value))
+
+
+class Metric:
+    """A named family of samples, one per combination of label values.
+
+    Values are either set by the instrumented code or read from
+    ``function`` at scrape time; the function returns the value, or for
+    labelled metrics a {label values: value} dict.
+    """
+
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 function: Callable = None, registry: 'Registry' = None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.function = function
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple, object] = {}
+        (REGISTRY if registry is None else registry).register(self)
+
+    def _key(self, labels: Dict) -> Tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError("%s expects labels %s, got %s" %
+                             (self.name, self.labelnames, tuple(labels)))
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> List[Tuple[str, Sequence[str], Sequence, float]]:
+        """(suffix, label names, label values, value) tuples"""
+        if self.function is None:
+            with self._lock:
+                return [('', self.labelnames, key, value)
+                        for key, value in self._values.items()]
+        try:
+            values = self.function()
+        except Exception as error:
+            logger.error("Error collecting %s, error:%s" % (self.name, error))
+            return []
+        if not self.labelnames:
+            return [('', (), (), values)] if values is not None else []
+        return [('', self.labelnames, key if isinstance(key, tuple) else (key,), value)
+                for key, value in values.items() if value is not None]
+
+    def render(self) -> List[str]:
+        lines = ['# HELP %s %s' % (self.name, self.documentation),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        for suffix, names, values, value in self.samples():
+            lines.append('%s%s%s %s' % (self.name, suffix,
+                                        _format_labels(names, values),
+                                        _format_value(value)))
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS, registry: 'Registry' = None):
+        Metric.__init__(self, name, documentation, labelnames, registry=registry)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # per bucket counts, sum, count
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        names = self.labelnames + ('le',)
+        samples = []
+        with self._lock:
+            for key, (counts, total, count) in self._values.items():
+                cumulative = 0
+                for bound, bucket in zip(self.buckets, counts):
+                    cumulative += bucket
+                    samples.append(('_bucket', names, key + (_format_value(bound),),
+                                    cumulative))
+                samples.append(('_bucket', names, key + ('+Inf',), count))
+                samples.append(('_sum', self.labelnames, key, total))
+                samples.append(('_count', self.labelnames, key, count))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError("Metric %s is already registered" % metric.name)
+            self._metrics[metric.name] = metric
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def process_tree_rss(pid: int) -> Optional[int]:
+    """Resident bytes of ``pid`` and all its descendants, read from /proc;
+    None where /proc is not available"""
+    if not pid or not os.path.isdir('/proc/%d' % pid):
+        return None
+    children: Dict[int, List[int]] = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % entry) as stat_obj:
+                stat = stat_obj.read()
+        except OSError:
+            continue
+        # the command name may contain spaces, fields resume after ')'
+        ppid = int(stat[stat.rindex(')') + 2:].split()[1])
+        children.setdefault(ppid, []).append(int(entry))
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        pending.extend(children.get(current, ()))
+        try:
+            with open('/proc/%d/statm' % current) as statm_obj:
+                total += int(statm_obj.read().split()[1]) * PAGE_SIZE
+        except (OSError, IndexError, ValueError):
+            continue
+    return total
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry: Registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer(threading.Thread):
+    """Serves the registry on http://host:port/metrics"""
+
+    def __init__(self, host: str = METRICS_HOST, port: int = METRICS_PORT,
+                 registry: Registry = REGISTRY):
+        threading.Thread.__init__(self, name='metrics', daemon=True)
+        handler = type('MetricsHandler', (_MetricsHandler,),
+                       {'registry': registry})
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+
+    @property
+    def address(self) -> Tuple[str, int]:
+        return self.httpd.server_address[:2]
+
+    def run(self):
+        logger.info("Serving metrics on http://%s:%s/metrics" % self.address)
+        self.httpd.serve_forever()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+# the scraper's own metrics
+SCRAPES = Counter('solaredge_scrapes_total',
+                  'Scrape cycles by engine and outcome', ('engine', 'outcome'))
+SCRAPE_SECONDS = Histogram('solaredge_scrape_seconds',
+                           'Duration of a whole scrape cycle', ('engine',))
+PAGE_LOAD_SECONDS = Histogram('solaredge_page_load_seconds',
+                              'Duration of browser.get')
+GET_DATA_SECONDS = Histogram('solaredge_get_data_seconds',
+                             "Duration of execute_script('return __get_data()')")
+MESSAGES = Counter('solaredge_messages_total',
+                   'Messages handled by the workers', ('role', 'outcome'))
+PROCESS_SECONDS = Histogram('solaredge_process_message_seconds',
+                            'Duration of WorkerThread.process_message', ('role',))
+STORAGE_WRITE_SECONDS = Histogram('solaredge_storage_write_seconds',
+                                  'Duration of a storage write', ('storage',))
+STORAGE_ROWS = Counter('solaredge_storage_rows_total',
+                       'Readings handed to a storage', ('storage',))
+STORAGE_ERRORS = Counter('solaredge_storage_errors_total',
+                         'Messages a storage failed to write', ('storage',))
+ARCHIVE_SECONDS = Histogram('solaredge_archive_seconds',
+                            'Duration of archiving the raw responses of a message')
+ARCHIVE_ERRORS = Counter('solaredge_archive_errors_total',
+                         'Messages whose responses could not be archived')
+PAGE_LOAD_EVENT_SECONDS = Histogram('solaredge_page_load_event_seconds',
+                                    'Navigation start to load event, from the performance api',
+                                    buckets=(.5, 1, 2.5, 5, 10, 20, 30, 60))
+PAGE_RESOURCES = Histogram('solaredge_page_resources',
+                           'Resources fetched by a page load',
+                           buckets=(10, 25, 50, 100, 200, 400, 800))
+PAGE_TRANSFER_BYTES = Histogram('solaredge_page_transfer_bytes',
+                                'Bytes transferred by a page load',
+                                buckets=(64e3, 256e3, 1e6, 4e6, 16e6, 64e6))
+TAB_JS_HEAP = Gauge('solaredge_tab_js_heap_bytes',
+                    'Used js heap of the tab showing a site', ('site',))
+HEALTH_FAILURES = Counter('solaredge_health_failures_total',
+                          'Failed tab health probes', ('probe',))
+REFRESHES = Counter('solaredge_refreshes_total',
+                    'Tab refreshes by failed probe and outcome', ('reason', 'outcome'))
+REFRESH_SECONDS = Histogram('solaredge_refresh_seconds',
+                            'Duration of a tab refresh')
+BROWSER_RECYCLES = Counter('solaredge_browser_recycles_total',
+                           'Browsers restarted by the memory watchdog', ('reason', 'outcome'))
+RECYCLE_SECONDS = Histogram('solaredge_browser_recycle_seconds',
+                            'Duration of restarting a browser and reloading its sites')
+LEASED_SITES = Gauge('solaredge_leased_sites',
+                     'Sites leased to this worker of a sharded deployment')
+LEASE_CHANGES = Counter('solaredge_lease_changes_total',
+                        'Sites gained or lost by this worker', ('change',))
@@ -0,0 +1,103 @@
+import base64
+import json
+import logging
+import re
+from collections import defaultdict
+from typing import Dict, List, Tuple
+from urllib.parse import urlparse
+
+from selenium.common.exceptions import WebDriverException
+
+from config import LAYOUT_ENERGY_PATTERN, RAW_PAYLOADS
+from local_browser import BrowserSlot
+
+logger = logging.getLogger('solaredge')
+
+LAYOUT_ENERGY_RE = re.compile(LAYOUT_ENERGY_PATTERN)
+
+
+def _target_id(handle: str) -> str:
+    # older chromedrivers prefix window handles with CDwindow-
+    return handle[len('CDwindow-'):] if handle.startswith('CDwindow-') else handle
+
+
+class NetworkCapture:
+    """Collects layout/energy response bodies from Chrome's devtools
+    network events.
+
+    ChromeDriver records ``Network.*`` events of every tab in the
+    performance log. Matching requests are remembered on
+    ``Network.responseReceived`` and their body is fetched with
+    ``Network.getResponseBody`` once ``Network.loadingFinished`` arrives.
+    Bodies are kept per site id, taken from the request path, so any tab of
+    the browser can drain the log on behalf of the others.
+    """
+
+    def __init__(self, slot: BrowserSlot, raw: bool = RAW_PAYLOADS):
+        self.slot = slot
+        self.raw = raw
+        self._pending: Dict[str, Tuple[str, str, int]] = {}
+        self._captured: Dict[int, List[Dict]] = defaultdict(list)
+        self._counts: Dict[int, int] = defaultdict(int)
+
+    def count(self, site_id: int) -> int:
+        """Number of responses captured for ``site_id`` so far"""
+        self.drain()
+        return self._counts[site_id]
+
+    def take(self, site_id: int) -> List[Dict]:
+        """Return and forget the responses captured for ``site_id``"""
+        self.drain()
+        with self.slot.lock:
+            return self._captured.pop(site_id, [])
+
+    def drain(self):
+        with self.slot.lock:
+            try:
+                entries = self.slot.browser.get_log('performance')
+            except WebDriverException as error:
+                logger.error("Unable to read performance log, error:%s" % error)
+                return
+            for entry in entries:
+                message = json.loads(entry['message'])
+                self._handle(message.get('webview'), message['message'])
+
+    def _handle(self, webview: str, event: Dict):
+        method = event.get('method')
+        params = event.get('params', {})
+        if method == 'Network.responseReceived':
+            path = urlparse(params['response']['url']).path
+            match = LAYOUT_ENERGY_RE.search(path)
+            if match:
+                self._pending[params['requestId']] = (
+                    webview, path, int(match.group(1)))
+        elif method == 'Network.loadingFinished':
+            pending = self._pending.pop(params['requestId'], None)
+            if pending:
+                webview, path, site_id = pending
+                body = self._response_body(webview, params['requestId'])
+                if body is not None:
+                    key = 'raw' if self.raw else 'res'
+                    self._captured[site_id].append({key: body, 'url': path})
+                    self._counts[site_id] += 1
+        elif method == 'Network.loadingFailed':
+            self._pending.pop(params['requestId'], None)
+
+    def _response_body(self, webview: str, request_id: str):
+        browser = self.slot.browser
+        try:
+            # getResponseBody is answered by the tab that made the request
+            for handle in browser.window_handles:
+                if _target_id(handle) == webview:
+                    browser.switch_to.window(handle)
+                    break
+            result = browser.execute_cdp_cmd(
+                'Network.getResponseBody', {'requestId': request_id})
+            body = result['body']
+            if result.get('base64Encoded'):
+                body = base64.b64decode(body)
+            return body if self.raw else json.loads(body)
+        except (WebDriverException, KeyError, ValueError) as error:
+            logger.error("Unable to read response %s, error:%s" %
+                         (request_id, error))
+            return None
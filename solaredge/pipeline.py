@@ -0,0 +1,261 @@
+"""asyncio runtime for the scraper.
+
+The scrape scheduler, a fan-out dispatcher, the processors of every
+worker pool and one sink per storage and archive run as coroutines joined
+by bounded ``asyncio.Queue``s:
+
+    scrapes -> inbox -> dispatch -> processors -> storage / archive sinks
+
+Selenium calls run on an executor sized to the number of concurrent
+scrapes and decoding and file I/O on a bounded I/O executor, so the event
+loop itself never blocks. Stopping is done by cancelling the main task,
+SIGTERM and SIGINT do that; the pipeline then stops scheduling, lets the
+in flight scrapes finish and drains the queues before closing the pools.
+"""
+import asyncio
+import heapq
+import logging
+import signal
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from config import (ASYNC_IO_WORKERS, FLUSH_CHECK_INTERVAL, QUEUE_MAXSIZE,
+                    SHUTDOWN_TIMEOUT)
+from metrics import MESSAGES, PROCESS_SECONDS, Gauge
+
+logger = logging.getLogger('solaredge')
+
+_pipelines: List['AsyncPipeline'] = []
+
+
+def _queue_depths() -> Dict[str, int]:
+    depths: Dict[str, int] = {}
+    for pipeline in _pipelines:
+        for stage, size in pipeline.qsizes().items():
+            depths[stage] = depths.get(stage, 0) + size
+    return depths
+
+
+ASYNC_QUEUE_DEPTH = Gauge('solaredge_async_queue_depth',
+                          'Messages waiting between the asyncio pipeline stages',
+                          ('stage',), function=_queue_depths)
+
+
+class _Inbox:
+    """Subscriber handed to the scraper; ``put_message`` is called from the
+    scrape executor and waits for room in the inbox"""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, inbox: asyncio.Queue,
+                 timeout: float = SHUTDOWN_TIMEOUT):
+        self.loop = loop
+        self.inbox = inbox
+        self.timeout = timeout
+
+    def put_message(self, message):
+        future = asyncio.run_coroutine_threadsafe(self.inbox.put(message), self.loop)
+        try:
+            future.result(self.timeout)
+        except Exception as error:
+            future.cancel()
+            logger.error("Dropping message of site %s, error:%s" %
+                         (getattr(message, 'site_id', None), error))
+
+
+class AsyncPipeline:
+    """Drives ``scrapper`` and the ``pools`` from one event loop.
+
+    The thread classes are reused for their logic only: the scraper for
+    its schedule and scrape cycle, the pool workers for ``transform``,
+    ``write_storage`` and ``dump_json``. None of their threads is started.
+    ``periodic`` takes ``(interval, function)`` pairs run off the loop,
+    such as the tab health checks.
+    """
+
+    def __init__(self, scrapper, pools: List, maxsize: int = QUEUE_MAXSIZE,
+                 io_workers: int = ASYNC_IO_WORKERS,
+                 periodic: List[Tuple[float, Callable]] = (),
+                 shutdown_timeout: float = SHUTDOWN_TIMEOUT):
+        self.scrapper = scrapper
+        self.pools = pools
+        self.maxsize = maxsize
+        self.periodic = list(periodic)
+        self.shutdown_timeout = shutdown_timeout
+        self.scrape_executor = ThreadPoolExecutor(
+            max_workers=scrapper.max_concurrency, thread_name_prefix='scrape')
+        self.io_executor = ThreadPoolExecutor(
+            max_workers=io_workers, thread_name_prefix='io')
+        self.inbox: Optional[asyncio.Queue] = None
+        # per pool: one queue per worker, one per storage and the archive's
+        self.processor_queues: List[List[asyncio.Queue]] = []
+        self.sink_queues: List[List[asyncio.Queue]] = []
+        self._scrapes: Set[asyncio.Future] = set()
+        self._tasks: List[asyncio.Task] = []
+
+    def qsizes(self) -> Dict[str, int]:
+        if self.inbox is None:
+            return {}
+        return {
+            'inbox': self.inbox.qsize(),
+            'process': sum(q.qsize() for queues in self.processor_queues for q in queues),
+            'sink': sum(q.qsize() for queues in self.sink_queues for q in queues),
+        }
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        main = asyncio.current_task()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(signum, main.cancel)
+            except (NotImplementedError, RuntimeError):
+                pass
+        self.inbox = asyncio.Queue(self.maxsize)
+        self.scrapper.register_interest(_Inbox(loop, self.inbox))
+        for pool in self.pools:
+            self._start_pool(pool)
+        self._tasks.append(asyncio.create_task(self.dispatch(), name='dispatch'))
+        # flush buffers of sites that stopped sending, as idle workers do
+        for pool in self.pools:
+            self._tasks.append(asyncio.create_task(
+                self.every(FLUSH_CHECK_INTERVAL, pool.workers[0].flush_expired)))
+        for interval, function in self.periodic:
+            self._tasks.append(asyncio.create_task(self.every(interval, function)))
+        _pipelines.append(self)
+        scrape = asyncio.create_task(self.scrape(), name='scrape')
+        try:
+            await scrape
+        except asyncio.CancelledError:
+            logger.info("Shutting down the pipeline")
+        finally:
+            scrape.cancel()
+            await self.shutdown()
+            _pipelines.remove(self)
+
+    def _start_pool(self, pool):
+        sinks = [asyncio.Queue(self.maxsize) for _ in pool.storages]
+        archive = asyncio.Queue(self.maxsize)
+        self.sink_queues.append(sinks + [archive])
+        writer = pool.workers[0]
+        for storage, queue in zip(pool.storages, sinks):
+            self._tasks.append(asyncio.create_task(
+                self.drain(queue, lambda item, storage=storage: writer.write_storage(
+                    storage, item.data, item.message, item.columnar))))
+        self._tasks.append(asyncio.create_task(self.drain(
+            archive, lambda item: writer.dump_json(item.message, item.responses))))
+        queues = []
+        for worker in pool.workers:
+            queue = asyncio.Queue(self.maxsize)
+            queues.append(queue)
+            self._tasks.append(asyncio.create_task(
+                self.process(worker, queue, sinks, archive), name=worker.name))
+        self.processor_queues.append(queues)
+
+    async def scrape(self):
+        """The ScrappingThread schedule, sleeping until the next site is due
+        instead of polling"""
+        loop = asyncio.get_running_loop()
+        scrapper = self.scrapper
+        if not scrapper.sites:
+            logger.warning("No sites registered, nothing to scrape")
+            # idle until the pipeline is cancelled
+            await asyncio.Event().wait()
+        await loop.run_in_executor(self.scrape_executor, scrapper.load_page)
+        now = loop.time()
+        schedule = [(now + scrapper.next_delay(site), index, site)
+                    for index, site in enumerate(scrapper.sites)]
+        heapq.heapify(schedule)
+        while True:
+            due, index, site = schedule[0]
+            if due > loop.time():
+                await asyncio.sleep(due - loop.time())
+                continue
+            twait = scrapper.next_delay(site)
+            heapq.heapreplace(schedule, (loop.time() + twait, index, site))
+            if not scrapper.owns(site):
+                continue
+            if not scrapper._claim(site):
+                logger.warning("Site %s is still being scraped, skipping" % site.site_id)
+                continue
+            logger.info("Next scrap of site %s in %.0f seconds" % (site.site_id, twait))
+            future = loop.run_in_executor(self.scrape_executor, scrapper._scrap_site, site)
+            self._scrapes.add(future)
+            future.add_done_callback(self._scrapes.discard)
+
+    async def dispatch(self):
+        """Hand every message to all pools at once"""
+        while True:
+            message = await self.inbox.get()
+            try:
+                await asyncio.gather(*(
+                    queues[hash(message.site_id) % len(queues)].put(message)
+                    for queues in self.processor_queues))
+            finally:
+                self.inbox.task_done()
+
+    async def process(self, worker, queue: asyncio.Queue, sinks: List[asyncio.Queue],
+                      archive: asyncio.Queue):
+        loop = asyncio.get_running_loop()
+        while True:
+            message = await queue.get()
+            outcome = 'error'
+            try:
+                processed = await loop.run_in_executor(
+                    self.io_executor, self._transform, worker, message)
+                if processed:
+                    puts = [archive.put(processed)]
+                    if processed.data is not None:
+                        puts.extend(sink.put(processed) for sink in sinks)
+                    await asyncio.gather(*puts)
+                outcome = 'ok'
+            except Exception as error:
+                logger.error("Error processing message, error:%s" % error)
+            finally:
+                MESSAGES.inc(role=worker.role, outcome=outcome)
+                queue.task_done()
+
+    @staticmethod
+    def _transform(worker, message):
+        with PROCESS_SECONDS.time(role=worker.role):
+            return worker.transform(message)
+
+    async def drain(self, queue: asyncio.Queue, write: Callable):
+        """Sink: apply ``write`` to every item, one at a time so the order
+        of writes to a storage is kept"""
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await queue.get()
+            try:
+                await loop.run_in_executor(self.io_executor, write, item)
+            except Exception as error:
+                logger.error("Error writing message, error:%s" % error)
+            finally:
+                queue.task_done()
+
+    async def every(self, interval: float, function: Callable):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await loop.run_in_executor(None, function)
+            except Exception as error:
+                logger.error("Error in periodic task, error:%s" % error)
+
+    async def shutdown(self):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.shutdown_timeout
+        if self._scrapes:
+            await asyncio.wait(set(self._scrapes), timeout=self.shutdown_timeout)
+        stages = [[self.inbox]] + self.processor_queues + self.sink_queues
+        for queues in stages:
+            for queue in queues:
+                try:
+                    await asyncio.wait_for(queue.join(), max(0, deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    logger.warning("%d messages left unprocessed on shutdown" %
+                                   queue.qsize())
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        for pool in self.pools:
+            await loop.run_in_executor(self.io_executor, pool.close)
+        self.scrape_executor.shutdown(wait=False)
+        self.io_executor.shutdown(wait=True)
@@ -0,0 +1,216 @@
+import json
+from datetime import datetime
+from numbers import Real
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    orjson = None
+    _loads = json.loads
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class SchemaError(ValueError):
+    """Raised when a layout/energy payload does not have the expected shape"""
+
+
+class PanelReading:
+    """One panel's values from a layout/energy response"""
+
+    __slots__ = ('site', 'panel', 'energy', 'units', 'unscaledEnergy',
+                 'moduleEnergy', 'relayState', 'date')
+
+    fields: Tuple[str, ...] = __slots__
+
+    def __init__(self, site: Optional[int], panel: str, energy, units,
+                 unscaledEnergy, moduleEnergy, relayState, date: datetime):
+        self.site = site
+        self.panel = panel
+        self.energy = energy
+        self.units = units
+        self.unscaledEnergy = unscaledEnergy
+        self.moduleEnergy = moduleEnergy
+        self.relayState = relayState
+        self.date = date
+
+    def as_row(self) -> Tuple:
+        return (self.site, self.panel, self.energy, self.units,
+                self.unscaledEnergy, self.moduleEnergy, self.relayState,
+                self.date)
+
+    def as_dict(self) -> Dict:
+        return dict(zip(self.fields, self.as_row()))
+
+    def __repr__(self):
+        return 'PanelReading(%s)' % ', '.join(
+            '%s=%r' % item for item in zip(self.fields, self.as_row()))
+
+
+_NUMERIC_FIELDS = ('energy', 'unscaledEnergy', 'moduleEnergy')
+
+
+def _check_number(panel: str, field: str, value):
+    if value is not None and (isinstance(value, bool) or not isinstance(value, Real)):
+        raise SchemaError("panel %s: %s is not a number (%r)" %
+                          (panel, field, value))
+
+
+def _validate_payload(payload) -> Dict[str, Dict]:
+    """Parse a layout/energy payload, raw text or already parsed, and check
+    every panel has its values and numbers where numbers belong; returns
+    the values by panel id"""
+    if isinstance(payload, (str, bytes, bytearray, memoryview)):
+        try:
+            payload = _loads(payload)
+        except ValueError as error:
+            raise SchemaError("payload is not valid json: %s" % error)
+    if not payload:
+        return {}
+    if not isinstance(payload, dict):
+        raise SchemaError("payload is a %s, expected an object" %
+                          type(payload).__name__)
+    for panel, values in payload.items():
+        try:
+            numbers = (values['energy'], values['unscaledEnergy'], values['moduleEnergy'])
+            values['units'], values['relayState']
+        except (KeyError, TypeError) as error:
+            raise SchemaError("panel %s: missing %s" % (panel, error))
+        if not all(value.__class__ is float for value in numbers):
+            for field, value in zip(_NUMERIC_FIELDS, numbers):
+                _check_number(panel, field, value)
+    return payload
+
+
+def decode_payload(payload, site_id: Optional[int], date: datetime) -> List[PanelReading]:
+    """Turn a layout/energy payload, raw text or already parsed, into
+    validated readings"""
+    return [PanelReading(site_id, panel, values['energy'], values['units'],
+                         values['unscaledEnergy'], values['moduleEnergy'],
+                         values['relayState'], date)
+            for panel, values in _validate_payload(payload).items()]
+
+
+def _response_payload(scrap_response: Dict):
+    if 'raw' in scrap_response:
+        return scrap_response['raw']
+    return scrap_response.get('res')
+
+
+def decode_response(scrap_response: Dict, site_id: Optional[int], date: datetime) -> List[PanelReading]:
+    """Decode one captured response, either ``{'res': ...}`` as parsed by
+    the extension or ``{'raw': ...}`` as handed over unparsed"""
+    return decode_payload(_response_payload(scrap_response), site_id, date)
+
+
+def _encode(values: Iterable) -> Tuple['np.ndarray', List]:
+    """Dictionary encode ``values``; ``None`` gets code -1"""
+    lookup: Dict[Any, int] = {}
+    codes = [-1 if value is None else lookup.setdefault(value, len(lookup))
+             for value in values]
+    return np.array(codes, dtype=np.int32), list(lookup)
+
+
+def _label(value) -> Optional[str]:
+    return None if value is None else str(value)
+
+
+class PanelColumns(NamedTuple):
+    """Readings of one or more responses as column arrays.
+
+    Panel ids, units and relay states are stored as int32 codes into their
+    ``*_categories`` list, code -1 meaning missing. Missing numbers are NaN
+    and a missing site is -1.
+    """
+    site: 'np.ndarray'
+    panel: 'np.ndarray'
+    panel_categories: List[str]
+    energy: 'np.ndarray'
+    units: 'np.ndarray'
+    units_categories: List[str]
+    unscaledEnergy: 'np.ndarray'
+    moduleEnergy: 'np.ndarray'
+    relayState: 'np.ndarray'
+    relayState_categories: List[str]
+    date: 'np.ndarray'
+
+    @property
+    def size(self) -> int:
+        return len(self.panel)
+
+    @classmethod
+    def build(cls, sites: List, panels: List, values: List[Dict], dates: List) -> 'PanelColumns':
+        if np is None:
+            raise RuntimeError("numpy is required for the columnar transform")
+        try:
+            energy = np.array([v['energy'] for v in values], dtype=np.float64)
+            unscaled = np.array([v['unscaledEnergy'] for v in values], dtype=np.float64)
+            module = np.array([v['moduleEnergy'] for v in values], dtype=np.float64)
+            units, units_categories = _encode(_label(v['units']) for v in values)
+            relay, relay_categories = _encode(_label(v['relayState']) for v in values)
+        except (KeyError, TypeError, ValueError) as error:
+            raise SchemaError("unexpected panel values: %r" % error)
+        panel, panel_categories = _encode(panels)
+        return cls(
+            site=np.array([-1 if s is None else s for s in sites], dtype=np.int64),
+            panel=panel, panel_categories=panel_categories,
+            energy=energy, units=units, units_categories=units_categories,
+            unscaledEnergy=unscaled, moduleEnergy=module,
+            relayState=relay, relayState_categories=relay_categories,
+            date=np.array(dates, dtype='datetime64[us]'),
+        )
+
+    @classmethod
+    def from_readings(cls, readings: List[PanelReading]) -> 'PanelColumns':
+        return cls.build(
+            [r.site for r in readings], [r.panel for r in readings],
+            [{'energy': r.energy, 'unscaledEnergy': r.unscaledEnergy,
+              'moduleEnergy': r.moduleEnergy, 'units': r.units,
+              'relayState': r.relayState} for r in readings],
+            [r.date for r in readings])
+
+    def to_readings(self) -> List[PanelReading]:
+        def label(codes, categories):
+            return [None if code < 0 else categories[code] for code in codes.tolist()]
+
+        def number(values):
+            return [None if value != value else value for value in values.tolist()]
+
+        return [PanelReading(*row) for row in zip(
+            [None if site < 0 else site for site in self.site.tolist()],
+            label(self.panel, self.panel_categories),
+            number(self.energy), label(self.units, self.units_categories),
+            number(self.unscaledEnergy), number(self.moduleEnergy),
+            label(self.relayState, self.relayState_categories),
+            self.date.tolist())]
+
+
+def response_values(scrap_response: Dict) -> Dict[str, Dict]:
+    """The validated panel values of one captured response, by panel id"""
+    return _validate_payload(_response_payload(scrap_response))
+
+
+def columns_from_values(batches: Iterable[Tuple[Dict[str, Dict], Optional[int], datetime]]
+                        ) -> PanelColumns:
+    """Build one set of column arrays from ``(response_values, site_id,
+    date)`` batches"""
+    sites, panels, values, dates = [], [], [], []
+    for payload, site_id, date in batches:
+        count = len(payload)
+        panels.extend(payload.keys())
+        values.extend(payload.values())
+        sites.extend([site_id] * count)
+        dates.extend([date] * count)
+    return PanelColumns.build(sites, panels, values, dates)
+
+
+def decode_columns(responses: Iterable[Tuple[Dict, Optional[int], datetime]]) -> PanelColumns:
+    """Decode a batch of ``(scrap_response, site_id, date)`` into one set of
+    column arrays"""
+    return columns_from_values((response_values(scrap_response), site_id, date)
+                               for scrap_response, site_id, date in responses)
@@ -0,0 +1,181 @@
+import csv
+import logging
+import os
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+from config import ROLLUP_FIELD, ROLLUP_RESOLUTIONS
+from records import PanelColumns, PanelReading
+from storage import day_folder
+
+logger = logging.getLogger('solaredge')
+
+# panel name of the per site aggregate, built from the sum of all panels
+SITE_PANEL = '*'
+ROLLUP_FIELDS = ('start', 'panel', 'delta', 'min', 'max', 'count')
+
+
+def bucket_start(timestamp: datetime, seconds: int) -> datetime:
+    """Start of the ``seconds`` long bucket holding ``timestamp``, buckets
+    being aligned on midnight"""
+    midnight = timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+    offset = (timestamp - midnight).total_seconds()
+    return midnight + timedelta(seconds=offset // seconds * seconds)
+
+
+class _Bucket:
+    """Running first, last, min, max and count of every panel of a site"""
+
+    __slots__ = ('start', 'stats')
+
+    def __init__(self, start: datetime):
+        self.start = start
+        self.stats: Dict[str, List] = {}
+
+    def add(self, panel: str, value: float):
+        stat = self.stats.get(panel)
+        if stat is None:
+            self.stats[panel] = [value, value, value, value, 1]
+            return
+        stat[1] = value
+        if value < stat[2]:
+            stat[2] = value
+        if value > stat[3]:
+            stat[3] = value
+        stat[4] += 1
+
+    def merge(self, other: '_Bucket'):
+        for panel, (first, last, low, high, count) in other.stats.items():
+            stat = self.stats.get(panel)
+            if stat is None:
+                self.stats[panel] = [first, last, low, high, count]
+                continue
+            stat[1] = last
+            stat[2] = min(stat[2], low)
+            stat[3] = max(stat[3], high)
+            stat[4] += count
+
+
+class RollupWriter:
+    """Appends finished buckets to ``rollup-<resolution>.csv`` next to the
+    site's ``processed.csv``"""
+
+    def __init__(self, suffix: str = ''):
+        self.suffix = suffix
+        self.paths: Set[str] = set()
+
+    def get_write_path(self, resolution: str, start: datetime, site_id: Optional[int]) -> str:
+        return os.path.join(day_folder(start, site_id),
+                            'rollup-%s.csv%s' % (resolution, self.suffix))
+
+    def write(self, resolution: str, start: datetime, site_id: Optional[int],
+              rows: Iterable[Tuple]):
+        path = self.get_write_path(resolution, start, site_id)
+        if self.suffix and path not in self.paths and os.path.exists(path):
+            # leftovers of an interrupted run
+            os.remove(path)
+        self.paths.add(path)
+        has_header = os.path.exists(path) and os.path.getsize(path) > 0
+        with open(path, 'a', newline='') as rollup_obj:
+            writer = csv.writer(rollup_obj)
+            if not has_header:
+                writer.writerow(ROLLUP_FIELDS)
+            writer.writerows(rows)
+
+
+class RollupEngine:
+    """Keeps per panel and per site aggregates of ``field`` at every
+    resolution and writes each bucket once it is finished.
+
+    Only the finest resolution sees the readings; a finished bucket is
+    folded into the enclosing bucket of the next resolution, so the cost
+    per reading does not grow with the number of resolutions. ``delta``
+    is the bucket's last value minus the last value of the previous
+    bucket, or minus its first value when there is none. A bucket still
+    open on close is written as is, so after a restart the same bucket may
+    appear twice; such rows merge by summing delta and count.
+    """
+
+    def __init__(self, resolutions: Sequence[Tuple[str, int]] = ROLLUP_RESOLUTIONS,
+                 field: str = ROLLUP_FIELD, writer: RollupWriter = None):
+        self.resolutions = list(resolutions)
+        self.field = field
+        self.writer = writer or RollupWriter()
+        self.late = 0
+        self._open: Dict[Optional[int], List[Optional[_Bucket]]] = {}
+        self._last: Dict[Tuple[int, Optional[int], str], float] = {}
+        self._lock = threading.Lock()
+
+    def add(self, site_id: Optional[int], panels: Sequence[str], values: Sequence,
+            timestamp: datetime):
+        """Add the readings of one message, which share ``timestamp``; a
+        panel repeated by several responses of the message counts once"""
+        _, seconds = self.resolutions[0]
+        start = bucket_start(timestamp, seconds)
+        with self._lock:
+            levels = self._open.setdefault(site_id, [None] * len(self.resolutions))
+            bucket = levels[0]
+            if bucket is not None and start < bucket.start:
+                self.late += 1
+                logger.debug("Dropping late readings of site %s from %s" %
+                             (site_id, timestamp))
+                return
+            if bucket is None or start > bucket.start:
+                if bucket is not None:
+                    self._close(site_id, 0, bucket)
+                bucket = levels[0] = _Bucket(start)
+            total = None
+            for panel, value in dict(zip(panels, values)).items():
+                # None and NaN
+                if value is None or value != value:
+                    continue
+                bucket.add(panel, value)
+                total = value if total is None else total + value
+            if total is not None:
+                bucket.add(SITE_PANEL, total)
+
+    def add_readings(self, readings: List[PanelReading], site_id: Optional[int],
+                     timestamp: datetime):
+        self.add(site_id, [reading.panel for reading in readings],
+                 [getattr(reading, self.field) for reading in readings], timestamp)
+
+    def add_columns(self, columns: PanelColumns, site_id: Optional[int],
+                    timestamp: datetime):
+        categories = columns.panel_categories
+        self.add(site_id, [categories[code] for code in columns.panel.tolist()],
+                 getattr(columns, self.field).tolist(), timestamp)
+
+    def _close(self, site_id: Optional[int], level: int, bucket: _Bucket):
+        name, _ = self.resolutions[level]
+        rows = []
+        for panel, (first, last, low, high, count) in bucket.stats.items():
+            key = (level, site_id, panel)
+            previous = self._last.get(key, first)
+            self._last[key] = last
+            rows.append((bucket.start, panel, last - previous, low, high, count))
+        try:
+            self.writer.write(name, bucket.start, site_id, rows)
+        except OSError as error:
+            logger.error("Unable to write %s rollup of site %s, error:%s" %
+                         (name, site_id, error))
+        if level + 1 == len(self.resolutions):
+            return
+        levels = self._open[site_id]
+        start = bucket_start(bucket.start, self.resolutions[level + 1][1])
+        parent = levels[level + 1]
+        if parent is None or parent.start != start:
+            if parent is not None:
+                self._close(site_id, level + 1, parent)
+            parent = levels[level + 1] = _Bucket(start)
+        parent.merge(bucket)
+
+    def close(self):
+        """Write every open bucket, finest first"""
+        with self._lock:
+            for site_id, levels in self._open.items():
+                for level in range(len(levels)):
+                    if levels[level] is not None:
+                        bucket, levels[level] = levels[level], None
+                        self._close(site_id, level, bucket)
+            self._open.clear()
@@ -0,0 +1,140 @@
+import math
+import random
+import threading
+import time
+from datetime import date, datetime, timezone
+from typing import Dict, Optional, Tuple
+
+from config import (ADAPTIVE_LAG, ADAPTIVE_MAX_INTERVAL, ADAPTIVE_MIN_INTERVAL,
+                    NIGHT_MARGIN, NIGHT_MAX_INTERVAL, Site)
+
+_J2000 = 2451545.0
+_UNIX_EPOCH_JD = 2440587.5
+
+
+def sun_times(day: date, latitude: float, longitude: float) -> Tuple[Optional[float], Optional[float]]:
+    """Sunrise and sunset of ``day`` as unix timestamps, using the sunrise
+    equation (accurate to a minute or two). Returns ``(None, None)`` on a
+    polar night and ``(-inf, inf)`` on a polar day."""
+    # julian day number of the day, counted from J2000
+    n = round(day.toordinal() + 1721425.0 - _J2000 + 0.0008)
+    mean_solar_noon = n - longitude / 360.0
+    anomaly = math.radians((357.5291 + 0.98560028 * mean_solar_noon) % 360)
+    center = (1.9148 * math.sin(anomaly) + 0.0200 * math.sin(2 * anomaly)
+              + 0.0003 * math.sin(3 * anomaly))
+    ecliptic = math.radians(
+        (math.degrees(anomaly) + center + 180 + 102.9372) % 360)
+    transit = (_J2000 + mean_solar_noon + 0.0053 * math.sin(anomaly)
+               - 0.0069 * math.sin(2 * ecliptic))
+    declination = math.asin(math.sin(ecliptic) * math.sin(math.radians(23.4397)))
+    phi = math.radians(latitude)
+    cos_hour_angle = ((math.sin(math.radians(-0.833)) - math.sin(phi) * math.sin(declination))
+                      / (math.cos(phi) * math.cos(declination)))
+    if cos_hour_angle > 1:
+        return None, None
+    if cos_hour_angle < -1:
+        return -math.inf, math.inf
+    half_day = math.degrees(math.acos(cos_hour_angle)) / 360.0
+
+    def to_unix(julian):
+        return (julian - _UNIX_EPOCH_JD) * 86400.0
+
+    return to_unix(transit - half_day), to_unix(transit + half_day)
+
+
+class _SiteState:
+    __slots__ = ('last_change', 'period', 'idle')
+
+    def __init__(self):
+        self.last_change: Optional[float] = None
+        self.period: Optional[float] = None
+        self.idle = 0
+
+
+class AdaptiveScheduler:
+    """Picks the delay before a site's next scrape.
+
+    The interval between observed value changes is tracked as a moving
+    average; once known, the next scrape is placed ``lag`` seconds after
+    the next expected update. Polls that see no change back off
+    exponentially, and between sunset and sunrise (when the site has
+    coordinates) the site is only checked every ``night_interval``
+    seconds or at sunrise, whichever comes first.
+    """
+
+    def __init__(self, min_interval: float = ADAPTIVE_MIN_INTERVAL,
+                 max_interval: float = ADAPTIVE_MAX_INTERVAL, lag: float = ADAPTIVE_LAG,
+                 night_margin: float = NIGHT_MARGIN, night_interval: float = NIGHT_MAX_INTERVAL):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.lag = lag
+        self.night_margin = night_margin
+        self.night_interval = night_interval
+        self._states: Dict[int, _SiteState] = {}
+        self._sun: Dict[Tuple[int, date], Tuple[Optional[float], Optional[float]]] = {}
+        self._sun_day: Optional[date] = None
+        self._lock = threading.Lock()
+
+    def observe(self, site_id: int, changed: bool, when: Optional[float] = None):
+        """Record whether a scrape of ``site_id`` returned new values"""
+        when = time.time() if when is None else when
+        with self._lock:
+            state = self._states.setdefault(site_id, _SiteState())
+            if not changed:
+                state.idle += 1
+                return
+            if state.last_change is not None and when > state.last_change:
+                interval = when - state.last_change
+                # intervals spanning missed updates would inflate the average
+                if state.period is not None:
+                    interval = interval / max(1, round(interval / state.period))
+                    state.period = 0.7 * state.period + 0.3 * interval
+                else:
+                    state.period = interval
+            state.last_change = when
+            state.idle = 0
+
+    def night_delay(self, site: Site, now: float) -> Optional[float]:
+        """Seconds to wait when it is night at the site, else None"""
+        if site.latitude is None or site.longitude is None:
+            return None
+        # the utc day and the local day differ, so look at both neighbours
+        today = datetime.fromtimestamp(now, tz=timezone.utc).date()
+        if today != self._sun_day:
+            self._sun_day = today
+            self._sun = {key: value for key, value in self._sun.items()
+                         if key[1] >= date.fromordinal(today.toordinal() - 1)}
+        next_sunrise = math.inf
+        for offset in (-1, 0, 1):
+            day = date.fromordinal(today.toordinal() + offset)
+            key = (site.site_id, day)
+            if key not in self._sun:
+                self._sun[key] = sun_times(day, site.latitude, site.longitude)
+            sunrise, sunset = self._sun[key]
+            if sunrise is None:
+                continue
+            if sunrise - self.night_margin <= now <= sunset + self.night_margin:
+                return None
+            if sunrise > now:
+                next_sunrise = min(next_sunrise, sunrise)
+        return min(self.night_interval,
+                   max(self.min_interval, next_sunrise - self.night_margin - now))
+
+    def next_delay(self, site: Site, now: Optional[float] = None) -> float:
+        now = time.time() if now is None else now
+        night = self.night_delay(site, now)
+        if night is not None:
+            return night
+        with self._lock:
+            state = self._states.get(site.site_id) or _SiteState()
+            last_change, period, idle = state.last_change, state.period, state.idle
+        if period and last_change is not None and idle < 3:
+            elapsed = now - last_change
+            target = last_change + (math.floor(elapsed / period) + 1) * period + self.lag
+            delay = target - now
+            if delay < self.min_interval:
+                delay += period
+        else:
+            delay = random.uniform(site.interval, 2 * site.interval)
+            delay *= 2 ** min(idle // 3, 5)
+        return max(self.min_interval, min(delay, self.max_interval))
@@ -1,45 +1,106 @@
 from __future__ import absolute_import
 
+import asyncio
+import heapq
 import logging
-import os
 import queue
 import random
 import signal
+import sqlite3
 import sys
 import threading
 import time
 from abc import ABCMeta, abstractmethod
-from csv import DictWriter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Any, Dict, List, NamedTuple
-import json
+from typing import Any, Dict, List, NamedTuple, Optional, Set
+
 from selenium import webdriver
 from selenium.common.exceptions import (JavascriptException,
                                         NoSuchElementException,
                                         TimeoutException, WebDriverException)
 
-from config import LOG_FILE, SCRAP_DATA
-from local_browser import (create_proxied_browser_instance,
-                           set_selenium_local_session)
-from utils import create_logger, is_page_available, web_address_navigator
+from config import (ADAPTIVE_SCHEDULING, ASYNC_PIPELINE, BROWSER_MAX_AGE,
+                    BROWSER_RSS_LIMIT, ROLLUPS,
+                    COLUMNAR_TRANSFORM, HEALTH_CHECK_INTERVAL,
+                    LEASE_HEARTBEAT, MAX_CONCURRENT_SCRAPS, METRICS_PORT,
+                    QUEUE_MAXSIZE, QUEUE_POLICY, RAW_PAYLOADS, RESPONSE_STALE_AFTER,
+                    SCRAP_ENGINE, SCRAP_TIMEOUT, SHARD_WORKER_ID,
+                    SHUTDOWN_TIMEOUT, STATE_API_PORT, TAB_HEAP_LIMIT, WATCHDOG_INTERVAL,
+                    WORKER_POOL_SIZES, Site, ensure_dirs, load_sites)
+from http_client import LayoutEnergyClient
+from archive import SegmentArchive
+from dedup import Deduplicator, response_digest
+from leases import LeaseTable
+from local_browser import BrowserPool, BrowserSlot, BrowserTab
+from metrics import (ARCHIVE_ERRORS, ARCHIVE_SECONDS, BROWSER_RECYCLES, GET_DATA_SECONDS,
+                     HEALTH_FAILURES, LEASE_CHANGES, LEASED_SITES, MESSAGES,
+                     RECYCLE_SECONDS,
+                     PAGE_LOAD_EVENT_SECONDS, PAGE_RESOURCES, PAGE_TRANSFER_BYTES,
+                     PROCESS_SECONDS, REFRESH_SECONDS, REFRESHES, SCRAPE_SECONDS,
+                     SCRAPES, STORAGE_ERRORS, STORAGE_ROWS, STORAGE_WRITE_SECONDS,
+                     TAB_JS_HEAP,
+                     Counter, Gauge, MetricsServer, process_tree_rss)
+from network_capture import NetworkCapture
+from records import (PanelReading, SchemaError, columns_from_values,
+                     decode_response, response_values)
+from rollups import RollupEngine
+from scheduling import AdaptiveScheduler
+from state import LatestState, StateServer
+from storage import StorageBackend, create_storages
+from utils import create_logger, explicit_wait, page_stats, web_address_navigator
 
-create_logger('solaredge')
 logger = logging.getLogger('solaredge')
-lock = threading.Lock()
 
 EXIT_SIG = 0
-try:
-    browser: webdriver.Chrome = create_proxied_browser_instance()
-except Exception as e:
-    logger.error(e)
-    sys.exit(-1)
-
-_url_ = "https://monitoringpublic.solaredge.com/solaredge-web/p/site/public?name=myerssolargrumbles#/layout"
+worker_pools: List['WorkerPool'] = []
+pool: BrowserPool = None
+leaser: 'ShardLeaser' = None
+dispatcher_thread: 'ScrappingThread' = None
+
+
+def start_browser_pool() -> BrowserPool:
+    global pool
+    try:
+        pool = BrowserPool()
+        pool.start()
+    except Exception as e:
+        logger.error(e)
+        sys.exit(-1)
+    return pool
+
+
+def record_page_stats(tab: BrowserTab, site_id: int):
+    """Log and export what loading the site cost, to compare lean and
+    full loads"""
+    stats = page_stats(tab)
+    if not stats:
+        return
+    if stats['load_ms'] is not None:
+        PAGE_LOAD_EVENT_SECONDS.observe(stats['load_ms'] / 1000)
+    PAGE_RESOURCES.observe(stats['resources'])
+    PAGE_TRANSFER_BYTES.observe(stats['transferred'])
+    if stats['js_heap'] is not None:
+        TAB_JS_HEAP.set(stats['js_heap'], site=site_id)
+    logger.info("Loaded site %s: %s ms, %d resources, %d KiB transferred, %s KiB js heap" % (
+        site_id, stats['load_ms'], stats['resources'], stats['transferred'] // 1024,
+        stats['js_heap'] // 1024 if stats['js_heap'] is not None else '?'))
 
 
 class ScrapMessage(NamedTuple):
     datetime: datetime
     data: List[Dict]
+    site_id: Optional[int] = None
+
+
+class ProcessedMessage(NamedTuple):
+    """What processing a message leaves for the storages and the archive;
+    ``data`` is a list of readings, PanelColumns when ``columnar``, or None
+    when no panel changed"""
+    message: ScrapMessage
+    data: Any
+    columnar: bool
+    responses: List[Dict]
 
 
 class AbstractThreadWorker(metaclass=ABCMeta):
@@ -50,190 +111,843 @@ class AbstractThreadWorker(metaclass=ABCMeta):
 
 
 class ScrappingThread(threading.Thread):
+    """Polls every registered site on its own cadence, running at most
+    ``max_concurrency`` scrapes at once"""
 
-    def __init__(self, *args, **kwargs):
+    engine = 'browser'
+
+    def __init__(self, *args, sites: List[Site] = None, max_concurrency: int = 1,
+                 scheduler: AdaptiveScheduler = None, **kwargs):
         threading.Thread.__init__(self, *args, **kwargs)
+        if scheduler is None and ADAPTIVE_SCHEDULING:
+            scheduler = AdaptiveScheduler()
+        self.scheduler = scheduler
+        self._digests: Dict[int, bytes] = {}
         self._interested_threads: List[AbstractThreadWorker] = []
+        self.sites = sites or load_sites()
+        self.max_concurrency = max_concurrency
+        self.sites_by_id: Dict[int, Site] = {
+            site.site_id: site for site in self.sites}
+        self._in_flight: Set[int] = set()
+        self._in_flight_lock = threading.Lock()
+        # monotonic times of the last scrape and the last response per site
+        self.last_attempt: Dict[int, float] = {}
+        self.last_response: Dict[int, float] = {}
+        # ids of the sites leased to this worker when sharded, None for all
+        self.owned: Optional[Set[int]] = None
+        self._stopped = threading.Event()
+
+    def stop(self):
+        """Stop scheduling scrapes; ``run`` returns once the scrapes in
+        flight have dispatched their messages"""
+        self._stopped.set()
+
+    def owns(self, site: Site) -> bool:
+        return self.owned is None or site.site_id in self.owned
 
     def load_page(self):
+        sites = [site for site in self.sites if self.owns(site)]
+        for site in sites[:pool.capacity]:
+            with pool.leased(site_id=site.site_id) as tab:
+                self.open_site(tab, site)
+
+    def open_site(self, tab: BrowserTab, site: Site):
         try:
-            browser.get(_url_)
-            self.ensure_extension_loaded()
-            web_address_navigator(browser, _url_)
+            tab.get(site.url)
+            self.prepare_page(tab, site)
         except TimeoutException as e:
             logger.error(e)
 
-    def get_random(self) -> int:
-        return random.randint(60, (2*60))
+    def prepare_page(self, tab: BrowserTab, site: Site):
+        """Set up a freshly loaded page of ``site``"""
+        self.ensure_extension_loaded(tab)
+        if RAW_PAYLOADS:
+            tab.execute_script('window.scrap_raw = true')
+        web_address_navigator(tab, site.url)
+        tab.site_id = site.site_id
+        record_page_stats(tab, site.site_id)
 
-    def ensure_extension_loaded(self):
+    def get_random(self, site: Site) -> int:
+        return random.randint(site.interval, (2*site.interval))
+
+    def next_delay(self, site: Site) -> float:
+        if self.scheduler:
+            return self.scheduler.next_delay(site)
+        return self.get_random(site)
+
+    def ensure_extension_loaded(self, tab: BrowserTab, notify: bool = True) -> bool:
         try:
-            engine = browser.execute_script(
-                'return document.getElementById("_ENGINE_")')
+            engine = tab.execute_script(
+                'var e = document.getElementById("_ENGINE_");'
+                'return e && [e.getAttribute("data-version"), e.getAttribute("data-ts")]')
             if engine:
-                logger.info("Scrap extension loaded , version:%s ts:%s" % (
-                    engine.get_attribute('data-version'), engine.get_attribute('data-ts')))
-                return
+                if notify:
+                    logger.info("Scrap extension loaded , version:%s ts:%s" % (
+                        engine[0], engine[1]))
+                return True
         except JavascriptException as err_r:
             logger.error(err_r)
+        return False
 
     def run(self):
+        if not self.sites:
+            logger.warning("No sites registered, nothing to scrape")
+            while not EXIT_SIG and not self._stopped.is_set():
+                self._stopped.wait(1)
+            return
         self.load_page()
-        while not EXIT_SIG:
-            twait = self.get_random()
-            logger.info("Waiting for %s seconds "%twait)
-            time.sleep(twait)
+        now = time.monotonic()
+        schedule = [(now + self.next_delay(site), index, site)
+                    for index, site in enumerate(self.sites)]
+        heapq.heapify(schedule)
+        with ThreadPoolExecutor(max_workers=self.max_concurrency,
+                                thread_name_prefix=self.name) as executor:
+            while not EXIT_SIG and not self._stopped.is_set():
+                due, index, site = schedule[0]
+                twait = due - time.monotonic()
+                if twait > 0:
+                    time.sleep(min(twait, 1))
+                    continue
+                twait = self.next_delay(site)
+                heapq.heapreplace(
+                    schedule, (time.monotonic() + twait, index, site))
+                if not self.owns(site):
+                    continue
+                if not self._claim(site):
+                    logger.warning(
+                        "Site %s is still being scraped, skipping" % site.site_id)
+                    continue
+                logger.info("Next scrap of site %s in %.0f seconds" %
+                            (site.site_id, twait))
+                executor.submit(self._scrap_site, site)
+
+    def _claim(self, site: Site) -> bool:
+        with self._in_flight_lock:
+            if site.site_id in self._in_flight:
+                return False
+            self._in_flight.add(site.site_id)
+            return True
+
+    def _scrap_site(self, site: Site):
+        outcome = 'error'
+        self.last_attempt[site.site_id] = time.monotonic()
+        try:
+            with SCRAPE_SECONDS.time(engine=self.engine):
+                self.scrap_cycle(site)
+            outcome = 'ok'
+        except Exception as error:
+            logger.error("Error scraping site %s, error:%s" %
+                         (site.site_id, error))
+        finally:
+            SCRAPES.inc(engine=self.engine, outcome=outcome)
+            with self._in_flight_lock:
+                self._in_flight.discard(site.site_id)
+
+    def scrap_cycle(self, site: Site):
+        with pool.leased(site_id=site.site_id) as tab:
             try:
-                data = browser.execute_script('return __get_data()')
+                if tab.site_id != site.site_id:
+                    self.open_site(tab, site)
+                # whatever arrived since the last cycle; the scheduler only
+                # learns from the read that follows the click
+                data = self.get_data(tab)
                 if data and len(data['data']):
                     message = ScrapMessage(
-                        datetime=datetime.now(), data=data['data'])
-                    self.dispatch_message(message)
-                browser.execute_script('__scrap_data()')
-                logger.info('scraping data %s' % (datetime.now()))
-                time.sleep(30)
-                data = browser.execute_script('return __get_data()')
+                        datetime=datetime.now(), data=data['data'], site_id=site.site_id)
+                    self.dispatch_message(message, observe=False)
+                count = tab.execute_script('return __scrap_data()') or 0
+                logger.info('scraping site %s %s' % (site.site_id, datetime.now()))
+                if explicit_wait(tab, "XHR", [count + 1], logger,
+                                 SCRAP_TIMEOUT, poll_frequency=0.1):
+                    self.last_response[site.site_id] = time.monotonic()
+                data = self.get_data(tab)
                 if data and len(data['data']):
                     message = ScrapMessage(
-                        datetime=datetime.now(), data=data['data'])
+                        datetime=datetime.now(), data=data['data'], site_id=site.site_id)
                     self.dispatch_message(message)
             except JavascriptException as js_error:
                 logger.error(js_error)
 
+    def get_data(self, tab: BrowserTab) -> Optional[Dict]:
+        with GET_DATA_SECONDS.time():
+            return tab.execute_script('return __get_data()')
+
     def register_interest(self, thread: AbstractThreadWorker):
         self._interested_threads.append(thread)
 
-    def dispatch_message(self, message: ScrapMessage):
+    def observe(self, message: ScrapMessage):
+        """Tell the scheduler whether the site's values moved"""
+        digest = response_digest(message.data[-1])
+        changed = self._digests.get(message.site_id) != digest
+        self._digests[message.site_id] = digest
+        self.scheduler.observe(message.site_id, changed,
+                               message.datetime.timestamp())
+
+    def dispatch_message(self, message: ScrapMessage, observe: bool = True):
+        """Hand ``message`` to the workers; ``observe`` tells the scheduler
+        whether it answers a poll, as opposed to a re-read of the buffer"""
+        if observe and self.scheduler and message.site_id is not None:
+            self.observe(message)
         for thread in self._interested_threads:
             thread.put_message(message)
 
 
+class CdpScrappingThread(ScrappingThread):
+    """Reads the layout/energy payload from devtools network events
+    instead of the extension buffer"""
+
+    engine = 'cdp'
+
+    refresh_script = (
+        "var element = document.getElementById('ext-comp-1034-button');"
+        "if (element) { element.click() }")
+
+    def __init__(self, *args, **kwargs):
+        ScrappingThread.__init__(self, *args, **kwargs)
+        self.captures: Dict[BrowserSlot, NetworkCapture] = {
+            slot: NetworkCapture(slot) for slot in pool.slots}
+
+    def dispatch_responses(self, site: Site, responses: List[Dict], observe: bool = True):
+        if responses:
+            message = ScrapMessage(
+                datetime=datetime.now(), data=responses, site_id=site.site_id)
+            self.dispatch_message(message, observe)
+
+    def scrap_cycle(self, site: Site):
+        with pool.leased(site_id=site.site_id) as tab:
+            try:
+                if tab.site_id != site.site_id:
+                    self.open_site(tab, site)
+                capture = self.captures[tab.slot]
+                self.dispatch_responses(site, capture.take(site.site_id), observe=False)
+                count = capture.count(site.site_id)
+                tab.execute_script(self.refresh_script)
+                logger.info('scraping site %s %s' % (site.site_id, datetime.now()))
+                if explicit_wait(tab, "NET", [capture, site.site_id, count + 1],
+                                 logger, SCRAP_TIMEOUT, poll_frequency=0.1):
+                    self.last_response[site.site_id] = time.monotonic()
+                self.dispatch_responses(site, capture.take(site.site_id))
+            except JavascriptException as js_error:
+                logger.error(js_error)
+
+
+class HttpScrappingThread(ScrappingThread):
+    """Collects the layout/energy payload without a browser"""
+
+    engine = 'http'
+
+    def __init__(self, *args, client: LayoutEnergyClient = None,
+                 max_concurrency: int = MAX_CONCURRENT_SCRAPS, **kwargs):
+        ScrappingThread.__init__(
+            self, *args, max_concurrency=max_concurrency, **kwargs)
+        self.client = client or LayoutEnergyClient(pool_size=max_concurrency)
+
+    def load_page(self):
+        self.client.warm_up(self.sites[0].url)
+
+    def scrap_cycle(self, site: Site):
+        logger.info('scraping site %s %s' % (site.site_id, datetime.now()))
+        response = self.client.fetch(site.site_id)
+        if not response:
+            return
+        self.last_response[site.site_id] = time.monotonic()
+        if response.get('res', response.get('raw')):
+            message = ScrapMessage(
+                datetime=datetime.now(), data=[response], site_id=site.site_id)
+            self.dispatch_message(message)
+
+
+class BoundedQueue(queue.Queue):
+    """A queue with a size limit and a policy for when it is full:
+    ``block`` makes the producer wait, ``drop_oldest`` discards the oldest
+    queued message to make room"""
+
+    def __init__(self, maxsize: int = QUEUE_MAXSIZE, policy: str = QUEUE_POLICY):
+        if policy not in ('block', 'drop_oldest'):
+            raise ValueError("Unknown queue policy %s" % policy)
+        queue.Queue.__init__(self, maxsize)
+        self.policy = policy
+        self.dropped = 0
+
+    def join(self, timeout: float = None) -> bool:
+        """Wait until every queued message was processed, at most
+        ``timeout`` seconds; False when some are left"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.all_tasks_done:
+            while self.unfinished_tasks:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.all_tasks_done.wait(remaining)
+        return True
+
+    def put_message(self, message: Any):
+        if self.policy == 'block':
+            while True:
+                try:
+                    self.put(message, timeout=1)
+                    return
+                except queue.Full:
+                    if EXIT_SIG:
+                        return
+        while True:
+            try:
+                self.put_nowait(message)
+                return
+            except queue.Full:
+                try:
+                    self.get_nowait()
+                    self.task_done()
+                    self.dropped += 1
+                    logger.warning("Queue full, dropped oldest message (%s so far)" %
+                                   self.dropped)
+                except queue.Empty:
+                    pass
+
+
 class WorkerThread(AbstractThreadWorker, threading.Thread):
-    def __init__(self, role: str, *args, **kwargs):
+    def __init__(self, role: str, *args, storages: List[StorageBackend] = None,
+                 deduplicator: Deduplicator = None, archive: SegmentArchive = None,
+                 message_queue: BoundedQueue = None, rollups: RollupEngine = None,
+                 state: LatestState = None, columnar: bool = COLUMNAR_TRANSFORM, **kwargs):
         threading.Thread.__init__(self, *args, **kwargs)
-        self.queue = queue.Queue()
+        self.queue = message_queue or BoundedQueue()
         self.role = role
+        self.columnar = columnar
+        self.storages = create_storages() if storages is None else storages
+        self.deduplicator = deduplicator or Deduplicator()
+        self.archive = archive or SegmentArchive()
+        if rollups is None and ROLLUPS:
+            rollups = RollupEngine()
+        self.rollups = rollups
+        self.state = state
 
     def run(self):
-        dispatcher_thread.register_interest(self)
         while not EXIT_SIG:
-            time.sleep(1*60)
-            message = self.queue.get()
-            if isinstance(message, ScrapMessage):
-                self.process_message(message)
-
-    def write_csv(self, data: List[Dict], path: str):
-        logger.info("Writing new data to %s" % (path))
-        field_names = list(data[0].keys())
-        try:
-            write_obj = None
-            exits = os.path.exists(path)
-            if exits:
-                write_obj = open(path, 'a+', newline='')
-                dict_writer = DictWriter(write_obj, fieldnames=field_names)
-                dict_writer.writerows(data)
-            else:
-                write_obj = open(path, 'w', newline='')
-                dict_writer = DictWriter(write_obj, fieldnames=field_names)
-                dict_writer.writeheader()
-                dict_writer.writerows(data)
-        except Exception as error:
-            logger.error(error)
-        finally:
-            if write_obj:
-                write_obj.close()
-
-    def get_write_path(self, datetime: datetime):
-        today = datetime.date()
-        root = os.path.join(SCRAP_DATA, str(today))
-        if not os.path.exists(root):
-            os.mkdir(root)
-        csv_path = os.path.join(root, 'processed.csv')
-        dump = os.path.join(root, 'dump')
-        if not os.path.exists(dump):
-            os.mkdir(dump)
-        return csv_path, os.path.join(dump, str(datetime.timestamp()).replace('.', '_')+'.json')
-
-    def dump_json(self, data: Dict, path: str):
+            try:
+                message = self.queue.get(timeout=1)
+            except queue.Empty:
+                self.flush_expired()
+                continue
+            outcome = 'error'
+            try:
+                if isinstance(message, ScrapMessage):
+                    with PROCESS_SECONDS.time(role=self.role):
+                        self.process_message(message)
+                outcome = 'ok'
+            except Exception as error:
+                logger.error("Error processing message, error:%s" % error)
+            finally:
+                MESSAGES.inc(role=self.role, outcome=outcome)
+                self.queue.task_done()
+
+    def dump_json(self, message: ScrapMessage, responses: List[Dict]):
         try:
-            with open(path, 'w') as json_obj:
-                logger.info("Dumping data to  %s" % (path))
-                json.dump(data, json_obj)
+            with ARCHIVE_SECONDS.time():
+                for scrap_response in responses:
+                    self.archive.append(
+                        message.datetime, message.site_id, scrap_response)
         except Exception as e:
+            ARCHIVE_ERRORS.inc()
             logger.error(e)
 
+    def write_storage(self, storage: StorageBackend, data, message: ScrapMessage,
+                      columnar: bool = False):
+        """Hand readings, or PanelColumns when ``columnar``, to ``storage``;
+        a failure is logged and counted so the other storages still get
+        the message"""
+        name = storage.__class__.__name__
+        try:
+            with STORAGE_WRITE_SECONDS.time(storage=name):
+                if columnar:
+                    storage.write_columns(data, message.datetime, message.site_id)
+                else:
+                    storage.write(data, message.datetime, message.site_id)
+        except Exception as error:
+            STORAGE_ERRORS.inc(storage=name)
+            logger.error("Unable to write message of site %s to %s, error:%s" %
+                         (message.site_id, name, error))
+            return
+        STORAGE_ROWS.inc(data.size if columnar else len(data), storage=name)
+
+    def write_storages(self, data, message: ScrapMessage, columnar: bool = False):
+        for storage in self.storages:
+            self.write_storage(storage, data, message, columnar)
+
     def process_message(self, message: ScrapMessage):
+        processed = self.transform(message)
+        if processed:
+            self.store(processed)
+
+    def store(self, processed: ProcessedMessage):
+        # the archive is what backfill rebuilds the storages from
+        try:
+            if processed.data is not None:
+                self.write_storages(processed.data, processed.message, processed.columnar)
+        finally:
+            self.dump_json(processed.message, processed.responses)
+
+    def transform(self, message: ScrapMessage) -> Optional[ProcessedMessage]:
+        """Deduplicate and decode a message and update the rollups and the
+        latest state; writing is left to ``store``"""
         if self.role == 'DATA_PROCESSOR':
             logger.info('Recieved new message %s' % message.__class__.__name__)
-            processed: List[Dict] = []
+            responses: List[Dict] = []
             for scrap_response in message.data:
-                data = scrap_response['res']
-                if data and isinstance(data, dict):
-                    for x, y in data.items():
-                        i = {}
-                        i['panel'] = x
-                        i['energy'] = y['energy']
-                        i['units'] = y['units']
-                        i['unscaledEnergy'] = y['unscaledEnergy']
-                        i['moduleEnergy'] = y['moduleEnergy']
-                        i['relayState'] = y['relayState']
-                        i['date'] = message.datetime
-                        processed.append(i)
+                if self.deduplicator.is_repeat(message.site_id, scrap_response):
+                    logger.info("Skipping repeated response of site %s" %
+                                message.site_id)
+                    continue
+                responses.append(scrap_response)
+            # per panel deltas need the row path
+            if self.columnar and not self.deduplicator.deltas:
+                return self.transform_columns(message, responses)
+            processed: List[PanelReading] = []
+            fresh: List[Dict] = []
+            for scrap_response in responses:
+                try:
+                    readings = decode_response(
+                        scrap_response, message.site_id, message.datetime)
+                except SchemaError as error:
+                    logger.error("Dropping malformed response %s, error:%s" %
+                                 (scrap_response.get('url'), error))
+                    continue
+                if readings:
+                    processed.extend(readings)
+                    fresh.append(scrap_response)
             if len(processed):
-                csv_path, json_path = self.get_write_path(message.datetime)
-                self.write_csv(processed, csv_path)
-                self.dump_json(message.data[0]['res'], json_path)
+                # before the delta filter, rollups count every sample
+                if self.rollups:
+                    self.rollups.add_readings(
+                        processed, message.site_id, message.datetime)
+                if self.state:
+                    self.state.update(message.site_id, processed, message.datetime)
+                changed = self.deduplicator.changed(
+                    processed, message.site_id, message.datetime)
+                return ProcessedMessage(message, changed or None, False, fresh)
+        return None
+
+    def transform_columns(self, message: ScrapMessage,
+                          responses: List[Dict]) -> Optional[ProcessedMessage]:
+        """Columnar ``transform``: responses are validated one by one like
+        on the row path and only those with readings are kept"""
+        batches = []
+        fresh: List[Dict] = []
+        for scrap_response in responses:
+            try:
+                values = response_values(scrap_response)
+            except SchemaError as error:
+                logger.error("Dropping malformed response %s, error:%s" %
+                             (scrap_response.get('url'), error))
+                continue
+            if values:
+                batches.append((values, message.site_id, message.datetime))
+                fresh.append(scrap_response)
+        if not batches:
+            return None
+        try:
+            columns = columns_from_values(batches)
+        except SchemaError as error:
+            logger.error("Dropping malformed message of site %s, error:%s" %
+                         (message.site_id, error))
+            return None
+        if self.rollups:
+            self.rollups.add_columns(columns, message.site_id, message.datetime)
+        if self.state:
+            self.state.update(message.site_id, columns, message.datetime)
+        return ProcessedMessage(message, columns, True, fresh)
 
     def put_message(self, message: Any):
-        self.queue.put(message)
+        self.queue.put_message(message)
 
+    def flush_expired(self):
+        for storage in self.storages:
+            try:
+                storage.flush_expired()
+            except Exception as error:
+                logger.error("Error flushing storage, error:%s" % error)
+
+    def close(self):
+        self.archive.close()
+        if self.rollups:
+            self.rollups.close()
+        for storage in self.storages:
+            try:
+                storage.close()
+            except Exception as error:
+                logger.error("Error closing storage, error:%s" % error)
+
+
+class WorkerPool(AbstractThreadWorker):
+    """``size`` worker threads of one role, each behind its own bounded
+    queue. Messages are routed by site id so every site is processed in
+    order by a single thread, while different sites spread across the
+    pool. Storages, archive, deduplicator, rollups and the latest state
+    are shared by the threads.
+    """
+
+    def __init__(self, role: str, size: int = 1, maxsize: int = QUEUE_MAXSIZE,
+                 policy: str = QUEUE_POLICY, storages: List[StorageBackend] = None,
+                 deduplicator: Deduplicator = None, state: LatestState = None):
+        self.role = role
+        self.storages = create_storages() if storages is None else storages
+        self.archive = SegmentArchive()
+        self.deduplicator = deduplicator or Deduplicator()
+        self.rollups = RollupEngine() if ROLLUPS else None
+        self.workers = [
+            WorkerThread(role, name='%s-%d' % (role, index), storages=self.storages,
+                         deduplicator=self.deduplicator, archive=self.archive,
+                         rollups=self.rollups, state=state,
+                         message_queue=BoundedQueue(maxsize, policy))
+            for index in range(max(1, size))
+        ]
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
 
-class RefreshThread(threading.Thread):
-    def __init__(self, *args, **kwargs):
+    def put_message(self, message: Any):
+        site_id = getattr(message, 'site_id', None)
+        self.workers[hash(site_id) % len(self.workers)].put_message(message)
+
+    def qsize(self) -> int:
+        return sum(worker.queue.qsize() for worker in self.workers)
+
+    def join(self, timeout: float = SHUTDOWN_TIMEOUT) -> bool:
+        """Wait for the queues to drain, False when the timeout passed
+        first"""
+        deadline = time.monotonic() + timeout
+        return all([worker.queue.join(max(0, deadline - time.monotonic()))
+                    for worker in self.workers])
+
+    def join_workers(self, timeout: float = SHUTDOWN_TIMEOUT):
+        """Wait for the threads to leave their loop, once EXIT_SIG is set"""
+        deadline = time.monotonic() + timeout
+        for worker in self.workers:
+            if worker.is_alive():
+                worker.join(max(0, deadline - time.monotonic()))
+
+    def close(self):
+        self.workers[0].close()
+
+
+class HealthThread(threading.Thread):
+    """Probes every browser tab and refreshes only the unhealthy ones.
+
+    A tab is leased before it is probed, so a probe or refresh never runs
+    while the tab is being scraped and a scrape waits for the refresh.
+    """
+
+    def __init__(self, scrapper: ScrappingThread, *args,
+                 interval: float = HEALTH_CHECK_INTERVAL,
+                 stale_after: float = RESPONSE_STALE_AFTER,
+                 heap_limit: int = TAB_HEAP_LIMIT, **kwargs):
+        threading.Thread.__init__(self, *args, **kwargs)
+        self.scrapper = scrapper
+        self.interval = interval
+        self.stale_after = stale_after
+        self.heap_limit = heap_limit
+        self._refreshed: Dict[int, float] = {}
+
+    def run(self):
+        next_check = time.monotonic() + self.interval
+        while not EXIT_SIG:
+            if time.monotonic() < next_check:
+                time.sleep(1)
+                continue
+            self.check_tabs()
+            next_check = time.monotonic() + self.interval
+
+    def check_tabs(self):
+        for tab in pool.tabs:
+            site = self.scrapper.sites_by_id.get(tab.site_id)
+            if site is None or not self.scrapper.owns(site):
+                continue
+            tab = pool.lease_tab(tab, timeout=2*SCRAP_TIMEOUT)
+            if tab is None:
+                logger.warning("Tab of site %s stayed busy, probing it later" %
+                               site.site_id)
+                continue
+            try:
+                # the tab may have been reused for another site meanwhile
+                if tab.site_id == site.site_id:
+                    reason = self.probe(tab, site)
+                    if reason:
+                        HEALTH_FAILURES.inc(probe=reason)
+                        self.refresh(tab, site, reason)
+            finally:
+                pool.release(tab)
+
+    def probe(self, tab: BrowserTab, site: Site) -> Optional[str]:
+        """Name of the first failing probe, None for a healthy tab"""
+        if (self.scrapper.engine != 'cdp'
+                and not self.scrapper.ensure_extension_loaded(tab, notify=False)):
+            return 'extension'
+        last_attempt = self.scrapper.last_attempt.get(site.site_id)
+        last_response = max(self.scrapper.last_response.get(site.site_id, 0),
+                            self._refreshed.get(site.site_id, 0))
+        if (last_attempt and last_attempt > last_response
+                and time.monotonic() - last_response > self.stale_after):
+            return 'stale'
+        try:
+            heap = tab.execute_script(
+                'return performance.memory ? performance.memory.usedJSHeapSize : null')
+        except WebDriverException as error:
+            logger.error("Unable to read js heap of site %s, error:%s" %
+                         (site.site_id, error))
+            return 'unresponsive'
+        if heap is not None:
+            TAB_JS_HEAP.set(heap, site=site.site_id)
+            if heap > self.heap_limit:
+                return 'heap'
+        return None
+
+    def refresh(self, tab: BrowserTab, site: Site, reason: str):
+        outcome = 'error'
+        try:
+            logger.info("Refreshing tab of site %s, failed probe:%s" %
+                        (site.site_id, reason))
+            with REFRESH_SECONDS.time():
+                tab.refresh()
+                self.scrapper.prepare_page(tab, site)
+            logger.info("Tab refreshed")
+            outcome = 'ok'
+        except Exception as e:
+            logger.error("Error refreshing browser, error:%s" % e)
+        finally:
+            self._refreshed[site.site_id] = time.monotonic()
+            REFRESHES.inc(reason=reason, outcome=outcome)
+
+
+class MemoryWatchdog(threading.Thread):
+    """Recycles browsers that grew past ``rss_limit`` or ran longer than
+    ``max_age``.
+
+    All tabs of the browser are leased first, so no scrape is cut short;
+    the worker queues are not involved and keep draining meanwhile.
+    """
+
+    def __init__(self, scrapper: ScrappingThread, *args,
+                 interval: float = WATCHDOG_INTERVAL, rss_limit: int = BROWSER_RSS_LIMIT,
+                 max_age: float = BROWSER_MAX_AGE, **kwargs):
+        threading.Thread.__init__(self, *args, **kwargs)
+        self.scrapper = scrapper
+        self.interval = interval
+        self.rss_limit = rss_limit
+        self.max_age = max_age
+
+    def run(self):
+        next_check = time.monotonic() + self.interval
+        while not EXIT_SIG:
+            if time.monotonic() < next_check:
+                time.sleep(1)
+                continue
+            self.check_browsers()
+            next_check = time.monotonic() + self.interval
+
+    def check_browsers(self):
+        for slot in pool.slots:
+            reason = self.over_limit(slot)
+            if reason:
+                self.recycle(slot, reason)
+
+    def over_limit(self, slot: BrowserSlot) -> Optional[str]:
+        rss = process_tree_rss(slot.pid)
+        if self.rss_limit and rss is not None and rss > self.rss_limit:
+            logger.warning("Browser uses %d MiB, over the %d MiB limit" %
+                           (rss // 2**20, self.rss_limit // 2**20))
+            return 'rss'
+        if self.max_age and slot.age > self.max_age:
+            return 'age'
+        return None
+
+    def recycle(self, slot: BrowserSlot, reason: str):
+        tabs = pool.lease_slot(slot, timeout=2*SCRAP_TIMEOUT)
+        if tabs is None:
+            logger.warning("Browser tabs stayed busy, recycling it later")
+            return
+        outcome = 'error'
+        try:
+            logger.info("Recycling browser, reason:%s" % reason)
+            sites = [(tab, self.scrapper.sites_by_id.get(tab.site_id)) for tab in tabs]
+            with RECYCLE_SECONDS.time():
+                slot.restart()
+                for tab, site in sites:
+                    if site is not None and self.scrapper.owns(site):
+                        self.scrapper.open_site(tab, site)
+            outcome = 'ok'
+        except Exception as e:
+            logger.error("Error recycling browser, error:%s" % e)
+        finally:
+            BROWSER_RECYCLES.inc(reason=reason, outcome=outcome)
+            for tab in tabs:
+                pool.release(tab)
+
+
+class ShardLeaser(threading.Thread):
+    """Keeps the scraper's share of the sites leased in a sharded
+    deployment, heartbeating every ``interval`` seconds.
+
+    When the table cannot be renewed for ``ttl`` seconds the other
+    workers take the sites over, so the scraper stops scraping them too.
+    """
+
+    def __init__(self, scrapper: ScrappingThread, table: LeaseTable, worker_id: str,
+                 *args, interval: float = LEASE_HEARTBEAT, **kwargs):
         threading.Thread.__init__(self, *args, **kwargs)
-        self._log = logging.getLogger('solaredge.bot')
+        self.scrapper = scrapper
+        self.table = table
+        self.worker_id = worker_id
+        self.interval = interval
+        self._renewed = time.monotonic()
 
     def run(self):
+        next_renewal = time.monotonic() + self.interval
         while not EXIT_SIG:
-            time.sleep(10*60)
-            logger.info("Acquiring lock")
-            with lock:
-                logger.info("Lock Acquired")
-                if browser:
-                    try:
-                        logger.info("Refreshing browser")
-                        browser.refresh()
-                        logger.info("Browser refreshed")
-                        web_address_navigator(browser, _url_)
-                    except Exception as e:
-                        logger.error("Error refreshing browser, errpr:%s" % e)
-            logger.info("Lock releashed")
+            if time.monotonic() < next_renewal:
+                time.sleep(1)
+                continue
+            self.renew()
+            next_renewal = time.monotonic() + self.interval
+
+    def renew(self):
+        try:
+            owned = self.table.renew(self.worker_id, self.scrapper.sites_by_id)
+            self._renewed = time.monotonic()
+        except sqlite3.Error as error:
+            logger.error("Unable to renew the site leases, error:%s" % error)
+            if time.monotonic() - self._renewed < self.table.ttl:
+                return
+            owned = set()
+        previous = self.scrapper.owned or set()
+        gained, lost = owned - previous, previous - owned
+        if gained or lost:
+            logger.info("Leased %d sites, gained %s lost %s" %
+                        (len(owned), sorted(gained), sorted(lost)))
+            LEASE_CHANGES.inc(len(gained), change='gained')
+            LEASE_CHANGES.inc(len(lost), change='lost')
+        self.scrapper.owned = owned
+        LEASED_SITES.set(len(owned))
+
+    def release(self):
+        try:
+            self.table.release(self.worker_id)
+        except sqlite3.Error as error:
+            logger.error("Unable to release the site leases, error:%s" % error)
+
+
+def queue_depths() -> Dict[str, int]:
+    return {worker_pool.role: worker_pool.qsize() for worker_pool in worker_pools}
+
+
+def queue_drops() -> Dict[str, int]:
+    return {worker_pool.role: sum(worker.queue.dropped for worker in worker_pool.workers)
+            for worker_pool in worker_pools}
+
+
+def browser_rss() -> Dict[int, Optional[int]]:
+    if pool is None:
+        return {}
+    return {index: process_tree_rss(slot.pid) for index, slot in enumerate(pool.slots)}
+
+
+QUEUE_DEPTH = Gauge('solaredge_queue_depth',
+                    'Messages waiting in the worker queues', ('role',), function=queue_depths)
+QUEUE_DROPPED = Counter('solaredge_queue_dropped_total',
+                        'Messages dropped by full worker queues', ('role',),
+                        function=queue_drops)
+BROWSER_RSS = Gauge('solaredge_browser_rss_bytes',
+                    'Resident memory of a browser and its driver', ('slot',),
+                    function=browser_rss)
 
 
 def terminateProcess(signalNumber, frame):
-    global EXIT_SIG
     print('(SIGTERM)recieved terminating the process gracefully')
-    EXIT_SIG = 1
     exist_gracefully()
 
 
-def exist_gracefully():
-    global browser
-    if browser:
-        browser.quit()
+def exist_gracefully(timeout: float = SHUTDOWN_TIMEOUT):
+    """Stop scraping, let the workers process what is queued, then stop
+    them and close the storages; like AsyncPipeline.shutdown"""
+    global EXIT_SIG
+    deadline = time.monotonic() + timeout
+    if dispatcher_thread:
+        dispatcher_thread.stop()
+        if dispatcher_thread.is_alive():
+            dispatcher_thread.join(timeout)
+    for worker_pool in worker_pools:
+        if not worker_pool.join(max(0, deadline - time.monotonic())):
+            logger.warning("%d messages left unprocessed on shutdown" %
+                           worker_pool.qsize())
+    EXIT_SIG = 1
+    for worker_pool in worker_pools:
+        worker_pool.join_workers(max(0, deadline - time.monotonic()))
+    if leaser:
+        leaser.release()
+    for worker_pool in worker_pools:
+        worker_pool.close()
+    if pool:
+        pool.close()
     sys.exit(0)
 
 
 if __name__ == '__main__':
-    signal.signal(signal.SIGTERM, terminateProcess)
-    signal.signal(signal.SIGINT, terminateProcess)
-    dispatcher_thread = ScrappingThread(name='scrapper')
+    ensure_dirs()
+    create_logger('solaredge')
+    if not ASYNC_PIPELINE:
+        signal.signal(signal.SIGTERM, terminateProcess)
+        signal.signal(signal.SIGINT, terminateProcess)
+    if SCRAP_ENGINE in ('browser', 'cdp'):
+        start_browser_pool()
+    sites = load_sites()
+    if SCRAP_ENGINE == 'http':
+        dispatcher_thread = HttpScrappingThread(name='scrapper', sites=sites)
+    elif SCRAP_ENGINE == 'cdp':
+        dispatcher_thread = CdpScrappingThread(
+            name='scrapper', sites=sites, max_concurrency=pool.capacity)
+    else:
+        dispatcher_thread = ScrappingThread(
+            name='scrapper', sites=sites, max_concurrency=pool.capacity)
+    if SHARD_WORKER_ID:
+        try:
+            leaser = ShardLeaser(dispatcher_thread, LeaseTable(), SHARD_WORKER_ID,
+                                 name='leaser')
+            leaser.renew()
+        except sqlite3.Error as e:
+            logger.error("Unable to open the lease table, error:%s" % e)
+            sys.exit(-1)
+    state = LatestState()
+    for role, size in WORKER_POOL_SIZES.items():
+        worker_pools.append(WorkerPool(role, size, state=state))
+    if METRICS_PORT:
+        MetricsServer().start()
+    if STATE_API_PORT:
+        StateServer(state).start()
+    if ASYNC_PIPELINE:
+        from pipeline import AsyncPipeline
+
+        periodic = []
+        if pool:
+            periodic = [
+                (HEALTH_CHECK_INTERVAL, HealthThread(dispatcher_thread).check_tabs),
+                (WATCHDOG_INTERVAL, MemoryWatchdog(dispatcher_thread).check_browsers),
+            ]
+        if leaser:
+            periodic.append((LEASE_HEARTBEAT, leaser.renew))
+        asyncio.run(AsyncPipeline(dispatcher_thread, worker_pools,
+                                  periodic=periodic).run())
+        if leaser:
+            leaser.release()
+        if pool:
+            pool.close()
+        sys.exit(0)
+    for worker_pool in worker_pools:
+        dispatcher_thread.register_interest(worker_pool)
+        worker_pool.start()
     dispatcher_thread.start()
-    worker_threads = []
-    roles = ['DATA_PROCESSOR']
-    for role in roles:
-        worker_thread = WorkerThread(role, name=role)
-        worker_thread.start()
-        worker_threads.append(worker_thread)
-    refresher = RefreshThread(name='refresher').start()
+    if pool:
+        HealthThread(dispatcher_thread, name='health').start()
+        MemoryWatchdog(dispatcher_thread, name='watchdog').start()
+    if leaser:
+        leaser.start()
     dispatcher_thread.join()
@@ -0,0 +1,238 @@
+import json
+import logging
+import re
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Deque, Dict, List, Optional, Tuple, Union
+from urllib.parse import parse_qs, urlparse
+
+from config import STATE_API_HOST, STATE_API_PORT, STATE_HISTORY
+from records import PanelColumns, PanelReading, orjson
+
+logger = logging.getLogger('solaredge')
+
+Batch = Union[List[PanelReading], PanelColumns]
+
+
+def _default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError("%r is not serializable" % value)
+
+
+def dumps(document) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(document, default=_default)
+    return json.dumps(document, default=_default).encode('utf-8')
+
+
+def _rows(batch: Batch) -> List[PanelReading]:
+    return batch.to_readings() if isinstance(batch, PanelColumns) else batch
+
+
+def _reading(reading: PanelReading) -> Dict:
+    document = reading.as_dict()
+    del document['site'], document['panel']
+    return document
+
+
+class _SiteState:
+    __slots__ = ('version', 'modified', 'batches')
+
+    def __init__(self, history: int):
+        self.version = 0
+        self.modified = 0.0
+        self.batches: Deque[Tuple[datetime, Batch]] = deque(maxlen=history)
+
+
+class LatestState:
+    """Newest readings of every site and panel, plus the last ``history``
+    messages of each site.
+
+    Updates only keep a reference to the batch, readings or columns, so
+    the workers pay nothing for it; documents are built when requested
+    and cached until the site changes again.
+    """
+
+    def __init__(self, history: int = STATE_HISTORY):
+        self.history = max(1, history)
+        self.version = 0
+        self.modified = 0.0
+        self._sites: Dict[Optional[int], _SiteState] = {}
+        self._cache: Dict[Tuple, Tuple[int, bytes]] = {}
+        self._lock = threading.Lock()
+
+    def update(self, site_id: Optional[int], batch: Batch, timestamp: datetime):
+        with self._lock:
+            site = self._sites.get(site_id)
+            if site is None:
+                site = self._sites[site_id] = _SiteState(self.history)
+            site.batches.append((timestamp, batch))
+            site.version += 1
+            site.modified = self.modified = time.time()
+            self.version += 1
+
+    def site_version(self, site_id: Optional[int]) -> Tuple[int, float]:
+        """``(version, modified)`` of a site, (0, 0) when it is unknown"""
+        with self._lock:
+            site = self._sites.get(site_id)
+            return (site.version, site.modified) if site else (0, 0.0)
+
+    def _snapshot(self, site_id) -> Tuple[int, List[Tuple[datetime, Batch]]]:
+        with self._lock:
+            site = self._sites.get(site_id)
+            if site is None:
+                return 0, []
+            return site.version, list(site.batches)
+
+    def sites(self) -> Dict:
+        with self._lock:
+            return {
+                'sites': [{'site': site_id, 'version': site.version,
+                           'updated': site.batches[-1][0]}
+                          for site_id, site in self._sites.items()],
+            }
+
+    def latest(self, site_id: Optional[int]) -> Optional[Dict]:
+        """Newest values of every panel seen in the recent messages"""
+        version, batches = self._snapshot(site_id)
+        if not batches:
+            return None
+        panels: Dict[str, Dict] = {}
+        for _, batch in reversed(batches):
+            for reading in _rows(batch):
+                if reading.panel not in panels:
+                    panels[reading.panel] = _reading(reading)
+        return {'site': site_id, 'version': version,
+                'updated': batches[-1][0], 'panels': panels}
+
+    def recent(self, site_id: Optional[int], panel: Optional[str] = None) -> Optional[Dict]:
+        """Values of the last messages, oldest first, per panel; None for
+        a ``panel`` not in them"""
+        version, batches = self._snapshot(site_id)
+        if not batches:
+            return None
+        panels: Dict[str, List[Dict]] = {}
+        for _, batch in batches:
+            for reading in _rows(batch):
+                if panel is None or reading.panel == panel:
+                    panels.setdefault(reading.panel, []).append(_reading(reading))
+        if panel is not None and not panels:
+            return None
+        return {'site': site_id, 'version': version, 'panels': panels}
+
+    def render(self, kind: str, site_id: Optional[int] = None,
+               panel: Optional[str] = None) -> Optional[bytes]:
+        """The json document, None when the site or panel is unknown. Only
+        documents that exist are cached, so the cache holds at most one
+        entry per known site and panel whatever clients ask for."""
+        if kind != 'history':
+            panel = None
+        key = (kind, site_id, panel)
+        version = self.version if kind == 'sites' else self.site_version(site_id)[0]
+        cached = self._cache.get(key)
+        if cached and cached[0] == version:
+            return cached[1]
+        if kind == 'sites':
+            document = self.sites()
+        elif kind == 'latest':
+            document = self.latest(site_id)
+        else:
+            document = self.recent(site_id, panel)
+        if document is None:
+            return None
+        body = dumps(document)
+        self._cache[key] = (version, body)
+        return body
+
+
+SITE_PATH = re.compile(r'^/sites/(\d+)/(latest|history)$')
+
+
+class _StateHandler(BaseHTTPRequestHandler):
+    """``/sites``, ``/sites/<id>/latest`` and ``/sites/<id>/history[?panel=]``,
+    answering 304 to a matching If-None-Match or If-Modified-Since"""
+
+    state: LatestState = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        panel = parse_qs(url.query).get('panel', [None])[0]
+        if url.path == '/sites':
+            kind, site_id = 'sites', None
+            version, modified = self.state.version, self.state.modified
+        else:
+            match = SITE_PATH.match(url.path)
+            if not match:
+                self.send_error(404)
+                return
+            kind, site_id = match.group(2), int(match.group(1))
+            version, modified = self.state.site_version(site_id)
+            if not version:
+                self.send_error(404, "Unknown site %s" % site_id)
+                return
+        etag = '"%s-%s-%d"' % (kind, site_id, version)
+        last_modified = formatdate(modified, usegmt=True)
+        if self.not_modified(etag, modified):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', last_modified)
+            self.end_headers()
+            return
+        body = self.state.render(kind, site_id, panel)
+        if body is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', last_modified)
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def not_modified(self, etag: str, modified: float) -> bool:
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            return etag in [tag.strip() for tag in if_none_match.split(',')] \
+                or if_none_match.strip() == '*'
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since:
+            try:
+                since = parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+            # http dates have a one second resolution
+            return int(modified) <= since
+        return False
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StateServer(threading.Thread):
+    """Serves a LatestState on http://host:port"""
+
+    def __init__(self, state: LatestState, host: str = STATE_API_HOST,
+                 port: int = STATE_API_PORT):
+        threading.Thread.__init__(self, name='state-api', daemon=True)
+        handler = type('StateHandler', (_StateHandler,), {'state': state})
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+
+    @property
+    def address(self) -> Tuple[str, int]:
+        return self.httpd.server_address[:2]
+
+    def run(self):
+        logger.info("Serving latest readings on http://%s:%s/sites" % self.address)
+        self.httpd.serve_forever()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,467 @@
+import csv
+import io
+import logging
+import os
+import sqlite3
+import threading
+import time
+from abc import ABCMeta, abstractmethod
+from datetime import date, datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from config import (CSV_FLUSH_BYTES, CSV_FLUSH_INTERVAL, CSV_FLUSH_ROWS,
+                    CSV_FSYNC, PARQUET_COMPRESSION, PARQUET_FLUSH_INTERVAL,
+                    PARQUET_PATH, PARQUET_ROW_GROUP_SIZE, SCRAP_DATA,
+                    SQLITE_CHECKPOINT_PAGES, SQLITE_PATH, STORAGE_BACKENDS)
+from records import PanelColumns, PanelReading
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+logger = logging.getLogger('solaredge')
+
+
+class StorageBackend(metaclass=ABCMeta):
+    """Destination for the readings produced by ``process_message``"""
+
+    @abstractmethod
+    def write(self, readings: List[PanelReading], timestamp: datetime, site_id: Optional[int]):
+        raise NotImplementedError()
+
+    def write_columns(self, columns: PanelColumns, timestamp: datetime, site_id: Optional[int]):
+        """Write a columnar batch; backends that can take the arrays
+        directly override this"""
+        self.write(columns.to_readings(), timestamp, site_id)
+
+    def flush(self):
+        """Persist anything buffered"""
+
+    def flush_expired(self):
+        """Persist what the flush policy says is due; called periodically
+        by the workers, so buffers of sites that stopped sending still
+        reach the disk"""
+
+    def close(self):
+        self.flush()
+
+
+_known_folders = set()
+
+
+def day_folder(timestamp: datetime, site_id: Optional[int] = None, *parts: str) -> str:
+    """``scrap_data/<date>[/<site_id>][/<parts>]``, created on first use"""
+    key = (timestamp.date(), site_id) + parts
+    root = os.path.join(SCRAP_DATA, str(key[0]))
+    if site_id is not None:
+        root = os.path.join(root, str(site_id))
+    root = os.path.join(root, *parts)
+    if key not in _known_folders:
+        os.makedirs(root, exist_ok=True)
+        _known_folders.add(key)
+    return root
+
+
+class CsvPartitionWriter:
+    """Keeps one ``processed.csv`` open and buffers rows in memory until
+    the flush policy says otherwise"""
+
+    def __init__(self, path: str, flush_rows: int = CSV_FLUSH_ROWS,
+                 flush_bytes: int = CSV_FLUSH_BYTES,
+                 flush_interval: float = CSV_FLUSH_INTERVAL, fsync: bool = CSV_FSYNC):
+        self.path = path
+        self.flush_rows = flush_rows
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        has_header = os.path.exists(path) and os.path.getsize(path) > 0
+        self._file = open(path, 'a', newline='')
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer)
+        self._rows = 0
+        self._last_flush = time.monotonic()
+        if not has_header:
+            self._writer.writerow(PanelReading.fields)
+
+    def write(self, readings: List[PanelReading]):
+        self._writer.writerows(reading.as_row() for reading in readings)
+        self._rows += len(readings)
+
+    def should_flush(self, now: float) -> bool:
+        return (self._rows >= self.flush_rows
+                or self._buffer.tell() >= self.flush_bytes
+                or (self._rows and now - self._last_flush >= self.flush_interval))
+
+    def flush(self):
+        if self._buffer.tell():
+            logger.info("Writing %s rows to %s" % (self._rows, self.path))
+            self._file.write(self._buffer.getvalue())
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            self._buffer.seek(0)
+            self._buffer.truncate()
+        self._rows = 0
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self._file.close()
+
+
+class CsvStorage(StorageBackend):
+    """Appends readings to ``scrap_data/<date>/<site_id>/processed.csv``
+    through one long lived writer per site and day.
+
+    Writers of a previous day are closed as soon as a reading of a newer
+    day arrives, so files roll over at midnight.
+    """
+
+    def __init__(self, **writer_options):
+        self.writer_options = writer_options
+        self._writers: Dict[Tuple[Optional[int], date], CsvPartitionWriter] = {}
+        self._day: Optional[date] = None
+        self._lock = threading.Lock()
+
+    def get_write_path(self, timestamp: datetime, site_id: Optional[int]) -> str:
+        return os.path.join(day_folder(timestamp, site_id), 'processed.csv')
+
+    def write(self, readings: List[PanelReading], timestamp: datetime, site_id: Optional[int]):
+        key = (site_id, timestamp.date())
+        with self._lock:
+            try:
+                if self._day is None or key[1] > self._day:
+                    self._roll_over(key[1])
+                writer = self._writers.get(key)
+                if writer is None:
+                    writer = self._writers[key] = CsvPartitionWriter(
+                        self.get_write_path(timestamp, site_id), **self.writer_options)
+                writer.write(readings)
+                self._flush_expired()
+            except Exception as error:
+                logger.error(error)
+
+    def _flush_expired(self):
+        now = time.monotonic()
+        for partition_writer in self._writers.values():
+            if partition_writer.should_flush(now):
+                partition_writer.flush()
+
+    def flush_expired(self):
+        with self._lock:
+            try:
+                self._flush_expired()
+            except Exception as error:
+                logger.error(error)
+
+    def _roll_over(self, day: date):
+        self._day = day
+        for key in [key for key in self._writers if key[1] < day]:
+            self._writers.pop(key).close()
+
+    def flush(self):
+        with self._lock:
+            for writer in self._writers.values():
+                writer.flush()
+
+    def close(self):
+        with self._lock:
+            while self._writers:
+                _, writer = self._writers.popitem()
+                try:
+                    writer.close()
+                except Exception as error:
+                    logger.error(error)
+
+
+class ParquetStorage(StorageBackend):
+    """Buffers readings per site and day and writes them as Arrow record
+    batches into ``parquet/site=<id>/day=<day>/part-*.parquet``.
+
+    The site is only stored in the hive style partition path, so datasets
+    opened with ``partitioning='hive'`` get it back as a column.
+
+    A partition is flushed into a new part file once it holds
+    ``row_group_size`` rows or its oldest row is ``flush_interval`` seconds
+    old, whether or not more rows arrive, so a crash loses at most one
+    interval of data. A partition that cannot be written keeps its rows
+    and is retried no sooner than ``flush_interval`` seconds later.
+    """
+
+    def __init__(self, root: str = PARQUET_PATH, row_group_size: int = PARQUET_ROW_GROUP_SIZE,
+                 flush_interval: float = PARQUET_FLUSH_INTERVAL,
+                 compression: str = PARQUET_COMPRESSION):
+        if pa is None:
+            raise RuntimeError("pyarrow is required for the parquet storage")
+        self.root = root
+        self.row_group_size = row_group_size
+        self.flush_interval = flush_interval
+        self.compression = compression
+        self.schema = pa.schema([
+            ('panel', pa.dictionary(pa.int32(), pa.string())),
+            ('energy', pa.float64()),
+            ('units', pa.dictionary(pa.int8(), pa.string())),
+            ('unscaledEnergy', pa.float64()),
+            ('moduleEnergy', pa.float64()),
+            ('relayState', pa.dictionary(pa.int8(), pa.string())),
+            ('date', pa.timestamp('us')),
+        ])
+        self._buffers: Dict[Tuple[Optional[int], date], List['pa.RecordBatch']] = {}
+        self._rows: Dict[Tuple[Optional[int], date], int] = {}
+        self._started: Dict[Tuple[Optional[int], date], float] = {}
+        # monotonic time of the last failed write per partition
+        self._failed: Dict[Tuple[Optional[int], date], float] = {}
+        self._parts = 0
+        self._lock = threading.Lock()
+
+    def write(self, readings: List[PanelReading], timestamp: datetime, site_id: Optional[int]):
+        if readings:
+            self.write_columns(PanelColumns.from_readings(readings),
+                               timestamp, site_id)
+
+    def write_columns(self, columns: PanelColumns, timestamp: datetime, site_id: Optional[int]):
+        key = (site_id, timestamp.date())
+        batch = self.to_record_batch(columns)
+        with self._lock:
+            self._buffers.setdefault(key, []).append(batch)
+            self._rows[key] = self._rows.get(key, 0) + batch.num_rows
+            self._started.setdefault(key, time.monotonic())
+            self._flush_expired(key[1])
+
+    def _flush_expired(self, day: Optional[date] = None):
+        now = time.monotonic()
+        for partition in list(self._buffers):
+            if now - self._failed.get(partition, now - self.flush_interval) < self.flush_interval:
+                continue
+            if ((day is not None and partition[1] != day)
+                    or self._rows[partition] >= self.row_group_size
+                    or now - self._started[partition] >= self.flush_interval):
+                self._flush_partition(partition)
+
+    def flush_expired(self):
+        with self._lock:
+            self._flush_expired()
+
+    def flush(self):
+        with self._lock:
+            for partition in list(self._buffers):
+                self._flush_partition(partition)
+
+    def to_record_batch(self, columns: PanelColumns) -> 'pa.RecordBatch':
+        def dictionary(codes, categories, field):
+            index_type = field.type.index_type
+            indices = pa.array(codes, mask=codes < 0).cast(index_type)
+            return pa.DictionaryArray.from_arrays(
+                indices, pa.array(categories, type=pa.string()))
+
+        schema = self.schema
+        arrays = [
+            dictionary(columns.panel, columns.panel_categories, schema.field('panel')),
+            pa.array(columns.energy, from_pandas=True),
+            dictionary(columns.units, columns.units_categories, schema.field('units')),
+            pa.array(columns.unscaledEnergy, from_pandas=True),
+            pa.array(columns.moduleEnergy, from_pandas=True),
+            dictionary(columns.relayState, columns.relayState_categories,
+                       schema.field('relayState')),
+            pa.array(columns.date, type=pa.timestamp('us')),
+        ]
+        return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+    def partition_path(self, site_id: Optional[int], day: date) -> str:
+        path = os.path.join(self.root, 'site=%s' % site_id, 'day=%s' % day)
+        if not os.path.exists(path):
+            os.makedirs(path)
+        return path
+
+    def _flush_partition(self, partition: Tuple[Optional[int], date]):
+        batches = self._buffers.pop(partition, None)
+        rows = self._rows.pop(partition, 0)
+        self._started.pop(partition, None)
+        if not batches:
+            return
+        site_id, day = partition
+        self._parts += 1
+        path = os.path.join(self.root, 'site=%s' % site_id, 'day=%s' % day,
+                            'part-%s-%d.parquet' % (datetime.now().strftime('%H%M%S%f'),
+                                                    self._parts))
+        try:
+            self.partition_path(site_id, day)
+            table = pa.Table.from_batches(batches).unify_dictionaries()
+            pq.write_table(table, path, row_group_size=self.row_group_size,
+                           compression=self.compression)
+            logger.info("Writing %s rows to %s" % (rows, path))
+        except (pa.ArrowException, OSError, TypeError, ValueError) as error:
+            logger.error("Unable to write %s rows to %s, keeping them for a retry, error:%s" %
+                         (rows, path, error))
+            try:
+                # a part file cut short by the failure
+                if os.path.exists(path):
+                    os.remove(path)
+            except OSError:
+                pass
+            self._buffers[partition] = batches
+            self._rows[partition] = rows
+            self._started[partition] = self._failed[partition] = time.monotonic()
+            return
+        self._failed.pop(partition, None)
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            for (site_id, day), rows in self._rows.items():
+                logger.error("Dropping %s unwritten rows of site %s on %s" % (rows, site_id, day))
+
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS panels (
+    id INTEGER PRIMARY KEY,
+    site INTEGER,
+    name TEXT NOT NULL,
+    UNIQUE (site, name)
+);
+CREATE TABLE IF NOT EXISTS readings (
+    site INTEGER,
+    panel INTEGER NOT NULL REFERENCES panels (id),
+    ts INTEGER NOT NULL,
+    energy REAL,
+    units TEXT,
+    unscaledEnergy REAL,
+    moduleEnergy REAL,
+    relayState TEXT
+);
+CREATE INDEX IF NOT EXISTS readings_site_panel_ts ON readings (site, panel, ts);
+"""
+SQLITE_COLUMNS = 'r.ts, r.energy, r.units, r.unscaledEnergy, r.moduleEnergy, r.relayState'
+
+
+def _labels(codes, categories: Sequence[str]) -> List[Optional[str]]:
+    return [None if code < 0 else categories[code] for code in codes.tolist()]
+
+
+class SqliteStorage(StorageBackend):
+    """Inserts readings into the ``readings`` table of a SQLite database in
+    WAL mode, every message in a single transaction.
+
+    Panels are stored as ids into the ``panels`` dictionary table and
+    ``ts`` holds the microseconds since 1970-01-01 of the reading's local
+    time, like the parquet timestamps, so ``snapshot`` and ``panel_range``
+    are seeks on the (site, panel, ts) index. WAL lets readers query while
+    the workers write; synchronous=NORMAL may lose the last transactions on
+    a power failure but never corrupts the database, FULL is used with
+    SOLAREDGE_FSYNC. The readings of a message spread over many index pages,
+    so the WAL is only checkpointed, and synced, every ``checkpoint_pages``
+    pages rather than SQLite's default 1000.
+    """
+
+    def __init__(self, path: str = SQLITE_PATH, fsync: bool = CSV_FSYNC,
+                 checkpoint_pages: int = SQLITE_CHECKPOINT_PAGES):
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.path = path
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=%s' % ('FULL' if fsync else 'NORMAL'))
+        self._connection.execute('PRAGMA wal_autocheckpoint=%d' % checkpoint_pages)
+        self._connection.executescript(SQLITE_SCHEMA)
+        self._panels: Dict[Tuple[Optional[int], str], int] = {}
+        self._lock = threading.Lock()
+
+    def write(self, readings: List[PanelReading], timestamp: datetime, site_id: Optional[int]):
+        self._insert(site_id, [
+            (reading.panel, (reading.date - EPOCH) // MICROSECOND, reading.energy,
+             reading.units, reading.unscaledEnergy, reading.moduleEnergy,
+             reading.relayState)
+            for reading in readings])
+
+    def write_columns(self, columns: PanelColumns, timestamp: datetime, site_id: Optional[int]):
+        # NaN is bound as NULL
+        self._insert(site_id, list(zip(
+            _labels(columns.panel, columns.panel_categories),
+            columns.date.astype('int64').tolist(), columns.energy.tolist(),
+            _labels(columns.units, columns.units_categories),
+            columns.unscaledEnergy.tolist(), columns.moduleEnergy.tolist(),
+            _labels(columns.relayState, columns.relayState_categories))))
+
+    def _insert(self, site_id: Optional[int], rows: List[Tuple]):
+        """``rows`` of (panel name, ts, values...)"""
+        if not rows:
+            return
+        with self._lock:
+            try:
+                with self._connection:
+                    cursor = self._connection.cursor()
+                    ids = self._panel_ids(cursor, site_id, {row[0] for row in rows})
+                    cursor.executemany(
+                        'INSERT INTO readings VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                        [(site_id, ids[row[0]]) + row[1:] for row in rows])
+            except sqlite3.Error as error:
+                # ids handed out by the rolled back transaction are void
+                self._panels.clear()
+                logger.error("Unable to write %s readings of site %s to %s, error:%s" %
+                             (len(rows), site_id, self.path, error))
+
+    def _panel_ids(self, cursor: sqlite3.Cursor, site_id: Optional[int],
+                   names: Iterable[str]) -> Dict[str, int]:
+        ids = {}
+        for name in names:
+            key = (site_id, name)
+            panel_id = self._panels.get(key)
+            if panel_id is None:
+                cursor.execute('INSERT OR IGNORE INTO panels (site, name) VALUES (?, ?)', key)
+                panel_id = self._panels[key] = cursor.execute(
+                    'SELECT id FROM panels WHERE site IS ? AND name = ?', key).fetchone()[0]
+            ids[name] = panel_id
+        return ids
+
+    def _query(self, site_id: int, sql: str, parameters: Tuple) -> List[PanelReading]:
+        with self._lock:
+            rows = self._connection.execute(sql, parameters).fetchall()
+        return [PanelReading(site_id, name, energy, units, unscaled, module, relay,
+                             EPOCH + ts * MICROSECOND)
+                for name, ts, energy, units, unscaled, module, relay in rows]
+
+    def snapshot(self, site_id: int, at: datetime) -> List[PanelReading]:
+        """Newest reading of every panel of ``site_id`` at or before ``at``"""
+        return self._query(site_id, (
+            'SELECT p.name, %s FROM panels p JOIN readings r ON r.rowid = ('
+            'SELECT rowid FROM readings WHERE site = p.site AND panel = p.id AND ts <= ? '
+            'ORDER BY ts DESC LIMIT 1) WHERE p.site = ? ORDER BY p.name' % SQLITE_COLUMNS),
+            ((at - EPOCH) // MICROSECOND, site_id))
+
+    def panel_range(self, site_id: int, panel: str, start: datetime,
+                    end: datetime) -> List[PanelReading]:
+        """Readings of one panel from ``start`` up to ``end`` excluded,
+        oldest first"""
+        return self._query(site_id, (
+            'SELECT p.name, %s FROM panels p JOIN readings r '
+            'ON r.site = p.site AND r.panel = p.id '
+            'WHERE p.site = ? AND p.name = ? AND r.ts >= ? AND r.ts < ? '
+            'ORDER BY r.ts' % SQLITE_COLUMNS),
+            (site_id, panel, (start - EPOCH) // MICROSECOND, (end - EPOCH) // MICROSECOND))
+
+    def close(self):
+        with self._lock:
+            try:
+                self._connection.execute('PRAGMA optimize')
+            finally:
+                self._connection.close()
+
+
+STORAGES = {
+    'csv': CsvStorage,
+    'parquet': ParquetStorage,
+    'sqlite': SqliteStorage,
+}
+
+
+def create_storages(names: List[str] = STORAGE_BACKENDS) -> List[StorageBackend]:
+    return [STORAGES[name.strip()]() for name in names if name.strip()]
@@ -0,0 +1,112 @@
+import gzip
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import storage  # noqa: E402
+from archive import (INDEX_NAME, SEGMENT_NAMES, ArchiveReader, SegmentArchive,  # noqa: E402
+                     _compress, encode_record, iter_dumps, zstandard)
+
+DATE = datetime(2020, 6, 1, 12)
+SITE = 7
+
+
+class ArchiveTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        patcher = mock.patch.object(storage, 'SCRAP_DATA', self.root)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        storage._known_folders.clear()
+        self.addCleanup(storage._known_folders.clear)
+        self.folder = os.path.join(self.root, str(DATE.date()), str(SITE))
+
+    def archive(self, *records, compression='gzip'):
+        archive = SegmentArchive(compression)
+        for timestamp, response in records:
+            archive.append(timestamp, SITE, response)
+        archive.close()
+        return ArchiveReader(self.folder)
+
+
+class EncodingTest(ArchiveTestCase):
+
+    def test_raw_body_with_newlines(self):
+        body = b'{\n  "p1": {"energy": 1.5},\n  "p2": {"units": "a\\nb"}\n}\n'
+        reader = self.archive((DATE, {'raw': body, 'url': 'u'}),
+                              (DATE + timedelta(seconds=30), {'raw': b'{"p3": 1}', 'url': 'v'}))
+        self.assertEqual([record['res'] for record in reader], [json.loads(body), {'p3': 1}])
+        self.assertEqual(reader.read(DATE), [{'ts': DATE.timestamp(), 'url': 'u',
+                                              'res': json.loads(body)}])
+
+
+
+def response(index: int) -> dict:
+    return {'res': {'p%d' % index: {'energy': float(index)}}, 'url': 'u%d' % index}
+
+
+class SegmentTest(ArchiveTestCase):
+
+    def compressions(self):
+        return ['gzip'] + (['zstd'] if zstandard else [])
+
+    def test_read_by_timestamp(self):
+        for compression in self.compressions():
+            with self.subTest(compression=compression):
+                later = DATE + timedelta(seconds=30)
+                reader = self.archive((DATE, response(1)), (DATE, response(2)),
+                                      (later, response(3)), compression=compression)
+                self.assertEqual(reader.timestamps(), [DATE.timestamp(), later.timestamp()])
+                self.assertEqual([record['url'] for record in reader.read(DATE)], ['u1', 'u2'])
+                self.assertEqual([record['res'] for record in reader.read(later.timestamp())],
+                                 [response(3)['res']])
+                self.assertEqual([record['url'] for record in reader], ['u1', 'u2', 'u3'])
+                shutil.rmtree(self.folder)
+                storage._known_folders.clear()
+
+    def test_reopen_appends(self):
+        self.archive((DATE, response(1)))
+        reader = self.archive((DATE + timedelta(seconds=30), response(2)))
+        self.assertEqual([record['url'] for record in reader], ['u1', 'u2'])
+
+    def test_torn_tail(self):
+        self.archive((DATE, response(1)), (DATE + timedelta(seconds=30), response(2)))
+        data_path = os.path.join(self.folder, SEGMENT_NAMES['gzip'])
+        index_path = os.path.join(self.folder, INDEX_NAME)
+        size = os.path.getsize(data_path)
+        member = _compress(encode_record(DATE + timedelta(seconds=60), response(3)), 'gzip')
+        # killed while appending a member and its index line
+        with open(data_path, 'ab') as data_obj:
+            data_obj.write(member[:len(member) // 2])
+        with open(index_path, 'a') as index_obj:
+            index_obj.write('%.6f %d' % (DATE.timestamp() + 60, size))
+        self.assertEqual([record['url'] for record in ArchiveReader(self.folder)], ['u1', 'u2'])
+
+        reader = self.archive((DATE + timedelta(seconds=90), response(4)))
+        self.assertEqual([record['url'] for record in reader], ['u1', 'u2', 'u4'])
+        self.assertEqual(reader.read(DATE + timedelta(seconds=90))[0]['url'], 'u4')
+        with gzip.open(data_path, 'rb') as data_obj:
+            self.assertEqual(len(data_obj.read().splitlines()), 3)
+
+    def test_iter_dumps_raw_and_parsed(self):
+        self.archive((DATE, {'raw': b'{"p1": {"energy": 1.5}}', 'url': 'a"b'}),
+                     (DATE, response(2)))
+        parsed = list(iter_dumps(self.folder, raw=False))
+        raw = list(iter_dumps(self.folder, raw=True))
+        self.assertEqual([timestamp for timestamp, _ in raw], [DATE, DATE])
+        self.assertEqual([r['url'] for _, r in raw], ['a"b', 'u2'])
+        self.assertEqual([json.loads(r['raw']) for _, r in raw], [r['res'] for _, r in parsed])
+        self.assertEqual(raw[0][1]['raw'], b'{"p1": {"energy": 1.5}}')
+
+
+if __name__ == '__main__':
+    unittest.main()
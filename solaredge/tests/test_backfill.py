@@ -0,0 +1,111 @@
+import csv
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from backfill import _merge_database, discover_units  # noqa: E402
+from records import PanelReading  # noqa: E402
+from storage import SqliteStorage  # noqa: E402
+
+DATE = datetime(2020, 6, 1, 12)
+
+SEED = """
+import sys
+from archive import SegmentArchive
+from benchmark import synthetic_messages
+from config import ensure_dirs
+from scrapper import ScrapMessage
+ensure_dirs()
+archive = SegmentArchive()
+for message in synthetic_messages(ScrapMessage, 20, 4, 2, 0.5, bool(int(sys.argv[1]))):
+    for response in message.data:
+        archive.append(message.datetime, message.site_id, response)
+archive.close()
+"""
+
+
+def readings(site_id: int, energy: float, date: datetime):
+    return [PanelReading(site_id, panel, energy, 'Wh', energy, energy, None, date)
+            for panel in ('p1', 'p2')]
+
+
+class MergeDatabaseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.target = os.path.join(self.folder, 'readings.db')
+        self.staging = os.path.join(self.folder, 'staging.db')
+
+    def write(self, path, *batches):
+        database = SqliteStorage(path=path, fsync=False)
+        for site_id, energy, date in batches:
+            database.write(readings(site_id, energy, date), date, site_id)
+        database.close()
+
+    def rows(self):
+        connection = sqlite3.connect(self.target)
+        self.addCleanup(connection.close)
+        return sorted(connection.execute(
+            'SELECT r.site, p.name, r.ts, r.energy FROM readings r '
+            'JOIN panels p ON p.id = r.panel').fetchall())
+
+    def test_replaces_the_day_of_the_site_only(self):
+        next_day = DATE + timedelta(days=1)
+        self.write(self.target, (1, 1.0, DATE), (1, 1.0, DATE + timedelta(minutes=5)),
+                   (1, 1.0, next_day), (2, 1.0, DATE))
+        self.write(self.staging, (1, 9.0, DATE))
+        _merge_database(self.staging, self.target, str(DATE.date()), 1)
+        rows = self.rows()
+        self.assertEqual([(site, panel, energy) for site, panel, _, energy in rows],
+                         [(1, 'p1', 9.0), (1, 'p1', 1.0), (1, 'p2', 9.0), (1, 'p2', 1.0),
+                          (2, 'p1', 1.0), (2, 'p2', 1.0)])
+        _merge_database(self.staging, self.target, str(DATE.date()), 1)
+        self.assertEqual(self.rows(), rows)
+
+    def test_creates_the_target(self):
+        self.write(self.staging, (None, 2.0, DATE))
+        _merge_database(self.staging, self.target, str(DATE.date()), None)
+        self.assertEqual([(site, energy) for site, _, _, energy in self.rows()],
+                         [(None, 2.0), (None, 2.0)])
+
+
+class BackfillTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.data)
+        self.env = dict(os.environ, SOLAREDGE_DATA=self.data,
+                        SOLAREDGE_LOGS=os.path.join(self.data, 'logs'))
+
+    def run_python(self, *args):
+        subprocess.run([sys.executable] + list(args), cwd=ROOT, env=self.env, check=True,
+                       stdout=subprocess.DEVNULL)
+
+    def test_rebuild_is_repeatable(self):
+        self.run_python('-c', SEED, '1')
+        scrap_data = os.path.join(self.data, 'scrap_data')
+        units = discover_units(scrap_data, 'site')
+        self.assertEqual([(unit.day, unit.folders[0][1]) for unit in units],
+                         [('2020-06-01', 0), ('2020-06-01', 1)])
+        for _ in range(2):
+            self.run_python('backfill.py', '--storage', 'csv,sqlite', '--jobs', '1', '--force')
+            connection = sqlite3.connect(os.path.join(self.data, 'readings.db'))
+            count = connection.execute('SELECT COUNT(*) FROM readings').fetchone()[0]
+            connection.close()
+            self.assertEqual(count, 20 * 4)
+            with open(os.path.join(scrap_data, '2020-06-01', '1', 'processed.csv')) as csv_obj:
+                self.assertEqual(len(list(csv.reader(csv_obj))), 1 + 10 * 4)
+        self.assertFalse([name for name in os.listdir(self.data) if '.backfill' in name])
+
+
+if __name__ == '__main__':
+    unittest.main()
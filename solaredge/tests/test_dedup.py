@@ -0,0 +1,60 @@
+import os
+import sys
+import unittest
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dedup import Deduplicator, response_digest  # noqa: E402
+from records import PanelReading  # noqa: E402
+
+DATE = datetime(2020, 6, 1, 12)
+
+
+def reading(panel: str, energy: float) -> PanelReading:
+    return PanelReading(1, panel, energy, 'Wh', energy, energy, None, DATE)
+
+
+class DeduplicatorTest(unittest.TestCase):
+
+    def test_raw_and_parsed_digests(self):
+        self.assertEqual(response_digest({'res': {'a': 1, 'b': 2}}),
+                         response_digest({'res': {'b': 2, 'a': 1}}))
+        self.assertEqual(response_digest({'raw': '{"a": 1}'}),
+                         response_digest({'raw': b'{"a": 1}'}))
+
+    def test_repeats_are_per_site(self):
+        deduplicator = Deduplicator(repeats=True, deltas=False)
+        response = {'res': {'p1': {'energy': 1}}}
+        self.assertFalse(deduplicator.is_repeat(1, response))
+        self.assertTrue(deduplicator.is_repeat(1, response))
+        self.assertFalse(deduplicator.is_repeat(2, response))
+        self.assertFalse(deduplicator.is_repeat(1, {'res': {'p1': {'energy': 2}}}))
+        self.assertFalse(Deduplicator(repeats=False).is_repeat(1, response))
+
+    def test_deltas_keep_changed_panels(self):
+        deduplicator = Deduplicator(deltas=True, snapshot_interval=60)
+        first = deduplicator.changed([reading('p1', 1.0), reading('p2', 2.0)], 1, DATE)
+        self.assertEqual([r.panel for r in first], ['p1', 'p2'])
+        later = DATE + timedelta(minutes=5)
+        changed = deduplicator.changed([reading('p1', 1.0), reading('p2', 3.0)], 1, later)
+        self.assertEqual([r.panel for r in changed], ['p2'])
+        self.assertEqual(deduplicator.changed([reading('p1', 1.0)], 1, later), [])
+
+    def test_deltas_snapshot_everything_when_due(self):
+        deduplicator = Deduplicator(deltas=True, snapshot_interval=60)
+        readings = [reading('p1', 1.0), reading('p2', 2.0)]
+        deduplicator.changed(readings, 1, DATE)
+        self.assertEqual(deduplicator.changed(readings, 1, DATE + timedelta(minutes=59)), [])
+        self.assertEqual(deduplicator.changed(readings, 1, DATE + timedelta(minutes=60)),
+                         readings)
+
+    def test_without_deltas_everything_is_kept(self):
+        readings = [reading('p1', 1.0)]
+        deduplicator = Deduplicator(deltas=False)
+        deduplicator.changed(readings, 1, DATE)
+        self.assertEqual(deduplicator.changed(readings, 1, DATE), readings)
+
+
+if __name__ == '__main__':
+    unittest.main()
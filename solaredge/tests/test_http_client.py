@@ -0,0 +1,104 @@
+import json
+import os
+import sys
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import LAYOUT_ENERGY_PATH, Site  # noqa: E402
+from http_client import LayoutEnergyClient  # noqa: E402
+
+PAYLOAD = {'siteId': 1, 'panels': [{'id': 'p1', 'energy': 12.5}]}
+OK_SITE, FAILING_SITE, GARBLED_SITE = 1, 2, 3
+
+
+class LayoutEnergyHandler(BaseHTTPRequestHandler):
+    """Stand-in for the layout/energy endpoint"""
+
+    def do_POST(self):
+        self.server.requests.append(self.path)
+        if self.path.startswith(LAYOUT_ENERGY_PATH.format(site_id=OK_SITE)):
+            self.reply(200, json.dumps(PAYLOAD).encode('utf-8'))
+        elif self.path.startswith(LAYOUT_ENERGY_PATH.format(site_id=GARBLED_SITE)):
+            self.reply(200, b'<html>maintenance</html>')
+        else:
+            self.reply(500, b'{}')
+
+    def reply(self, status: int, body: bytes):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class LayoutEnergyClientTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), LayoutEnergyHandler)
+        cls.server.requests = []
+        cls.thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.thread.start()
+        cls.base_url = 'http://127.0.0.1:%d' % cls.server.server_address[1]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        cls.thread.join()
+
+    def client(self, raw: bool) -> LayoutEnergyClient:
+        client = LayoutEnergyClient(base_url=self.base_url, pool_size=2,
+                                    timeout=5, raw=raw)
+        self.addCleanup(client.close)
+        return client
+
+    def test_fetch_parsed(self):
+        response = self.client(raw=False).fetch(OK_SITE)
+        self.assertEqual(response, {'res': PAYLOAD,
+                                    'url': LAYOUT_ENERGY_PATH.format(site_id=OK_SITE)})
+        self.assertIn('timeUnit=ALL', self.server.requests[-1])
+
+    def test_fetch_raw(self):
+        response = self.client(raw=True).fetch(OK_SITE)
+        self.assertEqual(set(response), {'raw', 'url'})
+        self.assertIsInstance(response['raw'], bytes)
+        self.assertEqual(json.loads(response['raw']), PAYLOAD)
+        self.assertEqual(response['url'], LAYOUT_ENERGY_PATH.format(site_id=OK_SITE))
+
+    def test_fetch_http_error(self):
+        self.assertIsNone(self.client(raw=False).fetch(FAILING_SITE))
+        self.assertIsNone(self.client(raw=True).fetch(FAILING_SITE))
+
+    def test_fetch_invalid_json(self):
+        self.assertIsNone(self.client(raw=False).fetch(GARBLED_SITE))
+
+    def test_fetch_unreachable(self):
+        client = LayoutEnergyClient(base_url='http://127.0.0.1:1', timeout=1, raw=False)
+        self.addCleanup(client.close)
+        self.assertIsNone(client.fetch(OK_SITE))
+
+    def test_scrap_cycle_dispatches_response(self):
+        from scrapper import HttpScrappingThread
+
+        messages = []
+        for site_id, expected in ((OK_SITE, True), (FAILING_SITE, False)):
+            thread = HttpScrappingThread(sites=[Site(site_id=site_id, name='test')],
+                                         client=self.client(raw=False))
+            thread.dispatch_message = messages.append
+            thread.scrap_cycle(thread.sites[0])
+            self.assertEqual(site_id in thread.last_response, expected)
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(messages[0].site_id, OK_SITE)
+        self.assertEqual(messages[0].data, [{'res': PAYLOAD, 'url': LAYOUT_ENERGY_PATH.format(
+            site_id=OK_SITE)}])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import leases  # noqa: E402
+from leases import LeaseTable  # noqa: E402
+
+SITES = range(1, 11)
+
+
+class LeaseTableTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.path = os.path.join(self.folder, 'leases.db')
+
+    def table(self, ttl: float = 45) -> LeaseTable:
+        table = LeaseTable(self.path, ttl=ttl)
+        self.addCleanup(table.close)
+        return table
+
+    def test_sites_are_split_without_overlap(self):
+        first, second = self.table(), self.table()
+        first.register('a')
+        second.register('b')
+        owned_a = first.renew('a', SITES)
+        owned_b = second.renew('b', SITES)
+        self.assertEqual(len(owned_a), 5)
+        self.assertEqual(owned_a | owned_b, set(SITES))
+        self.assertFalse(owned_a & owned_b)
+        self.assertEqual(first.assignments(), {'a': 5, 'b': 5})
+
+    def test_lone_worker_hands_back_its_excess(self):
+        table = self.table()
+        self.assertEqual(table.renew('a', SITES), set(SITES))
+        table.register('b')
+        owned_a = table.renew('a', SITES)
+        self.assertEqual(len(owned_a), 5)
+        self.assertEqual(table.renew('b', SITES), set(SITES) - owned_a)
+
+    def test_release_frees_the_sites(self):
+        table = self.table()
+        table.register('a')
+        table.register('b')
+        table.renew('a', SITES)
+        table.release('a')
+        self.assertEqual(table.renew('b', SITES), set(SITES))
+        self.assertEqual(table.assignments(), {'b': 10})
+
+    def test_silent_worker_loses_its_sites(self):
+        table = self.table(ttl=10)
+        with mock.patch.object(leases.time, 'time', return_value=1000.0):
+            table.register('b')
+            owned_a = table.renew('a', SITES)
+        self.assertEqual(len(owned_a), 5)
+        with mock.patch.object(leases.time, 'time', return_value=1011.0):
+            self.assertEqual(table.renew('b', SITES), set(SITES))
+
+    def test_removed_sites_are_dropped(self):
+        table = self.table()
+        table.renew('a', SITES)
+        self.assertEqual(table.renew('a', range(1, 4)), {1, 2, 3})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+import itertools
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from selenium.common.exceptions import NoSuchWindowException, WebDriverException  # noqa: E402
+
+from local_browser import BrowserPool  # noqa: E402
+
+
+class FakeSwitch:
+    def __init__(self, driver):
+        self.driver = driver
+
+    def window(self, handle):
+        if handle not in self.driver.handles:
+            raise NoSuchWindowException(handle)
+        self.driver.current = handle
+
+
+class FakeDriver:
+    """Just enough of a WebDriver for the pool; windows in ``hung`` time
+    out on every script"""
+
+    names = itertools.count(1)
+
+    def __init__(self):
+        self.handles = ['w%d' % next(self.names)]
+        self.current = self.handles[0]
+        self.hung = set()
+        self.quit_called = False
+        self.switch_to = FakeSwitch(self)
+
+    @property
+    def window_handles(self):
+        if self.quit_called:
+            raise WebDriverException('session deleted')
+        return list(self.handles)
+
+    def execute_script(self, script, *args):
+        if self.current in self.hung:
+            raise WebDriverException('script timeout')
+        if 'window.open' in script:
+            self.handles.append('w%d' % next(self.names))
+        return 'complete'
+
+    def close(self):
+        self.handles.remove(self.current)
+
+    def quit(self):
+        self.quit_called = True
+
+
+class PoolTestCase(unittest.TestCase):
+
+    def pool(self, tabs_per_browser: int) -> BrowserPool:
+        self.drivers = []
+
+        def factory():
+            self.drivers.append(FakeDriver())
+            return self.drivers[-1]
+
+        pool = BrowserPool(size=1, tabs_per_browser=tabs_per_browser, factory=factory)
+        pool.start()
+        return pool
+
+    def open_site(self, pool, site_id):
+        with pool.leased(site_id=site_id) as tab:
+            tab.execute_script('return document.readyState')
+            tab.site_id = site_id
+            return tab
+
+
+class ReplaceTabTest(PoolTestCase):
+
+    def test_hung_tab_gets_a_new_window(self):
+        pool = self.pool(tabs_per_browser=2)
+        first, second = self.open_site(pool, 1), self.open_site(pool, 2)
+        self.assertIsNot(first, second)
+        driver = self.drivers[0]
+        hung = second.handle
+        driver.hung.add(hung)
+
+        tab = pool.lease(site_id=2)
+        self.assertIs(tab, second)
+        self.assertNotEqual(tab.handle, hung)
+        self.assertNotIn(hung, driver.handles)
+        self.assertIsNone(tab.site_id)
+        self.assertTrue(tab.is_healthy())
+        # the other tab and the browser are untouched
+        self.assertEqual(len(self.drivers), 1)
+        self.assertEqual(first.site_id, 1)
+        self.assertIn(first.handle, driver.handles)
+
+    def test_only_window_hung_restarts_the_browser(self):
+        pool = self.pool(tabs_per_browser=1)
+        tab = self.open_site(pool, 1)
+        self.drivers[0].hung.add(tab.handle)
+
+        leased = pool.lease(site_id=1)
+        self.assertIs(leased, tab)
+        self.assertEqual(len(self.drivers), 2)
+        self.assertTrue(self.drivers[0].quit_called)
+        self.assertIsNone(tab.site_id)
+        self.assertTrue(tab.is_healthy())
+        self.assertEqual(tab.handle, self.drivers[1].handles[0])
+
+    def test_restart_forgets_the_sites_of_every_tab(self):
+        pool = self.pool(tabs_per_browser=2)
+        tabs = [self.open_site(pool, 1), self.open_site(pool, 2)]
+        pool.slots[0].restart()
+        self.assertEqual([tab.site_id for tab in tabs], [None, None])
+
+
+if __name__ == '__main__':
+    unittest.main()
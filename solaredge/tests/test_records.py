@@ -0,0 +1,98 @@
+import json
+import os
+import sys
+import unittest
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from records import SchemaError, decode_payload, decode_response, response_values  # noqa: E402
+from scrapper import ScrapMessage, WorkerThread  # noqa: E402
+
+DATE = datetime(2020, 6, 1, 12)
+
+
+def panel(energy=1.5, unscaled=1.25, module=2.0, units='Wh', relay=None):
+    return {'energy': energy, 'unscaledEnergy': unscaled, 'moduleEnergy': module,
+            'units': units, 'relayState': relay}
+
+
+class RecordingArchive:
+    def __init__(self):
+        self.records = []
+
+    def append(self, timestamp, site_id, scrap_response):
+        self.records.append((timestamp, site_id, scrap_response))
+
+    def close(self):
+        pass
+
+
+class ValidationTest(unittest.TestCase):
+
+    def test_decode_payload_reads_every_panel(self):
+        readings = decode_payload({'p1': panel(), 'p2': panel(energy=3)}, 7, DATE)
+        self.assertEqual([(r.site, r.panel, r.energy, r.moduleEnergy, r.date) for r in readings],
+                         [(7, 'p1', 1.5, 2.0, DATE), (7, 'p2', 3, 2.0, DATE)])
+
+    def test_raw_and_parsed_payloads_agree(self):
+        payload = {'p1': panel(relay='ON'), 'p2': panel(module=None)}
+        raw = decode_response({'raw': json.dumps(payload).encode('utf-8')}, 1, DATE)
+        parsed = decode_response({'res': payload}, 1, DATE)
+        self.assertEqual([r.as_row() for r in raw], [r.as_row() for r in parsed])
+
+    def test_row_and_columnar_validation_agree(self):
+        cases = [
+            {'p1': panel(module='12.5')},
+            {'p1': panel(energy='1')},
+            {'p1': panel(unscaled=True)},
+            {'p1': {'energy': 1.0}},
+            ['p1'],
+            b'{not json',
+        ]
+        for payload in cases:
+            with self.subTest(payload=payload):
+                with self.assertRaises(SchemaError):
+                    decode_payload(payload, 1, DATE)
+                with self.assertRaises(SchemaError):
+                    response_values({'res': payload} if not isinstance(payload, bytes)
+                                    else {'raw': payload})
+
+    def test_missing_numbers_are_accepted(self):
+        self.assertEqual(response_values({'res': {'p1': panel(None, None, None)}}),
+                         {'p1': panel(None, None, None)})
+        self.assertEqual(response_values({'res': {}}), {})
+
+
+class TransformTest(unittest.TestCase):
+
+    def worker(self, columnar: bool) -> WorkerThread:
+        return WorkerThread('DATA_PROCESSOR', storages=[], archive=RecordingArchive(),
+                            rollups=None, columnar=columnar)
+
+    def test_malformed_response_does_not_drop_the_message(self):
+        good = {'res': {'p1': panel()}, 'url': 'good'}
+        bad = {'res': {'p2': panel(module='n/a')}, 'url': 'bad'}
+        for columnar in (True, False):
+            with self.subTest(columnar=columnar):
+                worker = self.worker(columnar)
+                processed = worker.transform(ScrapMessage(
+                    datetime=DATE, data=[bad, good], site_id=3))
+                self.assertIsNotNone(processed)
+                self.assertEqual(processed.responses, [good])
+                if columnar:
+                    self.assertEqual(processed.data.panel_categories, ['p1'])
+                    self.assertEqual(processed.data.moduleEnergy.tolist(), [2.0])
+                else:
+                    self.assertEqual([r.panel for r in processed.data], ['p1'])
+
+    def test_only_malformed_responses_is_dropped(self):
+        for columnar in (True, False):
+            with self.subTest(columnar=columnar):
+                processed = self.worker(columnar).transform(ScrapMessage(
+                    datetime=DATE, data=[{'res': {'p1': panel(module=[1])}}], site_id=3))
+                self.assertIsNone(processed)
+
+
+if __name__ == '__main__':
+    unittest.main()
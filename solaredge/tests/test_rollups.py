@@ -0,0 +1,69 @@
+import os
+import sys
+import unittest
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rollups import SITE_PANEL, RollupEngine, bucket_start  # noqa: E402
+
+DATE = datetime(2020, 6, 1, 12)
+
+
+class RecordingWriter:
+    def __init__(self):
+        self.rows = []
+
+    def write(self, resolution, start, site_id, rows):
+        self.rows.extend((resolution, site_id) + tuple(row) for row in rows)
+
+    def of(self, resolution, panel):
+        return [row[2:] for row in self.rows if row[0] == resolution and row[3] == panel]
+
+
+class RollupEngineTest(unittest.TestCase):
+
+    def engine(self):
+        self.writer = RecordingWriter()
+        return RollupEngine(resolutions=(('1min', 60), ('5min', 300)),
+                            field='energy', writer=self.writer)
+
+    def test_bucket_start(self):
+        self.assertEqual(bucket_start(DATE + timedelta(minutes=7, seconds=3), 300),
+                         DATE + timedelta(minutes=5))
+
+    def test_finished_buckets_are_written(self):
+        engine = self.engine()
+        for seconds, values in ((0, (1.0, 10.0)), (30, (2.0, 11.0)), (60, (4.0, 12.0))):
+            engine.add(1, ['p1', 'p2'], values, DATE + timedelta(seconds=seconds))
+        # start, panel, delta, min, max, count
+        self.assertEqual(self.writer.of('1min', 'p1'), [(DATE, 'p1', 1.0, 1.0, 2.0, 2)])
+        self.assertEqual(self.writer.of('1min', SITE_PANEL),
+                         [(DATE, SITE_PANEL, 2.0, 11.0, 13.0, 2)])
+        engine.close()
+        minute = DATE + timedelta(minutes=1)
+        # delta against the last value of the previous bucket
+        self.assertEqual(self.writer.of('1min', 'p1')[1], (minute, 'p1', 2.0, 4.0, 4.0, 1))
+        self.assertEqual(self.writer.of('5min', 'p1'), [(DATE, 'p1', 3.0, 1.0, 4.0, 3)])
+
+    def test_missing_and_late_values(self):
+        engine = self.engine()
+        engine.add(1, ['p1', 'p2'], [1.0, None], DATE + timedelta(minutes=2))
+        engine.add(1, ['p1', 'p2'], [float('nan'), 3.0], DATE + timedelta(minutes=2, seconds=1))
+        engine.add(1, ['p1'], [5.0], DATE)
+        self.assertEqual(engine.late, 1)
+        engine.close()
+        self.assertEqual([row[-1] for row in self.writer.of('1min', 'p1')], [1])
+        self.assertEqual([row[-1] for row in self.writer.of('1min', 'p2')], [1])
+
+    def test_sites_are_separate(self):
+        engine = self.engine()
+        engine.add(1, ['p1'], [1.0], DATE)
+        engine.add(2, ['p1'], [7.0], DATE)
+        engine.close()
+        self.assertEqual(sorted(row[1] for row in self.writer.rows if row[0] == '1min'),
+                         [1, 1, 2, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
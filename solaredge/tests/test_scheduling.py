@@ -0,0 +1,75 @@
+import os
+import sys
+import unittest
+from datetime import date, datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import Site  # noqa: E402
+from scheduling import AdaptiveScheduler, sun_times  # noqa: E402
+
+SITE = Site(site_id=1, name='test', interval=60)
+LONDON = Site(site_id=2, name='london', interval=60, latitude=51.5, longitude=-0.12)
+
+
+def utc(*args) -> float:
+    return datetime(*args, tzinfo=timezone.utc).timestamp()
+
+
+class SunTimesTest(unittest.TestCase):
+
+    def test_equinox_at_the_equator(self):
+        sunrise, sunset = sun_times(date(2020, 3, 20), 0.0, 0.0)
+        self.assertAlmostEqual(sunrise, utc(2020, 3, 20, 6, 4), delta=5 * 60)
+        self.assertAlmostEqual(sunset, utc(2020, 3, 20, 18, 10), delta=5 * 60)
+
+    def test_polar_night_and_day(self):
+        self.assertEqual(sun_times(date(2020, 12, 21), 80.0, 0.0), (None, None))
+        sunrise, sunset = sun_times(date(2020, 6, 21), 80.0, 0.0)
+        self.assertEqual((sunrise, sunset), (float('-inf'), float('inf')))
+
+
+class AdaptiveSchedulerTest(unittest.TestCase):
+
+    def scheduler(self) -> AdaptiveScheduler:
+        return AdaptiveScheduler(min_interval=30, max_interval=1800, lag=15,
+                                 night_margin=1800, night_interval=3600)
+
+    def test_scrape_follows_the_update_period(self):
+        scheduler = self.scheduler()
+        start = utc(2020, 6, 21, 12)
+        for index in range(3):
+            scheduler.observe(SITE.site_id, True, start + 300 * index)
+        # next update expected at start + 900, scraped lag seconds after it
+        self.assertAlmostEqual(scheduler.next_delay(SITE, start + 610), 305)
+        # too close to the expected update, wait for the one after
+        self.assertAlmostEqual(scheduler.next_delay(SITE, start + 900), 315)
+
+    def test_missed_updates_do_not_inflate_the_period(self):
+        scheduler = self.scheduler()
+        start = utc(2020, 6, 21, 12)
+        for when in (0, 300, 900, 1200):
+            scheduler.observe(SITE.site_id, True, start + when)
+        self.assertAlmostEqual(scheduler.next_delay(SITE, start + 1210), 305)
+
+    def test_idle_polls_back_off(self):
+        scheduler = self.scheduler()
+        now = utc(2020, 6, 21, 12)
+        for _ in range(6):
+            scheduler.observe(SITE.site_id, False, now)
+        for _ in range(20):
+            delay = scheduler.next_delay(SITE, now)
+            self.assertGreaterEqual(delay, 4 * SITE.interval)
+            self.assertLessEqual(delay, 8 * SITE.interval)
+
+    def test_night_waits_for_sunrise(self):
+        scheduler = self.scheduler()
+        self.assertEqual(scheduler.next_delay(LONDON, utc(2020, 6, 21, 0)), 3600)
+        # sunrise is about 03:43 utc, scraping resumes half an hour before
+        delay = scheduler.next_delay(LONDON, utc(2020, 6, 21, 3))
+        self.assertAlmostEqual(delay, 13 * 60, delta=5 * 60)
+        self.assertIsNone(scheduler.night_delay(LONDON, utc(2020, 6, 21, 12)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,30 @@
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import scrapper  # noqa: E402
+from scrapper import HttpScrappingThread  # noqa: E402
+
+
+class EmptyRegistryTest(unittest.TestCase):
+
+    def test_idles_until_stopped(self):
+        with mock.patch.object(scrapper, 'load_sites', return_value=[]):
+            thread = HttpScrappingThread(client=mock.Mock())
+        self.assertEqual(thread.sites, [])
+        with self.assertLogs('solaredge', 'WARNING') as logs:
+            thread.start()
+            thread.join(0.2)
+            self.assertTrue(thread.is_alive())
+            thread.stop()
+            thread.join(2)
+        self.assertFalse(thread.is_alive())
+        self.assertIn('No sites registered', logs.output[0])
+        thread.client.warm_up.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+import http.client
+import json
+import os
+import sys
+import unittest
+from datetime import datetime
+from email.utils import formatdate
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from records import PanelColumns, PanelReading  # noqa: E402
+from state import LatestState, StateServer  # noqa: E402
+
+DATE = datetime(2020, 6, 1, 12)
+
+
+def readings(energy: float, panels=('p1', 'p2')):
+    return [PanelReading(1, panel, energy, 'Wh', energy, energy, None, DATE)
+            for panel in panels]
+
+
+class LatestStateTest(unittest.TestCase):
+
+    def test_latest_merges_rows_and_columns(self):
+        state = LatestState(history=3)
+        state.update(1, readings(1.0), DATE)
+        state.update(1, PanelColumns.from_readings(readings(2.0, ('p2',))), DATE)
+        latest = state.latest(1)
+        self.assertEqual(latest['version'], 2)
+        self.assertEqual(latest['panels']['p1']['energy'], 1.0)
+        self.assertEqual(latest['panels']['p2']['energy'], 2.0)
+
+    def test_history_is_bounded(self):
+        state = LatestState(history=2)
+        for energy in (1.0, 2.0, 3.0):
+            state.update(1, readings(energy), DATE)
+        recent = state.recent(1, 'p1')
+        self.assertEqual(list(recent['panels']), ['p1'])
+        self.assertEqual([value['energy'] for value in recent['panels']['p1']], [2.0, 3.0])
+
+    def test_render_is_cached_until_the_site_changes(self):
+        state = LatestState()
+        state.update(1, readings(1.0), DATE)
+        body = state.render('latest', 1)
+        self.assertIs(state.render('latest', 1), body)
+        state.update(1, readings(2.0), DATE)
+        self.assertIsNot(state.render('latest', 1), body)
+        self.assertIsNone(state.render('latest', 2))
+
+    def test_cache_holds_known_panels_only(self):
+        state = LatestState()
+        state.update(1, readings(1.0), DATE)
+        for name in ('p1', 'p1', 'p2', 'unknown', 'other'):
+            state.render('history', 1, name)
+            state.render('latest', 1, name)
+        self.assertIsNone(state.render('history', 1, 'unknown'))
+        self.assertEqual(sorted(key[2] or '' for key in state._cache), ['', 'p1', 'p2'])
+
+
+class StateServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.state = LatestState()
+        self.state.update(1, readings(1.0), DATE)
+        self.server = StateServer(self.state, host='127.0.0.1', port=0)
+        self.server.start()
+        self.addCleanup(self.server.close)
+
+    def get(self, path: str, **headers):
+        connection = http.client.HTTPConnection(*self.server.address, timeout=5)
+        self.addCleanup(connection.close)
+        connection.request('GET', path, headers=headers)
+        response = connection.getresponse()
+        return response, response.read()
+
+    def test_latest(self):
+        response, body = self.get('/sites/1/latest')
+        self.assertEqual(response.status, 200)
+        self.assertEqual(json.loads(body)['panels']['p2']['energy'], 1.0)
+        self.assertEqual(response.getheader('ETag'), '"latest-1-1"')
+
+    def test_etag_answers_304_until_the_site_changes(self):
+        response, _ = self.get('/sites/1/latest')
+        etag = response.getheader('ETag')
+        response, body = self.get('/sites/1/latest', **{'If-None-Match': etag})
+        self.assertEqual((response.status, body), (304, b''))
+        self.state.update(1, readings(2.0), DATE)
+        response, body = self.get('/sites/1/latest', **{'If-None-Match': etag})
+        self.assertEqual(response.status, 200)
+        self.assertNotEqual(response.getheader('ETag'), etag)
+
+    def test_if_modified_since(self):
+        response, _ = self.get('/sites', **{
+            'If-Modified-Since': formatdate(self.state.modified + 1, usegmt=True)})
+        self.assertEqual(response.status, 304)
+        response, _ = self.get('/sites', **{
+            'If-Modified-Since': formatdate(self.state.modified - 10, usegmt=True)})
+        self.assertEqual(response.status, 200)
+
+    def test_unknown_paths(self):
+        self.assertEqual(self.get('/sites/2/latest')[0].status, 404)
+        self.assertEqual(self.get('/nope')[0].status, 404)
+        self.assertEqual(self.get('/sites/1/history?panel=nope')[0].status, 404)
+        response, body = self.get('/sites/1/history?panel=p1')
+        self.assertEqual(list(json.loads(body)['panels']), ['p1'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import storage  # noqa: E402
+from metrics import STORAGE_ERRORS  # noqa: E402
+from records import PanelReading  # noqa: E402
+from scrapper import ProcessedMessage, ScrapMessage, WorkerThread  # noqa: E402
+from storage import ParquetStorage, StorageBackend  # noqa: E402
+
+DATE = datetime(2020, 6, 1, 12)
+
+
+def readings(count: int, site_id: int = 1):
+    return [PanelReading(site_id, 'p%d' % index, 1.5, 'Wh', 1.25, 2.0, None,
+                         DATE + timedelta(seconds=index)) for index in range(count)]
+
+
+class RecordingStorage(StorageBackend):
+    def __init__(self):
+        self.rows = []
+
+    def write(self, readings, timestamp, site_id):
+        self.rows.extend(readings)
+
+
+class FailingStorage(StorageBackend):
+    def write(self, readings, timestamp, site_id):
+        raise ValueError('broken')
+
+
+class RecordingArchive:
+    def __init__(self):
+        self.records = []
+
+    def append(self, timestamp, site_id, scrap_response):
+        self.records.append(scrap_response)
+
+    def close(self):
+        pass
+
+
+class StoreTest(unittest.TestCase):
+
+    def test_failing_storage_does_not_skip_the_others(self):
+        recording, archive = RecordingStorage(), RecordingArchive()
+        worker = WorkerThread('DATA_PROCESSOR', storages=[FailingStorage(), recording],
+                              archive=archive, rollups=None)
+        errors = STORAGE_ERRORS.value(storage='FailingStorage')
+        message = ScrapMessage(datetime=DATE, data=[{'res': {}}], site_id=1)
+        worker.store(ProcessedMessage(message, readings(2), False, message.data))
+        self.assertEqual(len(recording.rows), 2)
+        self.assertEqual(archive.records, message.data)
+        self.assertEqual(STORAGE_ERRORS.value(storage='FailingStorage'), errors + 1)
+
+    def test_archive_written_when_storages_raise(self):
+        archive = RecordingArchive()
+        worker = WorkerThread('DATA_PROCESSOR', storages=[], archive=archive, rollups=None)
+        worker.write_storages = mock.Mock(side_effect=RuntimeError('boom'))
+        message = ScrapMessage(datetime=DATE, data=[{'res': {}}], site_id=1)
+        with self.assertRaises(RuntimeError):
+            worker.store(ProcessedMessage(message, readings(1), False, message.data))
+        self.assertEqual(archive.records, message.data)
+
+
+class ParquetRetryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+
+    def parts(self):
+        return [name for _, _, names in os.walk(self.root) for name in names]
+
+    def test_failed_write_keeps_the_rows(self):
+        parquet = ParquetStorage(root=self.root, flush_interval=60)
+        parquet.write(readings(3), DATE, 1)
+        with mock.patch.object(storage.pq, 'write_table', side_effect=OSError('disk full')):
+            parquet.flush()
+        self.assertEqual(self.parts(), [])
+        parquet.write(readings(2), DATE, 1)
+        parquet.flush()
+        [part] = self.parts()
+        table = storage.pq.read_table(os.path.join(self.root, 'site=1', 'day=2020-06-01', part))
+        self.assertEqual(table.num_rows, 5)
+
+    def test_retry_waits_for_the_flush_interval(self):
+        parquet = ParquetStorage(root=self.root, row_group_size=1, flush_interval=60)
+        with mock.patch.object(storage.pq, 'write_table', side_effect=OSError('disk full')) as write:
+            parquet.write(readings(1), DATE, 1)
+            parquet.write(readings(1), DATE, 1)
+            parquet.flush_expired()
+        self.assertEqual(write.call_count, 1)
+        parquet.close()
+        self.assertEqual(len(self.parts()), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import scrapper  # noqa: E402
+import storage  # noqa: E402
+from scrapper import BoundedQueue, ScrapMessage, WorkerPool  # noqa: E402
+from storage import StorageBackend  # noqa: E402
+
+DATE = datetime(2020, 6, 1, 12)
+
+
+class RecordingStorage(StorageBackend):
+    def __init__(self):
+        self.writes = []
+        self._lock = threading.Lock()
+
+    def write(self, readings, timestamp, site_id):
+        with self._lock:
+            self.writes.append((site_id, readings[0].energy, threading.current_thread().name))
+
+
+def message(site_id: int, index: int) -> ScrapMessage:
+    values = {'energy': float(index), 'unscaledEnergy': float(index),
+              'moduleEnergy': float(index), 'units': 'Wh', 'relayState': None}
+    return ScrapMessage(datetime=DATE + timedelta(seconds=index),
+                        data=[{'res': {'p1': values}, 'url': None}], site_id=site_id)
+
+
+class WorkerPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        for name, value in (('SCRAP_DATA', self.root), ('_known_folders', set())):
+            patcher = mock.patch.object(storage, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_sites_are_processed_in_order_by_one_thread(self):
+        recording = RecordingStorage()
+        pool = WorkerPool('DATA_PROCESSOR', size=3, storages=[recording])
+        pool.start()
+        try:
+            for index in range(20):
+                for site_id in range(5):
+                    pool.put_message(message(site_id, index))
+            self.assertTrue(pool.join(timeout=10))
+        finally:
+            scrapper.EXIT_SIG = 1
+            try:
+                pool.join_workers(timeout=10)
+            finally:
+                scrapper.EXIT_SIG = 0
+            pool.close()
+        self.assertEqual(len(recording.writes), 100)
+        for site_id in range(5):
+            writes = [write for write in recording.writes if write[0] == site_id]
+            self.assertEqual([energy for _, energy, _ in writes], [float(i) for i in range(20)])
+            self.assertEqual(len({thread for _, _, thread in writes}), 1)
+        self.assertFalse(any(worker.is_alive() for worker in pool.workers))
+
+
+class BoundedQueueTest(unittest.TestCase):
+
+    def test_drop_oldest(self):
+        queue = BoundedQueue(maxsize=2, policy='drop_oldest')
+        for item in range(4):
+            queue.put_message(item)
+        self.assertEqual([queue.get_nowait() for _ in range(2)], [2, 3])
+        self.assertEqual(queue.dropped, 2)
+
+    def test_join_times_out_with_unfinished_messages(self):
+        queue = BoundedQueue(maxsize=2, policy='block')
+        queue.put_message(1)
+        self.assertFalse(queue.join(timeout=0.05))
+        queue.get_nowait()
+        queue.task_done()
+        self.assertTrue(queue.join(timeout=0.05))
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            BoundedQueue(policy='spill')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,3 +1,4 @@
+import hashlib
 import json
 import logging
 import os
@@ -9,6 +10,7 @@ from os.path import sep as native_slash
 from pathlib import Path
 from random import gauss, uniform
 from time import sleep as original_sleep
+from typing import Optional
 import os
 import colorlog
 import sys
@@ -17,9 +19,8 @@ from selenium.common.exceptions import (NoSuchElementException,
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support import expected_conditions as ec
 from selenium.webdriver.support.ui import WebDriverWait
-from webdriverdownloader import ChromeDriverDownloader, GeckoDriverDownloader
 from logging import Handler, Logger, StreamHandler
-from config import ASSETS_PATH, EXTENSION_PATH
+from config import ASSETS_PATH, DRIVER_CACHE, EXTENSION_PATH
 import shutil
 STDEV = 0.5
 sleep_percentage = 1
@@ -95,7 +96,34 @@ def get_time(labels):
     return results
 
 
+def cached_driver(name: str, resolve) -> Optional[str]:
+    """Path of driver ``name`` from DRIVER_CACHE, resolving and storing it
+    when the cached path is missing or no longer executable"""
+    try:
+        with open(DRIVER_CACHE) as cache_obj:
+            cache = json.load(cache_obj)
+    except (OSError, ValueError):
+        cache = {}
+    path = cache.get(name)
+    if path and os.path.isfile(path) and os.access(path, os.X_OK):
+        return path
+    path = resolve()
+    if path:
+        cache[name] = path
+        os.makedirs(os.path.dirname(DRIVER_CACHE), exist_ok=True)
+        # per process temporary file, sharded workers may resolve at once
+        tmp_path = '%s.%d.tmp' % (DRIVER_CACHE, os.getpid())
+        with open(tmp_path, 'w') as cache_obj:
+            json.dump(cache, cache_obj)
+        os.replace(tmp_path, DRIVER_CACHE)
+    return path
+
+
 def get_chrome_driver():
+    return cached_driver('chromedriver', find_chrome_driver)
+
+
+def find_chrome_driver():
     home = os.path.expanduser('~')
     driverpath = os.path.join(home, 'browser-drivers')
     if not os.path.exists(driverpath):
@@ -112,6 +140,7 @@ def get_chrome_driver():
     if chrome_path:
         return chrome_path
 
+    from webdriverdownloader import ChromeDriverDownloader
     try:
         gdd = ChromeDriverDownloader(driverpath, driverpath)
         _, sym_path = gdd.download_and_install()
@@ -121,30 +150,50 @@ def get_chrome_driver():
 
 
 def get_geckodriver():
+    return cached_driver('geckodriver', find_geckodriver)
+
+
+def find_geckodriver():
     gecko_path = shutil.which("geckodriver") or shutil.which("geckodriver.exe")
     if gecko_path:
         return gecko_path
+    from webdriverdownloader import GeckoDriverDownloader
     gdd = GeckoDriverDownloader(ASSETS_PATH, ASSETS_PATH)
     _, sym_path = gdd.download_and_install()
     return sym_path
 
 
+EXTENSION_FILES = ["manifest.json", 'content.js', "background.js",
+                   "arrive.js", 'beasts-32.png', 'beasts-32-light.png', 'beasts-48.png']
+
+
 def create_firefox_extension():
+    """Zip the extension into the assets folder, named after the hash of
+    its files so an unchanged extension is not zipped again"""
     ext_path = os.path.abspath(os.path.join(
         EXTENSION_PATH, "firefox_extension"))
     ext_path = str(Path(ext_path).absolute())
+    digest = hashlib.blake2b(digest_size=8)
+    for file in EXTENSION_FILES:
+        with open(ext_path + native_slash + file, 'rb') as file_obj:
+            digest.update(file.encode('utf-8') + b'\0' + file_obj.read())
     # save into assets folder
-    zip_file = os.path.join(ASSETS_PATH, 'firefox')
-    if not os.path.exists(zip_file):
-        os.mkdir(zip_file)
-    zip_file = os.path.join(zip_file, "extension.crf")
+    zip_folder = os.path.join(ASSETS_PATH, 'firefox')
+    os.makedirs(zip_folder, exist_ok=True)
+    zip_file = os.path.join(zip_folder, "extension-%s.crf" % digest.hexdigest())
     zip_file = str(Path(zip_file).absolute())
+    if os.path.exists(zip_file):
+        return zip_file
 
-    files = ["manifest.json", 'content.js', "background.js",
-             "arrive.js", 'beasts-32.png', 'beasts-32-light.png', 'beasts-48.png']
-    with zipfile.ZipFile(zip_file, "w", zipfile.ZIP_DEFLATED, False) as zipf:
-        for file in files:
+    tmp_file = '%s.%d.tmp' % (zip_file, os.getpid())
+    with zipfile.ZipFile(tmp_file, "w", zipfile.ZIP_DEFLATED, False) as zipf:
+        for file in EXTENSION_FILES:
             zipf.write(ext_path + native_slash + file, file)
+    os.replace(tmp_file, zip_file)
+    for name in os.listdir(zip_folder):
+        if (name.startswith('extension') and name.endswith('.crf')
+                and name != os.path.basename(zip_file)):
+            os.remove(os.path.join(zip_folder, name))
 
     return zip_file
 
@@ -188,7 +237,7 @@ def web_address_navigator(browser, link):
         while True:
             try:
                 browser.get(link)
-                sleep(2)
+                explicit_wait(browser, "PFL", [], None, 10, notify=False)
                 break
             except TimeoutException as exc:
                 if total_timeouts >= 7:
@@ -212,12 +261,14 @@ def reload_webpage(browser):
     return True
 
 
-def explicit_wait(browser, track, ec_params, logger, timeout=35, notify=True):
+def explicit_wait(browser, track, ec_params, logger, timeout=35, notify=True,
+                  poll_frequency=0.5):
     """
     Explicitly wait until expected condition validates
 
     :param notify:
     :param timeout:
+    :param poll_frequency: seconds between two checks of the condition
     :param browser: webdriver instance
     :param track: short name of the expected condition
     :param ec_params: expected condition specific parameters - [param1, param2]
@@ -255,6 +306,21 @@ def explicit_wait(browser, track, ec_params, logger, timeout=35, notify=True):
             "return document.readyState"
         ) in ["complete" or "loaded"]
 
+    elif track == "XHR":
+        expected_count = ec_params[0]
+        ec_name = "{} responses intercepted".format(expected_count)
+
+        def condition(browser): return (browser.execute_script(
+            "return __get_count()"
+        ) or 0) >= expected_count
+
+    elif track == "NET":
+        capture, site_id, expected_count = ec_params
+        ec_name = "{} responses captured for site {}".format(
+            expected_count, site_id)
+
+        def condition(browser): return capture.count(site_id) >= expected_count
+
     elif track == "SO":
         ec_name = "staleness of"
         element = ec_params[0]
@@ -266,7 +332,7 @@ def explicit_wait(browser, track, ec_params, logger, timeout=35, notify=True):
 
         condition = fail
     try:
-        wait = WebDriverWait(browser, timeout)
+        wait = WebDriverWait(browser, timeout, poll_frequency=poll_frequency)
         result = wait.until(condition)
     except TimeoutException:
         if notify is True:
@@ -280,6 +346,31 @@ def explicit_wait(browser, track, ec_params, logger, timeout=35, notify=True):
     return result
 
 
+PAGE_STATS_SCRIPT = """
+var nav = performance.getEntriesByType('navigation')[0];
+var resources = performance.getEntriesByType('resource');
+var transferred = nav ? nav.transferSize : 0;
+for (var i = 0; i < resources.length; i++) {
+    transferred += resources[i].transferSize || 0;
+}
+return {
+    load_ms: nav ? nav.loadEventEnd - nav.startTime : null,
+    resources: resources.length,
+    transferred: transferred,
+    js_heap: performance.memory ? performance.memory.usedJSHeapSize : null
+};
+"""
+
+
+def page_stats(browser):
+    """Load time, resource count, bytes transferred and js heap of the
+    current page, from the performance api; None when unavailable"""
+    try:
+        return browser.execute_script(PAGE_STATS_SCRIPT)
+    except WebDriverException:
+        return None
+
+
 def get_page_title(browser, logger):
     """ Get the title of the webpage """
     # wait for the current _page fully load to get the correct _page's title